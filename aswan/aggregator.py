@@ -1,4 +1,607 @@
 """ Code to aggregate incoming tables """
+import bisect
+import functools
+import hashlib
+import math
+import random
+import sys
+import time
+from stats import STATS
+from store import format_number
+
+
+def weight(row, column):
+    """ The value of a column as a number, or one to count rows. """
+    if column is None:
+        return 1
+    try:
+        return float(row[column])
+    except (IndexError, TypeError, ValueError):
+        return 0
+
+
+def describe(column):
+    """ Name of counting rows or summing a column. """
+    return 'count' if column is None else f'sum {column + 1}'
+
+
+class SlidingWindow():
+    """ Sums values added over the last seconds in a ring buffer of buckets,
+    buckets are emptied as time moves past them. """
+    __slots__ = ('width', 'buckets', 'current', 'total')
+
+    def __init__(self, seconds, buckets=60):
+        super().__init__()
+        self.width = seconds / buckets
+        self.buckets = [0] * buckets
+        self.current = None
+        self.total = 0
+
+    def advance(self, now):
+        """ Move the window to end at now. """
+        bucket = int(now // self.width)
+        if self.current is None:
+            self.current = bucket
+        elapsed = bucket - self.current
+        if elapsed <= 0:
+            return
+        count = len(self.buckets)
+        if elapsed >= count:
+            self.buckets = [0] * count
+            self.total = 0
+        else:
+            for expired in range(self.current + 1, bucket + 1):
+                self.buckets[expired % count] = 0
+            self.total = sum(self.buckets)
+        self.current = bucket
+
+    def add(self, value, now):
+        """ Add a value at time now. """
+        self.advance(now)
+        self.buckets[self.current % len(self.buckets)] += value
+        self.total += value
+
+
+class SpaceSaving():
+    """ Approximate heaviest k values of a stream. A value not yet counted
+    replaces the lightest counted value inheriting its count, so counts
+    overestimate by at most the lightest count. """
+    __slots__ = ('k', 'counts')
+
+    def __init__(self, k):
+        super().__init__()
+        self.k = k
+        self.counts = {}
+
+    def add(self, value, amount=1):
+        """ Count amount for value. """
+        counts = self.counts
+        if value in counts or len(counts) < self.k:
+            counts[value] = counts.get(value, 0) + amount
+            return
+        lightest = min(counts, key=counts.get)
+        counts[value] = counts.pop(lightest) + amount
+
+    def top(self):
+        """ The counted values heaviest first. """
+        return sorted(self.counts.items(), key=lambda item: -item[1])
+
+
+def stable_hash(value):
+    """ A 64 bit hash of a value that is the same in every process. """
+    return int.from_bytes(hashlib.blake2b(str(value).encode(),
+                                          digest_size=8).digest(), 'little')
+
+
+class HyperLogLog():
+    """ Approximate count of distinct values in 2 ** precision registers with
+    a relative error of about 1.04 / sqrt(2 ** precision). Registers are kept
+    sparse in a dictionary until it would outgrow the dense registers, and
+    the sum the estimate needs is kept up to date as registers change.
+    Sketches of the same precision merge into the sketch of the combined
+    streams. """
+    __slots__ = ('precision', 'registers', 'zeros', 'harmonic')
+
+    def __init__(self, precision=10):
+        super().__init__()
+        self.precision = precision
+        self.registers = {}
+        self.zeros = 1 << precision
+        self.harmonic = float(self.zeros)
+
+    def add(self, value):
+        """ Count a value. """
+        hashed = stable_hash(value)
+        index = hashed & ((1 << self.precision) - 1)
+        self.raise_register(
+            index, 65 - self.precision - (hashed >> self.precision).bit_length())
+
+    def raise_register(self, index, rank):
+        """ Set a register to rank if that is higher. """
+        registers = self.registers
+        sparse = type(registers) is dict
+        old = registers.get(index, 0) if sparse else registers[index]
+        if rank <= old:
+            return
+        registers[index] = rank
+        self.harmonic += 2.0 ** -rank - 2.0 ** -old
+        if not old:
+            self.zeros -= 1
+            if sparse and len(registers) << 5 > 1 << self.precision:
+                self.densify()
+
+    def densify(self):
+        """ Switch to a register per bucket. """
+        registers = bytearray(1 << self.precision)
+        for index, rank in self.registers.items():
+            registers[index] = rank
+        self.registers = registers
+
+    def merge(self, other):
+        """ Add the values counted by another sketch of the same precision. """
+        if other.precision != self.precision:
+            raise ValueError('HyperLogLog precisions differ')
+        if type(other.registers) is dict:
+            ranks = other.registers.items()
+        else:
+            ranks = enumerate(other.registers)
+        for index, rank in ranks:
+            self.raise_register(index, rank)
+
+    def count(self):
+        """ Estimated number of distinct values. """
+        buckets = 1 << self.precision
+        alpha = 0.7213 / (1 + 1.079 / buckets)
+        estimate = alpha * buckets * buckets / self.harmonic
+        if estimate <= 2.5 * buckets and self.zeros:
+            return buckets * math.log(buckets / self.zeros)
+        return estimate
+
+    def nbytes(self):
+        """ Bytes used by the registers. """
+        return sys.getsizeof(self.registers)
+
+
+class KLL():
+    """ Approximate quantiles of a stream of numbers in a KLL sketch keeping
+    about 3 * k values. Values are buffered in compactors of decreasing
+    capacity, the lowest kept sorted so that small sketches answer directly,
+    a full compactor sorts its values and promotes every other one
+    to the level above where each stands for twice as many. Sketches with
+    the same k merge into the sketch of the combined streams. """
+    __slots__ = ('k', 'compactors', 'size', 'max_size')
+
+    def __init__(self, k=200):
+        super().__init__()
+        self.k = k
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self.grow()
+
+    def capacity(self, level):
+        """ Values held at level before it is compacted. """
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * (2 / 3) ** depth)) + 1
+
+    def grow(self):
+        """ Add a level. """
+        self.compactors.append([])
+        self.max_size = sum(self.capacity(level)
+                            for level in range(len(self.compactors)))
+
+    def add(self, value):
+        """ Add a number. """
+        bisect.insort(self.compactors[0], value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def compress(self):
+        """ Compact the lowest full levels until the sketch fits. """
+        for level, compactor in enumerate(self.compactors):
+            if len(compactor) >= self.capacity(level):
+                if level + 1 >= len(self.compactors):
+                    self.grow()
+                compactor.sort()
+                odd = compactor.pop() if len(compactor) % 2 else None
+                self.compactors[level + 1].extend(
+                    compactor[random.getrandbits(1)::2])
+                compactor[:] = [] if odd is None else [odd]
+                self.size = sum(len(values) for values in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def merge(self, other):
+        """ Add the numbers in another sketch with the same k. """
+        if other.k != self.k:
+            raise ValueError('KLL sizes differ')
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for compactor, values in zip(self.compactors, other.compactors):
+            compactor.extend(values)
+        self.compactors[0].sort()
+        self.size = sum(len(values) for values in self.compactors)
+        while self.size >= self.max_size:
+            self.compress()
+
+    def quantiles(self, fractions):
+        """ The values at each fraction of the ranked numbers. """
+        if len(self.compactors) == 1:
+            values = self.compactors[0]
+            if not values:
+                return [math.nan for _ in fractions]
+            return [values[max(math.ceil(fraction * len(values)) - 1, 0)]
+                    for fraction in fractions]
+        weighted = sorted((value, 1 << level)
+                          for level, compactor in enumerate(self.compactors)
+                          for value in compactor)
+        if not weighted:
+            return [math.nan for _ in fractions]
+        ranks = []
+        total = 0
+        for _, value_weight in weighted:
+            total += value_weight
+            ranks.append(total)
+        return [weighted[min(bisect.bisect_left(ranks, fraction * total),
+                             len(weighted) - 1)][0]
+                for fraction in fractions]
+
+    def nbytes(self):
+        """ Approximate bytes used by the retained values. """
+        return 8 * self.size
+
+
+class Distinct():
+    """ Distinct values of a column within the key estimated with a
+    HyperLogLog sketch. """
+    numeric = True
+
+    def __init__(self, column, precision=10, name=None):
+        super().__init__()
+        self.column = column
+        self.precision = precision
+        self.names = [name or f'distinct {column + 1}']
+
+    def start(self):
+        """ New state for a key. """
+        return HyperLogLog(self.precision)
+
+    def update(self, state, row, now):
+        """ Add a row returning the estimated distinct values. A row missing
+        the column adds nothing. """
+        if self.column < len(row):
+            state.add(row[self.column])
+        return (round(state.count()),)
+
+
+class Quantiles():
+    """ Quantiles of a numeric column within the key estimated with a KLL
+    sketch. The sorting needed to answer is repeated only once the number
+    of values grows by a fraction of refresh so earlier answers are reused
+    as the key gets busy. """
+    numeric = True
+
+    def __init__(self, column, fractions=(0.5, 0.95, 0.99), k=200,
+                 refresh=1 / 64, names=None):
+        super().__init__()
+        self.column = column
+        self.fractions = fractions
+        self.k = k
+        self.refresh = refresh
+        self.names = names or [f'p{fraction * 100:g} {column + 1}'
+                               for fraction in fractions]
+
+    def start(self):
+        """ New state for a key: the sketch, values added, values at the last
+        answer and the answer. """
+        return [KLL(self.k), 0, 0, ()]
+
+    def update(self, state, row, now):
+        """ Add a row returning the estimated quantiles. """
+        sketch = state[0]
+        try:
+            sketch.add(float(row[self.column]))
+            state[1] += 1
+        except (IndexError, TypeError, ValueError):
+            pass
+        if not state[3] or state[1] - state[2] > state[2] * self.refresh:
+            state[2] = state[1]
+            state[3] = tuple(sketch.quantiles(self.fractions))
+        return state[3]
+
+
+class Total():
+    """ Rows, or the sum of a column, since the key first appeared. Like all
+    aggregation functions it names the columns it adds and returns a tuple
+    of their values for each row. """
+    numeric = True
+
+    def __init__(self, column=None, name=None):
+        super().__init__()
+        self.column = column
+        self.names = [name or describe(column)]
+
+    def start(self):
+        """ New state for a key. """
+        return [0]
+
+    def update(self, state, row, now):
+        """ Add a row returning the value of the column. """
+        state[0] += weight(row, self.column)
+        return (state[0],)
+
+
+class Window():
+    """ Rows, or the sum of a column, over the last seconds. With rate the
+    value is per second. """
+    numeric = True
+
+    def __init__(self, seconds, column=None, rate=False, buckets=60,
+                 name=None):
+        super().__init__()
+        self.seconds = seconds
+        self.column = column
+        self.rate = rate
+        self.buckets = buckets
+        self.names = [name or (f'{describe(column)}/s {seconds}s' if rate
+                               else f'{describe(column)} {seconds}s')]
+
+    def start(self):
+        """ New state for a key. """
+        return SlidingWindow(self.seconds, self.buckets)
+
+    def update(self, state, row, now):
+        """ Add a row returning the value of the column. """
+        state.add(weight(row, self.column), now)
+        return (self.value(state),)
+
+    def value(self, state):
+        """ The value of the column for the rows in the window. """
+        if self.rate:
+            return state.total / self.seconds
+        return state.total
+
+
+class Top():
+    """ The heaviest values of a column within the key, counting rows or
+    summing the weight column, approximated with Space-Saving. """
+    numeric = False
+
+    def __init__(self, column, k=3, weight_column=None, name=None):
+        super().__init__()
+        self.column = column
+        self.k = k
+        self.weight_column = weight_column
+        self.names = [name or f'top {column + 1}']
+
+    def start(self):
+        """ New state for a key. """
+        return SpaceSaving(self.k)
+
+    def update(self, state, row, now):
+        """ Add a row returning the heaviest values. A row missing the column
+        adds nothing. """
+        if self.column < len(row):
+            state.add(row[self.column], weight(row, self.weight_column))
+        return (' '.join(f'{value}:{count:g}'
+                         for value, count in state.top()),)
+
+
+def aggregation_function(spec):
+    """ Build an aggregation function from its spec, for example
+    {"function": "rate", "column": 8, "seconds": 10}. """
+    function = spec.get('function')
+    column = spec.get('column')
+    seconds = spec.get('seconds')
+    name = spec.get('name')
+    if function == 'count' or function == 'sum' and column is not None:
+        if function == 'count':
+            column = None
+        if seconds is None:
+            return Total(column, name)
+        return Window(seconds, column, name=name)
+    if function == 'rate':
+        return Window(seconds or 10, column, rate=True, name=name)
+    if function == 'top' and column is not None:
+        return Top(column, spec.get('k', 3), spec.get('weight'), name)
+    if function == 'distinct' and column is not None:
+        return Distinct(column, spec.get('precision', 10), name)
+    if function == 'quantile' and column is not None:
+        return Quantiles(column, spec.get('q', (0.5, 0.95, 0.99)),
+                         spec.get('k', 200), names=spec.get('names'))
+    raise Exception(f'Unknown aggregation {spec}')
+
+
+class Aggregations():
+    """ Per key aggregation functions whose values are inserted as the first
+    columns of each row. Each function keeps incremental state for every key
+    and does constant work per row. Records are timed by when they were read.
+    The keys with rows in a window are live and their windowed columns are
+    refreshed as the windows move on without them. """
+
+    def __init__(self, specs):
+        super().__init__()
+        self.functions = [aggregation_function(spec) for spec in specs]
+        self.states = {}
+        self.live = {}
+        self.windows = []
+        column = 0
+        for index, function in enumerate(self.functions):
+            if isinstance(function, Window):
+                self.windows.append((index, column, function))
+            column += len(function.names)
+        self.refresh_seconds = min(
+            (function.seconds / function.buckets
+             for _, _, function in self.windows), default=None)
+        self.refreshed = None
+
+    @property
+    def headers(self):
+        """ Names of the inserted columns. """
+        return [name for function in self.functions for name in function.names]
+
+    def metadata(self, metadata):
+        """ Metadata describing the rows once the columns are inserted. """
+        columns = [function for function in self.functions
+                   for _ in function.names]
+        numeric = [column for column, function in enumerate(columns)
+                   if function.numeric]
+        numeric += [column + len(columns)
+                    for column in metadata.get('numeric', ())]
+        return {**metadata, 'numeric': numeric, 'headers': self.headers}
+
+    def forget(self, keys):
+        """ Drop the state of keys no longer in the report. """
+        states = self.states
+        live = self.live
+        for key in keys:
+            states.pop(key, None)
+            live.pop(key, None)
+
+    def clear(self):
+        """ Drop the state of every key. """
+        self.states.clear()
+        self.live.clear()
+
+    def refresh(self, now):
+        """ Move the windows of the live keys to now, at most once every
+        window bucket, returning {key: [(column, value), ...]} for the keys
+        whose windowed values changed. Keys whose windows are empty are no
+        longer live. """
+        if not self.windows or (self.refreshed is not None and
+                                now - self.refreshed < self.refresh_seconds):
+            return {}
+        self.refreshed = now
+        changed = {}
+        idle = []
+        for key, states in self.live.items():
+            values = []
+            empty = True
+            for index, column, function in self.windows:
+                state = states[index]
+                before = state.total
+                state.advance(now)
+                if state.total != before:
+                    values.append((column, function.value(state)))
+                if state.total:
+                    empty = False
+            if values:
+                changed[key] = values
+            if empty:
+                idle.append(key)
+        for key in idle:
+            self.live.pop(key, None)
+        return changed
+
+    def apply(self, groups, now):
+        """ Update the state of each group's key with its rows, inserting
+        the aggregated values in the rows. Rows without a key are
+        aggregated on their own. """
+        functions = self.functions
+        live = self.live if self.windows else None
+        for index, (row_key, rows) in enumerate(groups):
+            if row_key is not None:
+                states = self.states.get(row_key)
+                if states is None:
+                    states = [function.start() for function in functions]
+                    self.states[row_key] = states
+                if live is not None:
+                    live[row_key] = states
+            else:
+                states = [function.start() for function in functions]
+            aggregated = []
+            for row in rows:
+                values = ()
+                for function, state in zip(functions, states):
+                    values += function.update(state, row, now)
+                aggregated.append(values + tuple(row))
+            groups[index] = (row_key, aggregated)
+
+
+@functools.lru_cache(maxsize=65536)
+def ip_prefix(value, bits):
+    """ The IPv4 network of bits at the start of value, 10.1.2.0/24 for
+    10.1.2.3 or 10.1.2.3.80 with 24 bits, or value if it is not an
+    address. """
+    parts = value.split('.', 4)
+    try:
+        address = (int(parts[0]) << 24 | int(parts[1]) << 16
+                   | int(parts[2]) << 8 | int(parts[3]))
+    except (IndexError, ValueError):
+        return value
+    address &= 0xffffffff << 32 - bits
+    return (f'{address >> 24 & 255}.{address >> 16 & 255}.'
+            f'{address >> 8 & 255}.{address & 255}/{bits}')
+
+
+def url_path(value):
+    """ A URL or request path without its query string or fragment. """
+    return value.partition('?')[0].partition('#')[0]
+
+
+def bucket(value, seconds):
+    """ The start of the bucket of seconds holding a numeric time, or value
+    itself if it is not a number. """
+    try:
+        start = math.floor(float(value) / seconds) * seconds
+    except (TypeError, ValueError, OverflowError):
+        return value
+    return format_number(float(start))
+
+
+def key_source(spec):
+    """ Source of the expression computing one part of a key from a row. A
+    part is a column number or a dict naming a column and optionally how its
+    value is reduced: to an ip_prefix of so many bits, its URL path, the
+    start of a time bucket of so many seconds or a slice of characters. The
+    part "source", the input a row was read from, is only set when several
+    inputs are read and is otherwise empty. """
+    if spec == 'source':
+        return '""'
+    if isinstance(spec, int):
+        spec = {'column': spec}
+    if not isinstance(spec, dict) or 'column' not in spec:
+        raise ValueError(f'Key part {spec!r} is not a column')
+    column = int(spec['column'])
+    if column < 0:
+        raise ValueError(f'Key column {column} is negative')
+    value = f'row[{column}]'
+    if 'ip_prefix' in spec:
+        bits = int(spec['ip_prefix'])
+        if not 0 <= bits <= 32:
+            raise ValueError(f'Key ip_prefix {bits} is not 0 to 32 bits')
+        value = f'ip_prefix({value}, {bits})'
+    elif spec.get('path'):
+        value = f'url_path({value})'
+    elif 'bucket' in spec:
+        seconds = float(spec['bucket'])
+        if not 0 < seconds < math.inf:
+            raise ValueError(f'Key bucket {seconds} is not a positive width')
+        value = f'bucket({value}, {seconds!r})'
+    elif 'slice' in spec:
+        start, end = ('' if i is None else int(i) for i in spec['slice'])
+        value = f'{value}[{start}:{end}]'
+    return f'(intern({value}) if size > {column} else "")'
+
+
+def key_function(spec):
+    """ Compile a key spec into a function returning the key of a row, or
+    None if the spec is None and rows have no key. A list of parts makes a
+    composite key that is a tuple. Keys are interned strings, shared with
+    the report's cells, and a missing field is an empty value which is a
+    key like any other. A spec that cannot be computed raises ValueError. """
+    if spec is None:
+        return None
+    if isinstance(spec, list):
+        key = '(' + ''.join(f'{key_source(part)}, ' for part in spec) + ')'
+    else:
+        key = key_source(spec)
+    namespace = {'intern': sys.intern, 'ip_prefix': ip_prefix,
+                 'url_path': url_path, 'bucket': bucket}
+    exec(f'def row_key(row):\n    size = len(row)\n    return {key}',
+         namespace)
+    return namespace['row_key']
 
 
 class Aggregator():
@@ -8,27 +611,114 @@ class Aggregator():
     def __init__(self, tabulator):
         super().__init__()
         self.tabulator = tabulator
+        self.ingest = None
+        self.aggregations = None
+        self.generation = None
+        self.key_spec = None
+        self.row_key = None
+        self.clock = None
 
-    def update(self, report):
-        """ Get next table and aggregate data into the final report """
-        table = self.tabulator.update()
+    def prepare(self, table):
+        """ Group the rows of a table by key ready to be applied to a report.
+        The report is not touched so this may run on the ingest thread. When
+        the metadata has no key each row gets a group of its own. Rows are
+        aggregated at the time the table was read and the windowed values of
+        live keys that changed since are added as the table's refresh. A
+        table without rows moves the windows to now unless more input is
+        pending. """
         rows = table['rows']
+        if not rows:
+            table['groups'] = []
+            if self.aggregations is not None and not table.get('pending'):
+                if table.get('generation') == self.generation:
+                    self.clock = max(self.clock or 0, time.time())
+                    table['refresh'] = self.aggregations.refresh(self.clock)
+            return table
         metadata = table['metadata']
-        key_column = metadata.get('key')
+        key_spec = metadata.get('key')
+        if key_spec != self.key_spec or self.row_key is None:
+            self.key_spec = key_spec
+            self.row_key = key_function(key_spec)
+        row_key = self.row_key
 
-        row_key = None
-        for row in rows:
-            row = row[:125]
+        groups = []
+        if row_key is None:
+            groups = [(None, [row[:125]]) for row in rows]
+        else:
+            group_index = {}
+            for row in rows:
+                row = row[:125]
+                key = row_key(row)
+                index = group_index.get(key)
+                if index is None:
+                    group_index[key] = len(groups)
+                    groups.append((key, [row]))
+                else:
+                    groups[index][1].append(row)
 
-            if key_column:
-                if len(row) < key_column:
-                    raise Exception(f'Row is missing a key {row}')
-                row_key = row[key_column]
+        if table.get('generation') != self.generation:
+            self.generation = table.get('generation')
+            specs = metadata.get('aggregate')
+            self.aggregations = Aggregations(specs) if specs else None
+            self.clock = None
+        if self.aggregations is not None and groups:
+            now = table.get('time')
+            if now is None:
+                now = time.time()
+            self.clock = now
+            self.aggregations.apply(groups, now)
+            table['refresh'] = self.aggregations.refresh(now)
+            table['metadata'] = self.aggregations.metadata(metadata)
 
-            existing_row = report.try_get_row_by_key(row_key)
-            if existing_row is not None:
-                report.update_in_place(existing_row, row)
-            else:
-                report.append_row_for_key(row_key, row)
+        table['groups'] = groups
+        return table
+
+    def forget(self, keys):
+        """ Drop the aggregation state of keys evicted from the report. """
+        self.request_drop(keys)
 
+    def clear(self):
+        """ Drop the aggregation state of all keys. """
+        self.request_drop(None)
+
+    def request_drop(self, keys):
+        """ Drop the state of keys, or of all keys when keys is None, for the
+        tabulator generation the report is showing. The state is owned by
+        the thread preparing tables so with an ingest thread the drop is
+        queued for it. """
+        if self.ingest is None:
+            self.drop(self.generation, keys)
+        else:
+            self.ingest.call(self.drop, self.tabulator.generation, keys)
+
+    def drop(self, generation, keys):
+        """ Drop the state of keys, or of all keys when keys is None, unless
+        a newer generation has already started fresh aggregations. """
+        if self.aggregations is None or generation != self.generation:
+            return
+        if keys is None:
+            self.aggregations.clear()
+        else:
+            self.aggregations.forget(keys)
+
+    def apply(self, report, table):
+        """ Insert or update the report rows for each group of a prepared
+        table as one batch, then set the refreshed windowed values. """
+        if table['groups']:
+            metadata = table['metadata']
+            report.apply(table['groups'], metadata.get('numeric', ()),
+                         metadata.get('headers', ()))
+        if table.get('refresh'):
+            report.refresh(table['refresh'])
+
+    def update(self, report):
+        """ Get next table and aggregate data into the final report """
+        if self.ingest is not None:
+            table = self.ingest.update()
+        else:
+            table = self.tabulator.update()
+            with STATS.timer('aggregate'):
+                table = self.prepare(table)
+        with STATS.timer('model'):
+            self.apply(report, table)
         return table
@@ -20,20 +20,100 @@ fields. The records are converted to a table including metadata and passed
 to the aggregator. The aggregator groups records and updates the report
 using key metadata provided by the proceeding tabulation process.
 """
+import argparse
+import multiprocessing
 import sys
 from PyQt5.QtWidgets import QApplication
 from aggregator import Aggregator
+from capture import CaptureFile
+from history import CODECS, ChunkHistory
+from ingest import Ingest
 from mainwindow import MainWindow
 from report import Report
+from stats import STATS
+from store import EvictionPolicy, HistoryPolicy
 from tabulator import Tabulator
 
 
 if __name__ == '__main__':
-    APPLICATION = QApplication(sys.argv)
-    APPLICATION.TABULATOR = Tabulator()
+    multiprocessing.freeze_support()
+    PARSER = argparse.ArgumentParser(description='Aswan stream aggregator')
+    PARSER.add_argument('--workers', type=int, default=0,
+                        help='parse fields with this many worker processes')
+    PARSER.add_argument('--history-limit', type=int, default=None,
+                        help='keep at most this many updates per key')
+    PARSER.add_argument('--history-stride', type=int, default=1,
+                        help='keep only every Nth update of a key')
+    PARSER.add_argument('--history-keep-first', action='store_true',
+                        help='always keep the first update of a key')
+    PARSER.add_argument('--history-drop-last', action='store_true',
+                        help='do not show the latest update between strides')
+    PARSER.add_argument('--history-budget', type=float, default=None,
+                        help='MiB of update history to keep across all keys')
+    PARSER.add_argument('--max-rows', type=int, default=None,
+                        help='evict rows to keep at most this many keys')
+    PARSER.add_argument('--evict', choices=EvictionPolicy.ORDERS,
+                        default='lru', help='evict the least recently or '
+                        'least frequently updated rows first')
+    PARSER.add_argument('--ttl', type=float, default=None,
+                        help='evict rows not updated for this many seconds')
+    PARSER.add_argument('--stats', metavar='FILE',
+                        help='append per tick pipeline statistics as JSONL')
+    PARSER.add_argument('--source', action='append', metavar='SPEC',
+                        help='read this source instead of stdin, repeatable: '
+                        '- for stdin, a file or FIFO path, tail:PATH, '
+                        'udp:HOST:PORT or tcp:HOST:PORT')
+    PARSER.add_argument('--capture', metavar='FILE',
+                        help='append the input to this capture file')
+    PARSER.add_argument('--open', metavar='FILE',
+                        help='load this capture before reading the input')
+    PARSER.add_argument('--seek', type=float, default=0,
+                        help='seconds into the capture to load from, '
+                        'negative counts back from its end')
+    PARSER.add_argument('--replay-compression', choices=sorted(CODECS),
+                        help='compress the replay history older than the '
+                        'in-memory ring')
+    PARSER.add_argument('--replay-memory', type=float, default=256,
+                        help='MiB of compressed replay history to keep in '
+                        'memory before spilling to disk')
+    PARSER.add_argument('--ingest-queue', type=int, default=64,
+                        help='tables read ahead of the report before the '
+                        'input backs up')
+    PARSER.add_argument('--drop', action='store_true',
+                        help='drop and count the rows read while the ingest '
+                        'queue is full instead of backing up the input')
+    ARGS, QT_ARGS = PARSER.parse_known_args()
+    if ARGS.stats:
+        STATS.enable(True, open(ARGS.stats, 'a', encoding='utf-8'))
+    HISTORY_BUDGET = ARGS.history_budget
+    if HISTORY_BUDGET is not None:
+        HISTORY_BUDGET = int(HISTORY_BUDGET * 2**20)
+    HISTORY_POLICY = HistoryPolicy(
+        ARGS.history_limit, ARGS.history_stride, ARGS.history_keep_first,
+        not ARGS.history_drop_last, HISTORY_BUDGET)
+
+    APPLICATION = QApplication(sys.argv[:1] + QT_ARGS)
+    APPLICATION.TABULATOR = Tabulator(history=ChunkHistory(
+        compression=ARGS.replay_compression,
+        compressed_limit=int(ARGS.replay_memory * 2**20)))
+    APPLICATION.TABULATOR.set_workers(ARGS.workers)
+    if ARGS.open:
+        CAPTURE = CaptureFile(ARGS.open)
+        APPLICATION.TABULATOR.open_capture(
+            CAPTURE.reader(CAPTURE.seek(ARGS.seek)))
+    APPLICATION.TABULATOR.set_inputs(ARGS.source)
+    APPLICATION.TABULATOR.set_capture(ARGS.capture)
     APPLICATION.AGGREGATOR = Aggregator(APPLICATION.TABULATOR)
-    APPLICATION.REPORT = Report(APPLICATION.AGGREGATOR)
+    APPLICATION.REPORT = Report(
+        APPLICATION.AGGREGATOR, HISTORY_POLICY,
+        EvictionPolicy(ARGS.max_rows, ARGS.evict, ARGS.ttl))
+    APPLICATION.INGEST = Ingest(APPLICATION.TABULATOR, APPLICATION.AGGREGATOR,
+                                ARGS.ingest_queue, ARGS.drop)
+    APPLICATION.AGGREGATOR.ingest = APPLICATION.INGEST
+    APPLICATION.INGEST.start()
     GUI = MainWindow(APPLICATION)
 
     GUI.show()
-    sys.exit(APPLICATION.exec_())
+    STATUS = APPLICATION.exec_()
+    APPLICATION.TABULATOR.set_capture(None)
+    sys.exit(STATUS)
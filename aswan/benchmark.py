@@ -0,0 +1,863 @@
+#!/usr/bin/env python3
+""" Benchmarks for the aswan pipeline. Run with the name of a benchmark, for
+example: python3 benchmark.py replay
+
+The suite times every stage and the whole pipeline and can be compared
+between commits:
+python3 benchmark.py suite --records 20000 --json before.json
+python3 benchmark.py suite --records 20000 --baseline before.json """
+import argparse
+import bisect
+import concurrent.futures
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from aggregator import KLL, Aggregator, HyperLogLog
+from history import ChunkHistory
+from parallel import ParallelParser
+from store import EvictionPolicy, HistoryPolicy, StoreModel
+from tabulator import (DeclarativeConfig, SyslogConfig, Tabulator,
+                       TcpDumpConfig, WeblogConfig, load_configs)
+import utils
+
+
+def key_chooser(rand, keys, skew, seed):
+    """ Return a function choosing one of keys, uniformly from rand when skew
+    is 0 and otherwise from a Zipf distribution with exponent skew drawn
+    from its own generator, so that rand sees the same calls either way. """
+    if not skew:
+        return lambda: rand.randrange(keys)
+    skewed = random.Random(seed + 1)
+    population = range(keys)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** skew
+                                            for rank in population))
+    return lambda: skewed.choices(population, cum_weights=cum_weights)[0]
+
+
+def weblog_lines(count, keys=1000, seed=1, skew=0):
+    """ Return count synthetic Apache combined log lines requesting one of
+    keys distinct urls. """
+    rand = random.Random(seed)
+    key = key_chooser(rand, keys, skew, seed)
+    return [f'10.0.{rand.randrange(256)}.{rand.randrange(256)} - - '
+            f'[10/Oct/2000:13:55:{i % 60:02d} -0700] '
+            f'"GET /page/{key()}.html HTTP/1.1" '
+            f'{rand.choice((200, 200, 200, 304, 404, 500))} '
+            f'{rand.randrange(100, 50000)} "-" "Mozilla/5.0 (X11; Linux x86_64)"'
+            for i in range(count)]
+
+
+def tcpdump_lines(count, keys=1000, seed=1, skew=0):
+    """ Return count synthetic tcpdump lines from one of keys distinct source
+    addresses with an occasional ARP line. """
+    rand = random.Random(seed)
+    key = key_chooser(rand, keys, skew, seed)
+    lines = []
+    for i in range(count):
+        time_stamp = f'13:55:{i % 60:02d}.{rand.randrange(10**6):06d}'
+        source = key()
+        if rand.random() < 0.05:
+            lines.append(f'{time_stamp} ARP, Request who-has 10.0.0.1 tell '
+                         f'10.1.{source // 256}.{source % 256}, length 28')
+        else:
+            lines.append(f'{time_stamp} IP 10.1.{source // 256}.{source % 256}'
+                         f'.{rand.randrange(1024, 65536)} > 93.184.216.34.443: '
+                         f'Flags [P.], seq 1:{rand.randrange(1500)}, ack 1, '
+                         f'win 502, length {rand.randrange(1500)}')
+    return lines
+
+
+def syslog_lines(count, keys=50, seed=1, skew=0):
+    """ Return count synthetic syslog lines from one of keys systems. """
+    rand = random.Random(seed)
+    key = key_chooser(rand, keys, skew, seed)
+    return [f'Oct {1 + i % 28:2d} 13:{i % 60:02d}:{rand.randrange(60):02d} '
+            f'host{rand.randrange(4)} daemon{key()}'
+            f'[{rand.randrange(32768)}]: session opened for user root: '
+            f'uid {rand.randrange(1000)}'
+            for i in range(count)]
+
+
+GENERATORS = {'TcpDump': tcpdump_lines,
+              'WebLog': weblog_lines,
+              'SysLog': syslog_lines}
+
+
+def chunked(byte_string, chunk_size):
+    """ Split byte_string into chunks as they might arrive from a pipe. """
+    return [byte_string[i:i + chunk_size]
+            for i in range(0, len(byte_string), chunk_size)]
+
+
+def bench_replay(args):
+    """ Time a full replay of histories of increasing length. Replay should be
+    linear so the time per chunk stays flat as the history grows. """
+    chunk = b'a\tb\tc\n' * 4
+    print(f'{"chunks":>10} {"seconds":>10} {"ns/chunk":>10}')
+    for chunks in [args.chunks // 4, args.chunks // 2, args.chunks]:
+        tabulator = Tabulator()
+        tabulator.config.read_available_bytes = lambda: b''
+        for _ in range(chunks):
+            tabulator.bytes_history.append(chunk)
+
+        start = time.perf_counter()
+        tabulator.replay()
+        while tabulator.read_or_replay_records():
+            pass
+        elapsed = time.perf_counter() - start
+        print(f'{chunks:>10} {elapsed:>10.3f} {1e9 * elapsed / chunks:>10.0f}')
+        tabulator.bytes_history.clear()
+
+
+def bench_config_change(args):
+    """ Time the replay after a config change through the tabulator,
+    aggregator and a Qt free model, a chunk at a time as before, in bulk
+    batches re-splitting the records and in bulk batches reusing the cached
+    records. """
+    data = ('\n'.join(weblog_lines(args.records)) + '\n').encode()
+    chunks = chunked(data, args.chunk_size)
+    tabulator = Tabulator()
+    tabulator.set_config(WeblogConfig())
+    feed = iter(chunks)
+    tabulator.config.read_available_bytes = lambda: next(feed, b'')
+    for _ in chunks:
+        tabulator.update()
+
+    def replay(batch, cached):
+        tabulator.replay_batch = batch
+        tabulator.set_config(WeblogConfig())
+        tabulator.config.read_available_bytes = lambda: b''
+        if not cached:
+            tabulator.record_cache.clear()
+        model = StoreModel(Aggregator(tabulator), HistoryPolicy(limit=0))
+        tables = 0
+        while tabulator.pending:
+            model.update()
+            tables += 1
+        return tables
+    for name, batch, cached in (('chunk', 1, False),
+                                ('bulk', Tabulator.REPLAY_BATCH, False),
+                                ('bulk cached', Tabulator.REPLAY_BATCH, True)):
+        tables = replay(batch, cached)
+        elapsed = best_of(lambda: replay(batch, cached))
+        print(f'{name:>12}: {tables:>6} tables {elapsed:>7.3f}s '
+              f'{args.records / elapsed:>10.0f} records/s')
+
+
+def bench_sources(args):
+    """ Time the tabulator reading the same records spread over increasing
+    numbers of FIFOs multiplexed by one selector, without a thread per
+    source. """
+    lines = weblog_lines(args.records)
+    blocks = [('\n'.join(lines[i:i + 100]) + '\n').encode()
+              for i in range(0, len(lines), 100)]
+    with tempfile.TemporaryDirectory() as directory:
+        for count in (1, 8, 64):
+            paths = [os.path.join(directory, f'fifo{i}') for i in range(count)]
+            for path in paths:
+                os.mkfifo(path)
+            tabulator = Tabulator(keep_history=False)
+            tabulator.set_inputs(paths)
+            writers = [os.open(path, os.O_WRONLY) for path in paths]
+            rows = 0
+            start = time.perf_counter()
+            for i in range(0, len(blocks), count):
+                for writer, block in zip(writers, blocks[i:i + count]):
+                    os.write(writer, block)
+                rows += len(tabulator.update()['rows'])
+            while rows < args.records:
+                rows += len(tabulator.update()['rows'])
+            elapsed = time.perf_counter() - start
+            for writer in writers:
+                os.close(writer)
+            tabulator.set_inputs(None)
+            for path in paths:
+                os.remove(path)
+            print(f'{count:>3} sources: {rows:>8} rows '
+                  f'{rows / elapsed:>10.0f} records/s')
+
+
+def best_of(function, repeat=3):
+    """ Return the fastest of repeat timings of function in seconds. """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def split_throughput(name, chunks, size):
+    """ Print the MB/s of both record splitters over chunks. """
+    megabytes = size / 2**20
+    chunk_size = len(chunks[0])
+
+    def old():
+        partial = b''
+        for chunk in chunks:
+            _, partial = utils.bytes_to_unicode_records(
+                partial + chunk, '\n', 'utf-8')
+
+    def new():
+        buffer = bytearray()
+        for chunk in chunks:
+            utils.split_records(buffer, chunk, '\n', 'utf-8')
+
+    print(f'{name} records, chunk {chunk_size:>8}: bytes_to_unicode_records '
+          f'{megabytes / best_of(old):8.1f} MB/s, split_records '
+          f'{megabytes / best_of(new):8.1f} MB/s')
+
+
+def bench_split(args):
+    """ Compare record splitting throughput in MB/s of the streaming splitter
+    against decoding, splitting and re-encoding each buffer. Long records
+    spanning many chunks show the cost of re-decoding the partial record. """
+    lines = weblog_lines(args.records)
+    long_lines = [' '.join(lines[i:i + 1000]) for i in range(0, len(lines), 1000)]
+    for name, records in [('short', lines), ('long', long_lines)]:
+        data = ('\n'.join(records) + '\n').encode('utf-8')
+        for chunk_size in [4096, 65536, 1048576]:
+            split_throughput(name, chunked(data, chunk_size), len(data))
+
+
+def naive_read_available_bytes(file, chunk_size=4096):
+    """ The original reader: 4096 byte reads appended to a bytes object. """
+    buffer = b''
+    while True:
+        read_list, _, _ = select.select([file], [], [], 0)
+        if file not in read_list:
+            break
+        chunk = os.read(file.fileno(), chunk_size)
+        if chunk == b'':
+            break
+        buffer += chunk
+    return buffer
+
+
+def drain_pipe(data, make_read):
+    """ Write data into a pipe from a thread and return the MB/s and number of
+    reads taken to drain it with the read function returned by make_read. """
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'rb', buffering=0)
+    read = make_read(reader)
+
+    def write():
+        for offset in range(0, len(data), 2**20):
+            os.write(write_fd, data[offset:offset + 2**20])
+        os.close(write_fd)
+
+    writer = threading.Thread(target=write)
+    start = time.perf_counter()
+    writer.start()
+    received = reads = 0
+    while received < len(data):
+        received += len(read())
+        reads += 1
+    elapsed = time.perf_counter() - start
+    writer.join()
+    reader.close()
+    return len(data) / 2**20 / elapsed, reads
+
+
+def bench_read(args):
+    """ Drain a pipe with the original reader and ByteReader budgets. The
+    original reader is quadratic in the size of a burst so keep it modest. """
+    data = ('\n'.join(weblog_lines(args.records)) + '\n').encode('utf-8')
+    data = data[:args.megabytes * 2**20]
+    print(f'{len(data) / 2**20:.1f} MB through a pipe')
+    mb_per_second, reads = drain_pipe(
+        data, lambda file: lambda: naive_read_available_bytes(file))
+    print(f'naive 4096 byte reads: {mb_per_second:8.1f} MB/s {reads:>8} calls')
+    for max_bytes in [2**20, 4 * 2**20, 16 * 2**20]:
+        mb_per_second, reads = drain_pipe(
+            data, lambda file: utils.ByteReader(file, max_bytes).read)
+        print(f'ByteReader budget {max_bytes // 2**20:>2} MB: '
+              f'{mb_per_second:8.1f} MB/s {reads:>8} calls')
+
+
+def bench_parse(args):
+    """ Parse a synthetic Apache log in process and with 1, 2, 4 and 8 worker
+    processes. Pool start up is excluded. """
+    records = weblog_lines(args.records)
+    print(f'{os.cpu_count()} cpus')
+    config = WeblogConfig()
+    expected = [tuple(config.parse_fields(record)) for record in records]
+    elapsed = best_of(lambda: [config.parse_fields(r) for r in records])
+    print(f'in process: {len(records) / elapsed:>10.0f} records/s')
+    for workers in [1, 2, 4, 8]:
+        parser = ParallelParser(config, workers)
+        assert parser.parse(records[:workers]) == expected[:workers]
+        elapsed = best_of(lambda: parser.parse(records))
+        assert parser.parse(records) == expected
+        parser.close()
+        print(f'{workers} workers: {len(records) / elapsed:>10.0f} records/s')
+
+
+def bench_configs(args):
+    """ Compare each canned closure config with the declarative config that
+    replaces it, checking both produce the same rows. The two are timed in
+    alternate rounds so that neither gains from running later. """
+    canned = {'TcpDump': TcpDumpConfig, 'WebLog': WeblogConfig,
+              'SysLog': SyslogConfig}
+    for name, factory in load_configs().items():
+        records = GENERATORS[name](args.records)
+        closure = canned[name]().parse_fields
+        compiled = factory().parse_fields
+        assert [closure(r) for r in records] == [compiled(r) for r in records]
+        old = new = math.inf
+        for _ in range(5):
+            old = min(old, best_of(lambda: [closure(r) for r in records], 1))
+            new = min(new, best_of(lambda: [compiled(r) for r in records], 1))
+        print(f'{name:>8}: closure {len(records) / old:>10.0f} records/s, '
+              f'declarative {len(records) / new:>10.0f} records/s')
+
+
+def bench_aggregate(args):
+    """ Group synthetic Apache log rows by key with and without the
+    aggregations of the WebLog config, then by composite and computed
+    keys. """
+    config = load_configs()['WebLog']()
+    rows = [config.parse_fields(record) for record in weblog_lines(args.records)]
+    for aggregate in ([], config.aggregate):
+        metadata = {'key': config.key, 'numeric': config.numeric,
+                    'aggregate': aggregate}
+        aggregator = Aggregator(None)
+        elapsed = best_of(lambda: aggregator.prepare(
+            {'metadata': metadata, 'rows': rows, 'generation': 0}))
+        names = [spec['function'] for spec in aggregate] or ['none']
+        print(f'{" ".join(names):>20}: {len(rows) / elapsed:>10.0f} rows/s')
+    keys = {'url': 5, 'address url': [0, 5],
+            'url path': {'column': 5, 'path': True},
+            'subnet minute': [{'column': 0, 'ip_prefix': 24},
+                              {'column': 3, 'slice': [0, 18]}]}
+    for name, key in keys.items():
+        aggregator = Aggregator(None)
+        metadata = {'key': key, 'numeric': config.numeric}
+        table = aggregator.prepare({'metadata': metadata, 'rows': rows,
+                                    'generation': 0})
+        elapsed = best_of(lambda: aggregator.prepare(
+            {'metadata': metadata, 'rows': rows, 'generation': 0}))
+        print(f'{name:>20}: {len(rows) / elapsed:>10.0f} rows/s '
+              f'{len(table["groups"]):>8} keys')
+
+
+def bench_eviction(args):
+    """ Apply tcpdump rows keyed by source address to a Qt free model in
+    batches, without a row cap and capped at a tenth of the keys with each
+    eviction order, reporting the rows kept and the time spent evicting. """
+    keys = args.keys or args.records // 2
+    config = TcpDumpConfig()
+    rows = [config.parse_fields(record)
+            for record in tcpdump_lines(args.records, keys, skew=args.skew)]
+    batches = [rows[i:i + 1000] for i in range(0, len(rows), 1000)]
+    policies = [('none', None)] + [
+        (order, EvictionPolicy(keys // 10, order)) for order in ('lru', 'lfu')]
+    for name, policy in policies:
+        aggregator = Aggregator(None)
+        model = StoreModel(None, HistoryPolicy(limit=0), policy)
+        store = model.store
+        evicting = 0.0
+        evict = store.remove_rows
+
+        def remove_rows(rows):
+            nonlocal evicting
+            start = time.perf_counter()
+            evict(rows)
+            evicting += time.perf_counter() - start
+        store.remove_rows = remove_rows
+        start = time.perf_counter()
+        for batch in batches:
+            table = aggregator.prepare({'metadata': {'key': config.key},
+                                        'rows': batch, 'generation': 0})
+            aggregator.apply(model, table)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>5}: {len(rows) / elapsed:>9.0f} rows/s '
+              f'{store.rows:>7} rows kept, removing rows took '
+              f'{evicting:.3f}s')
+
+
+def bench_sketches(args):
+    """ Accuracy against memory of the distinct count and quantile sketches,
+    each also checked after merging sketches of four parts of the stream. """
+    rand = random.Random(1)
+    for distinct in (100, 10000, args.records):
+        values = [f'10.{rand.randrange(256)}.{i // 256 % 256}.{i % 256}'
+                  for i in range(distinct)]
+        for precision in (6, 8, 10, 12, 14):
+            sketch = HyperLogLog(precision)
+            parts = [HyperLogLog(precision) for _ in range(4)]
+            for i, value in enumerate(values):
+                sketch.add(value)
+                parts[i % 4].add(value)
+            for part in parts[1:]:
+                parts[0].merge(part)
+            error = sketch.count() / distinct - 1
+            merged_error = parts[0].count() / distinct - 1
+            print(f'distinct {distinct:>8} precision {precision:>2}: '
+                  f'{sketch.nbytes():>6} bytes, error {error:+7.2%}, '
+                  f'merged {merged_error:+7.2%}')
+    values = [rand.lognormvariate(8, 1.5) for _ in range(args.records)]
+    exact = sorted(values)
+    fractions = (0.5, 0.95, 0.99)
+    for k in (50, 100, 200, 400):
+        sketch = KLL(k)
+        parts = [KLL(k) for _ in range(4)]
+        for i, value in enumerate(values):
+            sketch.add(value)
+            parts[i % 4].add(value)
+        for part in parts[1:]:
+            parts[0].merge(part)
+        for name, estimate in (('single', sketch), ('merged', parts[0])):
+            errors = [bisect.bisect_left(exact, quantile) / len(exact) - fraction
+                      for fraction, quantile in zip(
+                          fractions, estimate.quantiles(fractions))]
+            print(f'quantiles k {k:>3} {name}: {estimate.nbytes():>6} bytes, '
+                  f'rank error ' + ' '.join(f'{error:+.4f}' for error in errors))
+
+
+def bench_pipeline(args):
+    """ Run each config's synthetic input through the tabulator, aggregator
+    and a Qt free model in 64 KiB chunks as a headless run would. """
+    for name, factory in load_configs().items():
+        data = ('\n'.join(GENERATORS[name](args.records)) + '\n').encode()
+        chunks = chunked(data, 65536)
+
+        def run():
+            tabulator = Tabulator(keep_history=False)
+            tabulator.set_config(factory())
+            feed = iter(chunks)
+            tabulator.config.read_available_bytes = lambda: next(feed, b'')
+            model = StoreModel(Aggregator(tabulator), HistoryPolicy(limit=0))
+            for _ in chunks:
+                model.update()
+            return model
+        elapsed = best_of(run)
+        print(f'{name:>8}: {args.records / elapsed:>10.0f} records/s')
+
+
+def bench_filters(args):
+    """ Run the WebLog config through the tabulator, aggregator and a Qt
+    free model unfiltered and with filters of decreasing selectivity, field
+    conditions being tested after parsing and byte filters before decoding. """
+    spec = load_configs()['WebLog']().spec
+    data = ('\n'.join(weblog_lines(args.records, args.keys or 1000)) +
+            '\n').encode()
+    chunks = chunked(data, args.chunk_size)
+    filters = (('none', {}),
+               ('where status 5xx', {'where': [{'column': 7,
+                                                'startswith': '5'}]}),
+               ('contains status 500', {'contains': '" 500 '}),
+               ('regex status 5xx', {'regex': r'" 5\d\d '}),
+               ('where url', {'where': [{'column': 5,
+                                         'equals': '/page/7.html'}]}),
+               ('contains url', {'contains': ' /page/7.html '}),
+               ('contains url where 5xx',
+                {'contains': ' /page/7.html ',
+                 'where': [{'column': 7, 'startswith': '5'}]}))
+    for name, record_filter in filters:
+        factory = DeclarativeConfig(dict(spec, filter=record_filter)).factory
+
+        def fed_tabulator():
+            tabulator = Tabulator(keep_history=False)
+            tabulator.set_config(factory())
+            feed = iter(chunks)
+            tabulator.config.read_available_bytes = lambda: next(feed, b'')
+            return tabulator
+
+        def run():
+            model = StoreModel(Aggregator(fed_tabulator()),
+                               HistoryPolicy(limit=0))
+            for _ in chunks:
+                model.update()
+        counter = fed_tabulator()
+        rows = sum(len(counter.update()['rows']) for _ in chunks)
+        elapsed = best_of(run)
+        print(f'{name:>24}: {args.records / elapsed:>10.0f} records/s '
+              f'{rows:>8} rows kept')
+
+
+def bench_history(args):
+    """ Trade memory for CPU in the replay history: append weblog chunks to a
+    raw and to compressed histories, reporting the bytes retained, the time
+    the appending thread spent per chunk and at worst, the CPU the compressor
+    thread used and the replay rate through the tabulator. """
+    data = ('\n'.join(weblog_lines(args.records, args.keys or 1000)) +
+            '\n').encode()
+    chunks = chunked(data, args.chunk_size)
+    variants = [('raw', None, None, 2**20)]
+    variants += [(f'zlib {level} {block // 1024}K', 'zlib', level, block)
+                 for level, block in ((1, 2**20), (6, 2**18), (6, 2**20),
+                                      (6, 2**22), (9, 2**20))]
+    variants += [(f'lzma {level} 1024K', 'lzma', level, 2**20)
+                 for level in (0, 6)]
+    print(f'{len(data) / 2**20:.1f} MiB in {len(chunks)} chunks')
+    print(f'{"history":>14} {"MiB":>7} {"ratio":>6} {"us/chunk":>9} '
+          f'{"max ms":>7} {"cpu s":>6} {"replay MB/s":>12} {"records/s":>10}')
+    for name, compression, level, block_size in variants:
+        history = ChunkHistory(
+            memory_limit=len(data) if compression is None else 2**20,
+            disk_limit=0, compression=compression, level=level,
+            block_size=block_size, compressed_limit=len(data))
+        worst = 0
+        cpu = time.process_time()
+        thread_cpu = time.thread_time()
+        start = time.perf_counter()
+        for chunk in chunks:
+            before = time.perf_counter()
+            history.append(chunk)
+            worst = max(worst, time.perf_counter() - before)
+        appending = time.perf_counter() - start
+        history.flush()
+        cpu = (time.process_time() - cpu) - (time.thread_time() - thread_cpu)
+        assert len(history) == len(chunks)
+
+        tabulator = Tabulator(history=history)
+        tabulator.set_config(WeblogConfig())
+        tabulator.config.read_available_bytes = lambda: b''
+        tabulator.record_cache.clear()
+
+        def replay():
+            tabulator.replay()
+            while tabulator.read_or_replay_records():
+                pass
+        replaying = best_of(replay)
+        print(f'{name:>14} {history.nbytes / 2**20:>7.1f} '
+              f'{len(data) / history.nbytes:>6.1f} '
+              f'{1e6 * appending / len(chunks):>9.1f} {1e3 * worst:>7.2f} '
+              f'{cpu:>6.2f} {len(data) / 1e6 / replaying:>12.1f} '
+              f'{args.records / replaying:>10.0f}')
+
+
+def qt_application():
+    """ Create the Qt application used by report benchmarks, offscreen unless
+    a platform was chosen. """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
+def bench_report(args):
+    """ Apply synthetic weblog updates to a Report, reporting updates/s and
+    the growth of the peak resident set size. """
+    application = qt_application()
+    from report import Report
+    config = load_configs()['WebLog']()
+    rows = [config.parse_fields(record) for record in weblog_lines(args.records)]
+    report = Report(None)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for offset in range(0, len(rows), 1000):
+        batch = rows[offset:offset + 1000]
+        report.apply([(row[config.key], [row]) for row in batch],
+                     config.numeric)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{len(rows) / elapsed:>10.0f} updates/s, {report.rowCount()} rows, '
+          f'peak RSS grew {(peak - base) / 1024:.1f} MB')
+    application.quit()
+
+
+def bench_proxy(args):
+    """ Time updates of a large report sorted by a column whose values change,
+    through the stock proxy sorted again after each update and through the
+    incremental proxy, with and without a filter. """
+    application = qt_application()
+    from PyQt5.QtCore import QSortFilterProxyModel, Qt
+    from PyQt5.QtWidgets import QTreeView
+    from proxy import SortFilterProxy
+    from report import Report
+    config = load_configs()['WebLog']()
+    keys = args.keys or 100000
+    rows = [config.parse_fields(record)
+            for record in weblog_lines(args.records, keys)]
+    updates = [config.parse_fields(record)
+               for record in weblog_lines(100 * 1000, keys, seed=2)]
+    for name, filtered in (('stock', False), ('incremental', False),
+                           ('stock', True), ('incremental', True)):
+        report = Report(None)
+        report.apply([(row[config.key], [row]) for row in rows],
+                     config.numeric)
+        if name == 'stock':
+            proxy = QSortFilterProxyModel()
+            proxy.setSortRole(Qt.UserRole)
+            proxy.setDynamicSortFilter(False)
+            proxy.setFilterKeyColumn(7)
+            if filtered:
+                proxy.setFilterRegularExpression('^5')
+            refresh = lambda: proxy.sort(8, Qt.DescendingOrder)
+        else:
+            proxy = SortFilterProxy()
+            if filtered:
+                proxy.set_filter('^5', 7)
+            refresh = proxy.refresh
+        proxy.setSourceModel(report)
+        view = QTreeView()
+        view.setModel(proxy)
+        view.setUniformRowHeights(True)
+        view.resize(1200, 800)
+        view.show()
+        proxy.sort(8, Qt.DescendingOrder)
+        application.processEvents()
+        frame_seconds = []
+        for offset in range(0, len(updates), 1000):
+            batch = updates[offset:offset + 1000]
+            start = time.perf_counter()
+            report.apply([(row[config.key], [row]) for row in batch],
+                         config.numeric)
+            refresh()
+            application.processEvents()
+            frame_seconds.append(time.perf_counter() - start)
+        label = f'{name} filtered' if filtered else name
+        print(f'{label:>20}: {report.rowCount():>7} rows '
+              f'{proxy.rowCount():>7} shown '
+              f'{1000 * sum(frame_seconds) / len(frame_seconds):>8.2f} ms mean '
+              f'{1000 * percentile(frame_seconds, 0.99):>8.2f} ms p99')
+        view.close()
+    application.quit()
+
+
+class IdleAggregator():
+    """ An aggregator without new data so a report only animates. """
+
+    def update(self, report):
+        """ Nothing arrived. """
+        return {'metadata': {}, 'rows': []}
+
+    def clear(self):
+        """ There is no aggregation state. """
+
+
+def bench_animation(args):
+    """ Animate a report after one large update, reporting the mean frame
+    time over the lifetime of the animation. """
+    application = qt_application()
+    from report import RowAnimator, Report
+    config = load_configs()['WebLog']()
+    rows = [config.parse_fields(record) for record in weblog_lines(args.records)]
+    report = Report(IdleAggregator())
+    report.apply([(row[config.key], [row]) for row in rows], config.numeric)
+    frames = RowAnimator.LIFETIME + 1
+    start = time.perf_counter()
+    for _ in range(frames):
+        report.update()
+    elapsed = time.perf_counter() - start
+    print(f'{report.rowCount() * report.columnCount()} cells, '
+          f'{elapsed / frames * 1000:.3f} ms/frame')
+    application.quit()
+
+
+class FeedAggregator():
+    """ Applies one prepared table per frame, so a report can be timed
+    without the stages before it. """
+
+    def __init__(self, tables):
+        super().__init__()
+        self.tables = iter(tables)
+        self.aggregator = Aggregator(None)
+
+    def update(self, report):
+        """ Apply the next table. """
+        table = next(self.tables, None) or {'metadata': {}, 'rows': [],
+                                            'groups': []}
+        self.aggregator.apply(report, table)
+        return table
+
+    def clear(self):
+        """ The tables were aggregated beforehand. """
+
+
+def percentile(values, fraction):
+    """ The value at fraction of the sorted values. """
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def suite_chunks(options):
+    """ The synthetic input of a suite run split into chunks. """
+    generator = GENERATORS[options['config']]
+    keyword_arguments = {'skew': options['skew']}
+    if options['keys']:
+        keyword_arguments['keys'] = options['keys']
+    lines = generator(options['records'], **keyword_arguments)
+    return chunked(('\n'.join(lines) + '\n').encode(), options['chunk_size'])
+
+
+def feed_tabulator(tabulator, chunks):
+    """ Feed chunks to a tabulator as if they were read from stdin. """
+    tabulator.set_config(load_configs()[tabulator.config_name]())
+    feed = iter(chunks)
+    tabulator.config.read_available_bytes = lambda: next(feed, b'')
+
+
+def report_view(report):
+    """ Show a report sorted through a proxy as the main window does. """
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtWidgets import QTreeView
+    from proxy import SortFilterProxy
+    proxy = SortFilterProxy()
+    proxy.setSourceModel(report)
+    view = QTreeView()
+    view.setModel(proxy)
+    view.setUniformRowHeights(True)
+    view.setSortingEnabled(True)
+    view.sortByColumn(0, Qt.DescendingOrder)
+    view.resize(1200, 800)
+    view.show()
+    return proxy, view
+
+
+def run_frames(application, report, proxy, frames):
+    """ Update and repaint a report for frames returning each frame's
+    seconds. """
+    frame_seconds = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        report.update()
+        proxy.refresh()
+        application.processEvents()
+        frame_seconds.append(time.perf_counter() - start)
+    return frame_seconds
+
+
+def run_stage(stage, options):
+    """ Time one stage of the pipeline, the stages before it are run untimed
+    to produce its input. Run in a fresh process so that its peak RSS is its
+    own. """
+    chunks = suite_chunks(options)
+    tabulator = Tabulator(keep_history=False)
+    tabulator.config_name = options['config']
+    feed_tabulator(tabulator, chunks)
+    frame_seconds = None
+    start = time.perf_counter()
+    if stage == 'end_to_end':
+        application = qt_application()
+        from report import Report
+        report = Report(Aggregator(tabulator))
+        proxy, view = report_view(report)
+        start = time.perf_counter()
+        frame_seconds = run_frames(application, report, proxy, len(chunks))
+    else:
+        tables = [tabulator.update() for _ in chunks]
+    if stage in ('aggregate', 'model', 'report'):
+        aggregator = Aggregator(None)
+        start = time.perf_counter()
+        tables = [aggregator.prepare(table) for table in tables]
+    if stage == 'model':
+        model = StoreModel(None)
+        start = time.perf_counter()
+        for table in tables:
+            aggregator.apply(model, table)
+    elif stage == 'report':
+        application = qt_application()
+        from report import Report
+        report = Report(FeedAggregator(tables))
+        proxy, view = report_view(report)
+        start = time.perf_counter()
+        frame_seconds = run_frames(application, report, proxy, len(tables))
+    elapsed = time.perf_counter() - start
+    result = {'seconds': elapsed,
+              'records_per_second': options['records'] / elapsed,
+              'peak_rss_mb': resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if frame_seconds:
+        result['frames'] = len(frame_seconds)
+        result['p99_frame_ms'] = percentile(frame_seconds, 0.99) * 1000
+    return result
+
+
+def git_commit():
+    """ The commit of the working tree being measured, if known. """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    """ Measure records/s, p99 frame time and peak RSS of each stage and of
+    the whole pipeline with an offscreen Qt platform, for each config's
+    synthetic input. Each stage runs in its own process. Results are written
+    as JSON with --json and compared with an earlier run with --baseline. """
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+    results = {}
+    for config in args.configs or list(GENERATORS):
+        options = {'config': config, 'records': args.records,
+                   'keys': args.keys, 'skew': args.skew,
+                   'chunk_size': args.chunk_size}
+        results[config] = {}
+        for stage in ('tabulate', 'aggregate', 'model', 'report',
+                      'end_to_end'):
+            with concurrent.futures.ProcessPoolExecutor(
+                    1, multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(run_stage, stage, options).result()
+            results[config][stage] = result
+            line = (f'{config:>8} {stage:>10}: '
+                    f'{result["records_per_second"]:>9.0f} records/s '
+                    f'{result["peak_rss_mb"]:>7.1f} MB peak')
+            if 'p99_frame_ms' in result:
+                line += f' {result["p99_frame_ms"]:>7.1f} ms p99 frame'
+            old = baseline.get(config, {}).get(stage)
+            if old:
+                change = (result['records_per_second']
+                          / old['records_per_second'] - 1)
+                line += f' ({change:+.1%} records/s)'
+            print(line, flush=True)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'commit': git_commit(), 'time': time.time(),
+                       'python': sys.version, 'cpus': os.cpu_count(),
+                       'arguments': vars(args), 'results': results},
+                      file, indent=2)
+
+
+BENCHMARKS = {'replay': bench_replay,
+              'config_change': bench_config_change,
+              'sources': bench_sources,
+              'split': bench_split,
+              'read': bench_read,
+              'parse': bench_parse,
+              'configs': bench_configs,
+              'aggregate': bench_aggregate,
+              'eviction': bench_eviction,
+              'sketches': bench_sketches,
+              'pipeline': bench_pipeline,
+              'filters': bench_filters,
+              'history': bench_history,
+              'report': bench_report,
+              'proxy': bench_proxy,
+              'animation': bench_animation,
+              'suite': bench_suite}
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    PARSER.add_argument('benchmark', choices=list(BENCHMARKS.keys()))
+    PARSER.add_argument('--chunks', type=int, default=1000000)
+    PARSER.add_argument('--records', type=int, default=200000)
+    PARSER.add_argument('--megabytes', type=int, default=8)
+    PARSER.add_argument('--keys', type=int, default=None,
+                        help='distinct keys in the synthetic input')
+    PARSER.add_argument('--skew', type=float, default=0,
+                        help='Zipf exponent of the key choice, 0 is uniform')
+    PARSER.add_argument('--chunk-size', type=int, default=65536)
+    PARSER.add_argument('--configs', nargs='*', choices=list(GENERATORS))
+    PARSER.add_argument('--json', help='write suite results to this file')
+    PARSER.add_argument('--baseline', help='compare with these results')
+    ARGS = PARSER.parse_args()
+    BENCHMARKS[ARGS.benchmark](ARGS)
@@ -0,0 +1,274 @@
+""" Persistent capture of the raw input for reloading a session later.
+
+A capture is an append-only file of length prefixed chunks, each with the
+time it was read, and an index file beside it holding the time and offset of
+every chunk. The top bit of a chunk's length is set when it holds records
+framed with the names of several inputs. Captures are written by a
+background thread while streaming and read back through a memory map,
+seeking by time through the index.
+"""
+import bisect
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from array import array
+
+MAGIC = b'ASWANCP1'
+CHUNK_HEADER = struct.Struct('<dI')
+FRAMED = 1 << 31
+INDEX_ENTRY = struct.Struct('<dQ')
+
+
+def index_path(path):
+    """ The index file of the capture at path. """
+    return path + '.idx'
+
+
+class CaptureFile():
+    """ A capture opened for reading. Index entries that point past the end
+    of the data are ignored and chunks written after the last index entry
+    are found by walking their headers, so a capture cut short by a crash
+    still opens. """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.times = array('d')
+        self.offsets = array('Q')
+        self.framed = bytearray()
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = None
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        if self.map is None or self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not an aswan capture')
+        self.repaired = self.load_index()
+
+    def load_index(self):
+        """ Load the index and index any chunks missing from it, returning
+        True when the index file did not match the data. """
+        try:
+            with open(index_path(self.path), 'rb') as file:
+                entries = file.read()
+        except FileNotFoundError:
+            entries = b''
+        complete = len(entries) - len(entries) % INDEX_ENTRY.size
+        repaired = complete != len(entries)
+        end = len(MAGIC)
+        for timestamp, offset in INDEX_ENTRY.iter_unpack(entries[:complete]):
+            chunk_end = self.chunk_end(offset)
+            if offset != end or chunk_end is None:
+                repaired = True
+                break
+            self.times.append(timestamp)
+            self.offsets.append(offset)
+            self.framed.append(self.chunk_framed(offset))
+            end = chunk_end
+        while True:
+            chunk_end = self.chunk_end(end)
+            if chunk_end is None:
+                break
+            self.times.append(CHUNK_HEADER.unpack_from(self.map, end)[0])
+            self.offsets.append(end)
+            self.framed.append(self.chunk_framed(end))
+            end = chunk_end
+            repaired = True
+        self.end = end
+        return repaired
+
+    def chunk_end(self, offset):
+        """ The end of the chunk at offset or None if it is incomplete. """
+        if offset + CHUNK_HEADER.size > self.size:
+            return None
+        end = offset + CHUNK_HEADER.size + (CHUNK_HEADER.unpack_from(
+            self.map, offset)[1] & ~FRAMED)
+        return end if end <= self.size else None
+
+    def chunk_framed(self, offset):
+        """ True if the chunk at offset holds framed records. """
+        return CHUNK_HEADER.unpack_from(self.map, offset)[1] & FRAMED != 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def start_time(self):
+        """ The time the first chunk was read. """
+        return self.times[0] if self.times else 0.0
+
+    @property
+    def duration(self):
+        """ Seconds between the first and last chunk. """
+        return self.times[-1] - self.times[0] if self.times else 0.0
+
+    def seek(self, seconds):
+        """ The index of the first chunk read at least seconds after the
+        start of the capture, or before its end when seconds is negative. """
+        if seconds < 0:
+            seconds += self.duration
+        return bisect.bisect_left(self.times, self.start_time + seconds)
+
+    def chunk(self, index):
+        """ The chunk at index as bytes. """
+        offset = self.offsets[index]
+        size = CHUNK_HEADER.unpack_from(self.map, offset)[1] & ~FRAMED
+        start = offset + CHUNK_HEADER.size
+        return self.map[start:start + size]
+
+    def reader(self, index=0, max_bytes=16 * 2**20, max_seconds=1.0):
+        """ A reader returning the chunks from index onwards. """
+        return CaptureReader(self, index, max_bytes, max_seconds)
+
+    def close(self):
+        """ Release the map and file. """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class CaptureReader():
+    """ Reads a capture from a chunk index as if it were the input, joining
+    consecutive chunks that end within max_bytes of the first, were read
+    less than max_seconds after it and are framed the same way, per read. A
+    larger chunk is read alone. time is when the last chunk returned was
+    read and framed whether it holds framed records. """
+
+    def __init__(self, capture, index=0, max_bytes=16 * 2**20,
+                 max_seconds=1.0):
+        super().__init__()
+        self.capture = capture
+        self.index = index
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.time = None
+        self.framed = False
+
+    @property
+    def pending(self):
+        """ True while chunks are left to read. """
+        return self.index < len(self.capture)
+
+    @property
+    def progress(self):
+        """ The fraction of the capture read. """
+        return self.index / len(self.capture) if len(self.capture) else 1.0
+
+    def read(self):
+        """ Return the next chunks joined, empty once the capture is read. """
+        capture = self.capture
+        offsets = capture.offsets
+        start = self.index
+        if start >= len(capture):
+            return b''
+        limit = offsets[start] + self.max_bytes
+        stop = bisect.bisect_right(offsets, limit, start + 1)
+        if stop < len(offsets) or capture.end > limit:
+            # The chunk starting before the limit ends past it
+            stop = max(stop - 1, start + 1)
+        stop = bisect.bisect_left(capture.times,
+                                  capture.times[start] + self.max_seconds,
+                                  start + 1, stop)
+        framed = capture.framed[start]
+        for index in range(start + 1, stop):
+            if capture.framed[index] != framed:
+                stop = index
+                break
+        self.index = stop
+        self.time = capture.times[stop - 1]
+        self.framed = bool(framed)
+        if stop == start + 1:
+            return capture.chunk(start)
+        return b''.join(capture.chunk(index) for index in range(start, stop))
+
+    def close(self):
+        """ Close the capture. """
+        self.capture.close()
+
+
+class CaptureWriter():
+    """ Appends chunks to a capture from a background thread so the reading
+    thread never waits on the disk. An existing capture is appended to after
+    dropping any incomplete chunk at its end. """
+
+    def __init__(self, path, flush_seconds=1.0):
+        super().__init__()
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.chunks = queue.Queue()
+        self.errors = 0
+
+        entries = b''
+        rewrite = True
+        if os.path.exists(path) and os.path.getsize(path):
+            capture = CaptureFile(path)
+            rewrite = capture.repaired
+            if rewrite:
+                entries = b''.join(
+                    INDEX_ENTRY.pack(timestamp, offset) for timestamp, offset
+                    in zip(capture.times, capture.offsets))
+            capture.close()
+            with open(path, 'r+b') as file:
+                file.truncate(capture.end)
+        self.file = open(path, 'ab')
+        if not self.file.tell():
+            self.file.write(MAGIC)
+        self.offset = self.file.tell()
+        if rewrite:
+            with open(index_path(path), 'wb') as file:
+                file.write(entries)
+        self.index = open(index_path(path), 'ab')
+
+        self.thread = threading.Thread(target=self.run, name='capture',
+                                       daemon=True)
+        self.thread.start()
+
+    def write(self, chunk, timestamp=None, framed=False):
+        """ Queue a chunk read at timestamp, by default now, that holds
+        framed records if framed is set. """
+        self.chunks.put((time.time() if timestamp is None else timestamp,
+                         bytes(chunk), framed))
+
+    def run(self):
+        """ Writer loop run on the capture thread. The data is flushed before
+        the index at least every flush_seconds. """
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self.chunks.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                timestamp, chunk, framed = item
+                try:
+                    self.file.write(CHUNK_HEADER.pack(
+                        timestamp, len(chunk) | (FRAMED if framed else 0)))
+                    self.file.write(chunk)
+                    self.index.write(INDEX_ENTRY.pack(timestamp, self.offset))
+                    self.offset += CHUNK_HEADER.size + len(chunk)
+                except OSError:
+                    self.errors += 1
+            if time.monotonic() - last_flush >= self.flush_seconds:
+                self.flush()
+                last_flush = time.monotonic()
+        self.flush()
+
+    def flush(self):
+        """ Flush the data then the index. """
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        """ Write the queued chunks and close the capture. """
+        self.chunks.put(None)
+        self.thread.join()
+        self.file.close()
+        self.index.close()
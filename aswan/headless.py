@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+""" Run the aswan pipeline without a display, aggregating stdin or a file at
+full speed and writing snapshots of the report as TSV or JSONL. """
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+from aggregator import Aggregator
+from capture import CaptureFile
+from store import EvictionPolicy, HistoryPolicy, StoreModel
+from tabulator import DelimitedTextFieldParser, Tabulator, load_configs
+
+
+def snapshot_rows(model):
+    """ Yield each report row as a list of values, numbers as int or float
+    and missing values as None. """
+    store = model.store
+    for row in range(store.rows):
+        values = []
+        for column in range(store.width):
+            value = store.value(row, column)
+            if isinstance(value, float):
+                if math.isnan(value):
+                    value = None
+                elif value.is_integer():
+                    value = int(value)
+            values.append(value)
+        yield values
+
+
+def write_tsv(model, output):
+    """ Write the report as a header line followed by a line per row. """
+    store = model.store
+    output.write('\t'.join(model.header(column)
+                           for column in range(store.width)) + '\n')
+    for row in range(store.rows):
+        output.write('\t'.join(store.text(row, column) or ''
+                               for column in range(store.width)) + '\n')
+    output.write('\n')
+
+
+def write_jsonl(model, output, snapshot):
+    """ Write the report as a JSON object per row naming the columns. """
+    names = [model.header(column) for column in range(model.store.width)]
+    for values in snapshot_rows(model):
+        output.write(json.dumps({'snapshot': snapshot,
+                                 'row': dict(zip(names, values))}) + '\n')
+
+
+WRITERS = {'tsv': lambda model, output, snapshot: write_tsv(model, output),
+           'jsonl': write_jsonl}
+
+
+def run(tabulator, model, write, interval, idle_seconds=0.01):
+    """ Update the model until the input ends, writing a snapshot every
+    interval seconds if interval is set and always once at the end. """
+    snapshot = 0
+    next_snapshot = time.monotonic() + interval if interval else math.inf
+    try:
+        while not tabulator.finished:
+            table = model.update()
+            if not table['rows'] and not tabulator.pending:
+                time.sleep(idle_seconds)
+            if time.monotonic() >= next_snapshot:
+                write(model, snapshot)
+                snapshot += 1
+                next_snapshot += interval
+    except KeyboardInterrupt:
+        pass
+    write(model, snapshot)
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    CONFIGS = {'Default': DelimitedTextFieldParser, **load_configs()}
+    PARSER = argparse.ArgumentParser(description='Aswan headless aggregator')
+    PARSER.add_argument('--config', choices=list(CONFIGS), default='Default')
+    PARSER.add_argument('--input', help='read this file instead of stdin')
+    PARSER.add_argument('--output', help='write to this file not stdout')
+    PARSER.add_argument('--format', choices=list(WRITERS), default='tsv')
+    PARSER.add_argument('--interval', type=float, default=0,
+                        help='seconds between snapshots, 0 for the end only')
+    PARSER.add_argument('--workers', type=int, default=0,
+                        help='parse fields with this many worker processes')
+    PARSER.add_argument('--history-limit', type=int, default=0,
+                        help='keep at most this many updates per key')
+    PARSER.add_argument('--max-rows', type=int, default=None,
+                        help='evict rows to keep at most this many keys')
+    PARSER.add_argument('--evict', choices=EvictionPolicy.ORDERS,
+                        default='lru', help='evict the least recently or '
+                        'least frequently updated rows first')
+    PARSER.add_argument('--ttl', type=float, default=None,
+                        help='evict rows not updated for this many seconds')
+    PARSER.add_argument('--source', action='append', metavar='SPEC',
+                        help='read this source instead of stdin, repeatable: '
+                        '- for stdin, a file or FIFO path, tail:PATH, '
+                        'udp:HOST:PORT or tcp:HOST:PORT')
+    PARSER.add_argument('--capture', metavar='FILE',
+                        help='append the input to this capture file')
+    PARSER.add_argument('--open', metavar='FILE',
+                        help='aggregate this capture, then --input if given')
+    PARSER.add_argument('--seek', type=float, default=0,
+                        help='seconds into the capture to start from, '
+                        'negative counts back from its end')
+    ARGS = PARSER.parse_args()
+
+    TABULATOR = Tabulator(keep_history=False)
+    CONFIG = CONFIGS[ARGS.config]()
+    if ARGS.input:
+        CONFIG.reader.file = open(ARGS.input, 'rb')
+    elif ARGS.open:
+        CONFIG.reader.file = open(os.devnull, 'rb')
+    TABULATOR.set_config(CONFIG)
+    TABULATOR.set_workers(ARGS.workers)
+    if ARGS.open:
+        CAPTURE = CaptureFile(ARGS.open)
+        TABULATOR.open_capture(CAPTURE.reader(CAPTURE.seek(ARGS.seek)))
+    TABULATOR.set_inputs(ARGS.source)
+    TABULATOR.set_capture(ARGS.capture)
+    MODEL = StoreModel(Aggregator(TABULATOR),
+                       HistoryPolicy(limit=ARGS.history_limit),
+                       EvictionPolicy(ARGS.max_rows, ARGS.evict, ARGS.ttl))
+    OUTPUT = sys.stdout
+    if ARGS.output:
+        OUTPUT = open(ARGS.output, 'w', encoding='utf-8')
+    WRITE = WRITERS[ARGS.format]
+    run(TABULATOR, MODEL,
+        lambda model, snapshot: WRITE(model, OUTPUT, snapshot), ARGS.interval)
+    OUTPUT.flush()
+    TABULATOR.set_workers(0)
+    TABULATOR.set_capture(None)
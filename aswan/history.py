@@ -0,0 +1,437 @@
+""" Bounded replay history of the raw chunks read from the input. """
+import bisect
+import collections
+import lzma
+import mmap
+import queue
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+
+BLOCK_COUNT = struct.Struct('<I')
+STREAM_SIZE = 65536
+CODECS = {'zlib': (lambda data, level: zlib.compress(
+                       data, -1 if level is None else level),
+                   zlib.decompressobj),
+          'lzma': (lambda data, level: lzma.compress(data, preset=level),
+                   lzma.LZMADecompressor)}
+
+
+def encode_block(chunks, compression, level=None):
+    """ Compress chunks into one block prefixed with their sizes. """
+    sizes = [len(chunk) for chunk in chunks]
+    return (BLOCK_COUNT.pack(len(sizes))
+            + struct.pack(f'<{len(sizes)}I', *sizes)
+            + CODECS[compression][0](b''.join(chunks), level))
+
+
+def decode_block(block, compression):
+    """ Yield the chunks of a block, decompressing STREAM_SIZE compressed
+    bytes at a time so that only a little of the block is ever expanded. """
+    count = BLOCK_COUNT.unpack_from(block)[0]
+    sizes = struct.unpack_from(f'<{count}I', block, BLOCK_COUNT.size)
+    decompressor = CODECS[compression][1]()
+    expanded = bytearray()
+    index = 0
+    with memoryview(block) as view:
+        for offset in range(BLOCK_COUNT.size + 4 * count, len(block),
+                            STREAM_SIZE):
+            expanded += decompressor.decompress(
+                view[offset:offset + STREAM_SIZE])
+            start = 0
+            while index < count and len(expanded) - start >= sizes[index]:
+                yield bytes(expanded[start:start + sizes[index]])
+                start += sizes[index]
+                index += 1
+            del expanded[:start]
+
+
+class Block():
+    """ Chunks spilled from the memory ring to be compressed together on the
+    compressor thread, which replaces the chunks with the compressed data
+    and sets compressed. stored is the size the history accounts the block
+    at. """
+    __slots__ = ('chunks', 'data', 'compression', 'count', 'size', 'stored',
+                 'compressed')
+
+    def __init__(self, chunks, compression):
+        super().__init__()
+        self.chunks = chunks
+        self.data = None
+        self.compression = compression
+        self.count = len(chunks)
+        self.size = sum(len(chunk) for chunk in chunks)
+        self.stored = self.size
+        self.compressed = threading.Event()
+
+    def __iter__(self):
+        chunks = self.chunks
+        if chunks is not None:
+            yield from chunks
+        else:
+            yield from decode_block(self.data, self.compression)
+
+
+class Segment():
+    """ An append-only file of chunks on disk. Chunk boundaries are held in
+    memory and the file is memory mapped when chunks are read back. """
+
+    def __init__(self, directory=None):
+        super().__init__()
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.offsets = array('Q', [0])
+        self.map = None
+        self.count = 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def size(self):
+        """ Bytes stored in the segment. """
+        return self.offsets[-1]
+
+    def append(self, chunk, count=1):
+        """ Append a chunk, or a block of count chunks, to the end of the
+        segment file. """
+        self.file.write(chunk)
+        self.offsets.append(self.offsets[-1] + len(chunk))
+        self.count += count
+
+    def chunk(self, index):
+        """ Return the chunk at index as bytes. """
+        if self.map is None or len(self.map) < self.offsets[index + 1]:
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.chunk(index)
+
+    def close(self):
+        """ Release the map and delete the segment file. """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class ChunkHistory():
+    """ Recent chunks are kept in an in-memory ring of at most memory_limit
+    bytes. Older chunks spill to append-only segment files of segment_size
+    bytes and the oldest segments are discarded once disk_limit is reached.
+
+    With compression, 'zlib' or 'lzma' at level, chunks leaving the ring are
+    gathered into blocks of block_size bytes that are compressed on a
+    background thread and kept in memory up to compressed_limit bytes before
+    spilling to the segments. Blocks are decompressed as they are replayed.
+    Appending waits for the compressor when more than PENDING_BLOCKS blocks
+    are waiting to be compressed so that a slow codec cannot grow the raw
+    backlog without bound.
+
+    The time each chunk was read, and whether it holds records framed with
+    the names of several inputs, is kept as a timeline holding an entry only
+    when the time moved by TIME_RESOLUTION seconds or the framing changed,
+    numbering the chunks appended since the history was cleared. """
+    PENDING_BLOCKS = 4
+    TIME_RESOLUTION = 0.1
+
+    def __init__(self, memory_limit=32 * 2**20, segment_size=64 * 2**20,
+                 disk_limit=2**30, directory=None, compression=None,
+                 level=None, block_size=2**20, compressed_limit=256 * 2**20):
+        super().__init__()
+        if compression is not None and compression not in CODECS:
+            raise ValueError(f'Unknown compression {compression}, use one of '
+                             f'{list(CODECS)}')
+        self.memory_limit = memory_limit
+        self.segment_size = segment_size
+        self.disk_limit = disk_limit
+        self.directory = directory
+        self.compression = compression
+        self.level = level
+        self.block_size = block_size
+        self.compressed_limit = compressed_limit
+
+        self.memory = collections.deque()
+        self.memory_bytes = 0
+        self.filling = []
+        self.filling_bytes = 0
+        self.blocks = collections.deque()
+        self.unsettled = collections.deque()
+        self.block_bytes = 0
+        self.segments = collections.deque()
+        self.disk_bytes = 0
+        self.dropped = 0
+        self.appended = 0
+        self.marks = array('Q')
+        self.times = array('d')
+        self.framed = array('B')
+        self.compressing = None
+        self.compressor = None
+
+    def __len__(self):
+        return (sum(s.count for s in self.segments)
+                + sum(b.count for b in self.blocks)
+                + len(self.filling) + len(self.memory))
+
+    @property
+    def nbytes(self):
+        """ Bytes retained in memory and on disk. """
+        return (self.memory_bytes + self.filling_bytes + self.block_bytes
+                + self.disk_bytes)
+
+    def append(self, chunk, timestamp=None, framed=False):
+        """ Record a chunk read at timestamp, by default now, and whether it
+        is framed, spilling or compressing the oldest chunks when the memory
+        ring is full. """
+        if timestamp is None:
+            timestamp = time.time()
+        times = self.times
+        if (not times or abs(timestamp - times[-1]) >= self.TIME_RESOLUTION
+                or framed != self.framed[-1]):
+            self.marks.append(self.appended)
+            times.append(timestamp)
+            self.framed.append(framed)
+        self.appended += 1
+        chunk = bytes(chunk)
+        self.memory.append(chunk)
+        self.memory_bytes += len(chunk)
+        while self.memory_bytes > self.memory_limit and self.memory:
+            oldest = self.memory.popleft()
+            self.memory_bytes -= len(oldest)
+            if self.compression is None:
+                self.spill(oldest)
+            else:
+                self.fill(oldest)
+        if self.unsettled:
+            self.settle()
+
+    def fill(self, chunk):
+        """ Add a chunk to the block being filled, handing the block to the
+        compressor thread once it holds block_size bytes. """
+        self.filling.append(chunk)
+        self.filling_bytes += len(chunk)
+        if self.filling_bytes < self.block_size:
+            return
+        block = Block(self.filling, self.compression)
+        self.filling = []
+        self.filling_bytes = 0
+        self.blocks.append(block)
+        self.unsettled.append(block)
+        self.block_bytes += block.stored
+        if self.compressor is None:
+            self.compressing = queue.Queue()
+            self.compressor = threading.Thread(target=self.compress,
+                                               name='history', daemon=True)
+            self.compressor.start()
+        self.compressing.put(block)
+
+    def compress(self):
+        """ Compressor loop run on the history thread, the codecs release the
+        GIL while they work. """
+        while True:
+            block = self.compressing.get()
+            block.data = encode_block(block.chunks, block.compression,
+                                      self.level)
+            block.chunks = None
+            block.compressed.set()
+
+    def settle(self):
+        """ Account the blocks compressed since the last call, waiting on the
+        oldest while too many are pending, and spill the oldest compressed
+        blocks beyond compressed_limit. """
+        while len(self.unsettled) > self.PENDING_BLOCKS:
+            self.unsettled[0].compressed.wait()
+            self.settle_block()
+        while self.unsettled and self.unsettled[0].compressed.is_set():
+            self.settle_block()
+        while (self.block_bytes > self.compressed_limit and self.blocks
+               and self.blocks[0] not in self.unsettled):
+            block = self.blocks.popleft()
+            self.block_bytes -= block.stored
+            self.spill(block.data, block.count)
+
+    def flush(self):
+        """ Wait for the pending blocks to be compressed and account them. """
+        for block in list(self.unsettled):
+            block.compressed.wait()
+        self.settle()
+
+    def settle_block(self):
+        """ Account the oldest compressed block at its compressed size. """
+        block = self.unsettled.popleft()
+        self.block_bytes += len(block.data) - block.stored
+        block.stored = len(block.data)
+
+    def spill(self, chunk, count=1):
+        """ Write a chunk, or a compressed block of count chunks, to the
+        newest segment, discarding the oldest segments that fall outside the
+        retained window. """
+        if self.disk_limit <= 0:
+            self.dropped += count
+            self.trim_times()
+            return
+        if not self.segments or self.segments[-1].size >= self.segment_size:
+            self.segments.append(Segment(self.directory))
+        self.segments[-1].append(chunk, count)
+        self.disk_bytes += len(chunk)
+        while self.disk_bytes > self.disk_limit and len(self.segments) > 1:
+            segment = self.segments.popleft()
+            self.disk_bytes -= segment.size
+            self.dropped += segment.count
+            segment.close()
+            self.trim_times()
+
+    def trim_times(self):
+        """ Forget the times of dropped chunks once they are at least half
+        of the timeline, keeping the time of the oldest retained chunk. """
+        index = bisect.bisect_right(self.marks, self.dropped) - 1
+        if index > 0 and 2 * index >= len(self.marks):
+            del self.marks[:index]
+            del self.times[:index]
+            del self.framed[:index]
+
+    def __iter__(self):
+        """ Yield the retained chunks oldest first, reading spilled chunks
+        from disk one at a time and decompressing blocks as they are
+        reached. """
+        for segment in list(self.segments):
+            if self.compression is None:
+                yield from segment
+            else:
+                for block in segment:
+                    yield from decode_block(block, self.compression)
+        for block in list(self.blocks):
+            yield from block
+        yield from list(self.filling)
+        yield from list(self.memory)
+
+    def timed(self):
+        """ Yield (time, framed, chunk) for the retained chunks oldest
+        first. """
+        marks = self.marks
+        number = self.dropped
+        index = max(bisect.bisect_right(marks, number) - 1, 0)
+        for chunk in self:
+            while index + 1 < len(marks) and marks[index + 1] <= number:
+                index += 1
+            yield self.times[index], bool(self.framed[index]), chunk
+            number += 1
+
+    def clear(self):
+        """ Discard all history. Blocks still being compressed are
+        forgotten. """
+        for segment in self.segments:
+            segment.close()
+        self.segments.clear()
+        self.disk_bytes = 0
+        self.blocks.clear()
+        self.unsettled.clear()
+        self.block_bytes = 0
+        self.filling = []
+        self.filling_bytes = 0
+        self.memory.clear()
+        self.memory_bytes = 0
+        self.dropped = 0
+        self.appended = 0
+        self.marks = array('Q')
+        self.times = array('d')
+        self.framed = array('B')
+
+
+class HistoryCursor():
+    """ A replay position over the chunks that were in a history when the
+    cursor was created. The history itself is never modified, so each step
+    is O(1) however long the history is. time is when the last chunk
+    returned was read and framed whether it holds framed records, following
+    is the (time, framed, chunk) of the next one. """
+
+    def __init__(self, history):
+        super().__init__()
+        self.history = history
+        self.position = 0
+        self.end = len(history)
+        self.chunks = history.timed()
+        self.time = None
+        self.framed = False
+        self.following = None
+
+    @property
+    def remaining(self):
+        """ Chunks still to be replayed. """
+        return self.end - self.position
+
+    def peek(self):
+        """ The (time, framed, chunk) of the next chunk without moving past
+        it, or None when there is none. """
+        if self.following is None and self.position < self.end:
+            self.following = next(self.chunks, None)
+        return self.following
+
+    def next(self):
+        """ Return the next chunk or None when the replay is complete. """
+        if self.position >= self.end:
+            return None
+        timed = self.following or next(self.chunks, None)
+        self.following = None
+        if timed is None:
+            self.position = self.end
+            return None
+        self.time, self.framed, chunk = timed
+        self.position += 1
+        return chunk
+
+
+class RecordCache():
+    """ The records split from the most recent history chunks, numbered in
+    the order the chunks were read, with the partial record left after each.
+    A replay under the same record delimiter and encoding takes the records
+    from here rather than splitting the chunks again. Bounded by the bytes of
+    the chunks it covers. """
+
+    def __init__(self, limit=16 * 2**20):
+        super().__init__()
+        self.limit = limit
+        self.framing = None
+        self.entries = {}
+        self.last = -1
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set_framing(self, framing):
+        """ Discard the cached records if the framing they were split with
+        differs. """
+        if framing != self.framing:
+            self.clear()
+            self.framing = framing
+
+    def get(self, number):
+        """ Return (records, partial record, size, sources) of chunk number
+        or None. """
+        return self.entries.get(number)
+
+    def put(self, number, records, partial, size, sources=None):
+        """ Cache the records split from chunk number of size bytes and the
+        runs of records from each source if it was framed. Chunks are only
+        added in order, evicting the oldest beyond the limit. """
+        if number <= self.last or size > self.limit:
+            return
+        self.entries[number] = (records, bytes(partial), size, sources)
+        self.last = number
+        self.nbytes += size
+        while self.nbytes > self.limit:
+            self.nbytes -= self.entries.pop(next(iter(self.entries)))[2]
+
+    def clear(self):
+        """ Discard all cached records. """
+        self.entries = {}
+        self.last = -1
+        self.nbytes = 0
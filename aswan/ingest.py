@@ -0,0 +1,124 @@
+""" Background reading and parsing of the input, decoupled from the GUI. """
+import queue
+import threading
+import time
+import traceback
+from stats import STATS
+
+
+class Ingest():
+    """ A producer thread reads and tabulates the input and prepares the
+    tables for the aggregator, queueing them for the GUI thread to apply.
+    When the queue is full the producer waits, which backs up the input,
+    unless drop is set in which case the table is discarded and counted.
+    Tables without rows are queued only to refresh windowed values. The
+    aggregation state is only touched on the producer thread, other threads
+    queue their changes to it with call. """
+
+    def __init__(self, tabulator, aggregator, max_tables=64, drop=False):
+        super().__init__()
+        self.tabulator = tabulator
+        self.aggregator = aggregator
+        self.tables = queue.Queue(max_tables)
+        self.requests = queue.SimpleQueue()
+        self.drop = drop
+        self.max_tables_per_update = 8
+        self.idle_seconds = 0.01
+
+        self.dropped_rows = 0
+        self.blocked_seconds = 0.0
+        self.errors = 0
+
+        self.running = False
+        self.thread = threading.Thread(target=self.run, name='ingest',
+                                       daemon=True)
+
+    def start(self):
+        """ Start the producer thread. """
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the producer thread and wait for it to finish. """
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        """ Producer loop run on the ingest thread. """
+        while self.running:
+            try:
+                self.run_requests()
+                table = self.tabulator.update()
+                with STATS.timer('aggregate'):
+                    table = self.aggregator.prepare(table)
+                if table['rows'] or table.get('refresh'):
+                    self.put(table)
+                elif not table['pending']:
+                    time.sleep(self.idle_seconds)
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
+
+    def call(self, function, *args):
+        """ Run function with args on the producer thread before it
+        prepares its next table. """
+        self.requests.put((function, args))
+
+    def run_requests(self):
+        """ Run the functions queued by call, in order. """
+        while True:
+            try:
+                function, args = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            function(*args)
+
+    def put(self, table):
+        """ Queue a prepared table applying backpressure or dropping it. """
+        if self.drop:
+            try:
+                self.tables.put_nowait(table)
+            except queue.Full:
+                self.dropped_rows += len(table['rows'])
+                STATS.count('dropped', len(table['rows']))
+            return
+        start = time.perf_counter()
+        while self.running:
+            try:
+                self.tables.put(table, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.blocked_seconds += time.perf_counter() - start
+
+    def update(self):
+        """ Take the queued tables for the current tabulator generation and
+        merge them into one prepared table. Called from the GUI thread. A
+        refreshed value is kept only if no later group updates its key. """
+        merged = {'metadata': {}, 'rows': [], 'groups': [], 'pending': False,
+                  'refresh': {}}
+        refresh = merged['refresh']
+        for _ in range(self.max_tables_per_update):
+            try:
+                table = self.tables.get_nowait()
+            except queue.Empty:
+                break
+            if table['generation'] != self.tabulator.generation:
+                continue
+            if table['rows']:
+                merged['metadata'] = table['metadata']
+                merged['rows'].extend(table['rows'])
+                merged['groups'].extend(table['groups'])
+                if refresh:
+                    for key, _ in table['groups']:
+                        refresh.pop(key, None)
+            refresh.update(table.get('refresh', ()))
+        merged['pending'] = not self.tables.empty()
+        STATS.gauge('queue', self.tables.qsize())
+        return merged
+
+    def status(self):
+        """ A short description of the queue for the status bar. """
+        return (f'Queue {self.tables.qsize()}/{self.tables.maxsize}  '
+                f'Blocked {self.blocked_seconds:.1f}s  '
+                f'Dropped {self.dropped_rows} rows')
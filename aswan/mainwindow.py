@@ -1,9 +1,15 @@
 """ MainWindow - the Main user interface code. """
+import re
 import webbrowser
-from PyQt5.QtCore import QSortFilterProxyModel, QTimer
+from PyQt5.QtCore import QTimer
 from PyQt5.QtMultimedia import QSound
 from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QHeaderView, QMainWindow, qApp
+from PyQt5.QtWidgets import (QFileDialog, QHeaderView, QInputDialog, QLabel,
+                             QLineEdit, QMainWindow, QMessageBox, QProgressBar,
+                             qApp)
+from capture import CaptureFile
+from proxy import SortFilterProxy
+from stats import STATS
 from ui_mainwindow import Ui_MainWindow
 from tabulatordialog import TabulatorDialog
 
@@ -22,24 +28,65 @@ class MainWindow(QMainWindow):
 
         self.setWindowIcon(QIcon('aswan-icon.png'))
 
+        self.ingest_status = QLabel()
+        self.window.statusbar.addPermanentWidget(self.ingest_status)
+        self.stats_status = QLabel()
+        self.stats_status.setVisible(False)
+        self.window.statusbar.addWidget(self.stats_status)
+        self.replay_progress = QProgressBar()
+        self.replay_progress.setFormat('Replay %p%')
+        self.replay_progress.setMaximumWidth(160)
+        self.replay_progress.setVisible(False)
+        self.window.statusbar.addPermanentWidget(self.replay_progress)
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText('Filter')
+        self.filter_edit.setClearButtonEnabled(True)
+        self.filter_edit.setMaximumWidth(240)
+        self.window.statusbar.addPermanentWidget(self.filter_edit)
+
         # Data binding
-        self.proxy_model = QSortFilterProxyModel()
+        self.proxy_model = SortFilterProxy()
         self.proxy_model.setSourceModel(self.application.REPORT)
         self.window.treeView.setModel(self.proxy_model)
+        # Rows are single lines, so changed rows need no size hint
+        self.window.treeView.setUniformRowHeights(True)
 
         # Command binding
+        self.window.actionOpen.triggered.connect(self.cmd_file_open)
         self.window.actionQuit.triggered.connect(qApp.quit)
 
         self.window.actionColumns.triggered.connect(self.cmd_view_columns)
         self.window.actionClear.triggered.connect(self.cmd_view_clear)
         self.window.actionFit_Columns_To_Contents.triggered.connect(
             self.cmd_view_fit_columns_to_contents)
+        self.window.actionStatistics.toggled.connect(self.cmd_view_statistics)
+        self.filter_edit.textChanged.connect(self.cmd_view_filter)
 
         self.window.actionDocumentation.triggered.connect(self.cmd_help_documentation)
 
         # Start the report updates
         self.update()
 
+    def cmd_file_open(self):
+        """ Reload a capture from a chosen time offset. """
+        path, _ = QFileDialog.getOpenFileName(self, 'Open Capture')
+        if not path:
+            return
+        try:
+            capture = CaptureFile(path)
+        except (OSError, ValueError) as error:
+            QMessageBox.warning(self, 'Open Capture', str(error))
+            return
+        seconds, accepted = QInputDialog.getDouble(
+            self, 'Open Capture', 'Start seconds into the capture:', 0.0, 0.0,
+            capture.duration, 1)
+        if not accepted:
+            capture.close()
+            return
+        self.application.TABULATOR.open_capture(
+            capture.reader(capture.seek(seconds)))
+        self.application.REPORT.clear(aggregations=False)
+
     def cmd_view_columns(self):
         """ Configure the columns produced by the tabulator. """
         self.tabulator_dialog = TabulatorDialog(self.application)
@@ -53,17 +100,42 @@ class MainWindow(QMainWindow):
         """ Fit report columns to visible rows. """
         self.window.treeView.header().resizeSections(QHeaderView.ResizeToContents)
 
+    def cmd_view_statistics(self, checked):
+        """ Show or hide the pipeline statistics, which are only collected
+        while shown or dumped. """
+        STATS.enable(checked or STATS.dump is not None)
+        self.stats_status.setVisible(checked)
+
+    def cmd_view_filter(self, text):
+        """ Show only the rows containing the filter text. """
+        self.proxy_model.set_filter(re.escape(text))
+
     def cmd_help_documentation(self):
         """ Show documentation. """
         webbrowser.open_new('https://www.intrepiduniverse.com/')
 
     def update(self):
-        """ Timer method to update the report in real time. """
+        """ Timer method to update the report in real time. When input was
+        left unread the next update is scheduled immediately. The rows that
+        changed are sorted and filtered once per update. """
+        interval = 100
         try:
             if self.window.actionRealtime.isChecked():
-                table = self.application.REPORT.update()
-                if table['rows']:
-                    if self.window.actionAudible_Blink.isChecked():
+                with STATS.timer('frame'):
+                    table = self.application.REPORT.update()
+                    if table['rows'] and self.window.actionAudible_Blink.isChecked():
                         self.sound.play()
+                    with STATS.timer('sort'):
+                        self.proxy_model.refresh()
+                if table.get('pending'):
+                    interval = 0
+            self.ingest_status.setText(self.application.INGEST.status())
+            progress = self.application.TABULATOR.replay_progress
+            self.replay_progress.setVisible(progress is not None)
+            if progress is not None:
+                self.replay_progress.setValue(int(progress * 100))
+            STATS.tick()
+            if self.window.actionStatistics.isChecked():
+                self.stats_status.setText(STATS.summary())
         finally:
-            QTimer.singleShot(100, self.update)
+            QTimer.singleShot(interval, self.update)
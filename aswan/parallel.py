@@ -0,0 +1,54 @@
+""" Parse records into fields on several cores with a process pool. """
+import concurrent.futures
+import multiprocessing
+
+# The config of a worker process, built once when the worker starts
+CONFIG = None
+
+
+def start_worker(factory):
+    """ Build the config used by this worker process. """
+    global CONFIG
+    CONFIG = factory()
+
+
+def parse_batch(records):
+    """ Parse a batch of records in a worker returning rows as tuples. """
+    parse_fields = CONFIG.parse_fields
+    rows = []
+    for record in records:
+        fields = parse_fields(record)
+        if fields:
+            rows.append(tuple(fields))
+    return rows
+
+
+class ParallelParser():
+    """ Shards records in batches of batch_size across worker processes. Each
+    worker builds its own config from the config's factory, or its class, so
+    configs built from closures need not be picklable. Rows are returned in
+    input order. Fewer than min_records are better parsed in process. """
+
+    def __init__(self, config, workers, batch_size=5000, min_records=1000):
+        super().__init__()
+        self.workers = workers
+        self.batch_size = batch_size
+        self.min_records = min_records
+        factory = getattr(config, 'factory', type(config))
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            workers, multiprocessing.get_context('spawn'),
+            initializer=start_worker, initargs=(factory,))
+
+    def parse(self, records):
+        """ Parse records returning the rows in order. """
+        batch_size = max(min(self.batch_size, len(records) // self.workers), 1)
+        batches = [records[i:i + batch_size]
+                   for i in range(0, len(records), batch_size)]
+        rows = []
+        for batch in self.pool.map(parse_batch, batches):
+            rows.extend(batch)
+        return rows
+
+    def close(self):
+        """ Shut down the worker processes. """
+        self.pool.shutdown(cancel_futures=True)
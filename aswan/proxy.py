@@ -0,0 +1,488 @@
+""" A sort and filter proxy for the report that is kept up to date
+incrementally.
+
+Only the top level rows whose sort value or filter text changed are placed
+again, by bisection into a sorted list of (sort key, source row) entries,
+instead of sorting every row after each update. Whether a row matches the
+filter is cached per row and only recomputed when the row changes. History
+rows are shown in their own order under their top level row.
+"""
+import bisect
+import re
+from PyQt5.QtCore import QAbstractProxyModel, QModelIndex, Qt
+
+
+def sort_key(value):
+    """ A key ordering missing values, then numbers, then text so that mixed
+    columns can be sorted. """
+    if value is None or value != value:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, str(value))
+
+
+class SortFilterProxy(QAbstractProxyModel):
+    """ Presents the top level rows of the source accepted by the filter in
+    the order of the sort column. Changes are collected from the source
+    signals and applied by refresh, which should be called once per update.
+    The source is expected to append and remove top level rows at its end,
+    as the report does, other insertions and removals reset the proxy. When
+    more than MERGE_MOVES rows change place at once they are merged into the
+    sorted entries in one pass rather than moved one by one. """
+    MERGE_MOVES = 32
+
+    def __init__(self, sort_role=Qt.UserRole):
+        super().__init__()
+        self.sort_role = sort_role
+        self.sort_column = -1
+        self.sort_order = Qt.AscendingOrder
+        self.pattern = None
+        self.filter_column = -1
+        self.entries = []
+        self.entry_of = []
+        self.accepted = bytearray()
+        self.dirty = set()
+        self.inserting = []
+        self.removing = []
+        self.resetting = False
+
+    # QAbstractItemModel interface
+
+    def setSourceModel(self, model):
+        """ Follow the changes of a new source model. """
+        old = self.sourceModel()
+        if old is not None:
+            for signal, slot in self.connections(old):
+                signal.disconnect(slot)
+        self.beginResetModel()
+        super().setSourceModel(model)
+        self.rebuild()
+        self.endResetModel()
+        for signal, slot in self.connections(model):
+            signal.connect(slot)
+
+    def index(self, row, column, parent=QModelIndex()):
+        """ Index of a top level or history cell. """
+        source = self.sourceModel()
+        if not 0 <= column < source.columnCount():
+            return QModelIndex()
+        if not parent.isValid():
+            if 0 <= row < len(self.entries):
+                return self.createIndex(row, column, 0)
+            return QModelIndex()
+        if parent.internalId() == 0 and parent.column() == 0:
+            source_row = self.source_row(parent.row())
+            if 0 <= row < source.rowCount(source.index(source_row, 0)):
+                return self.createIndex(row, column, source_row + 1)
+        return QModelIndex()
+
+    def parent(self, index=None):
+        """ The top level row of a history row. """
+        if index is None:
+            return super().parent()
+        if not index.isValid() or index.internalId() == 0:
+            return QModelIndex()
+        return self.createIndex(self.proxy_row(index.internalId() - 1), 0, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        """ Accepted top level rows, or the history of a top level row. """
+        if not parent.isValid():
+            return len(self.entries)
+        if parent.internalId() == 0 and parent.column() == 0:
+            source = self.sourceModel()
+            return source.rowCount(source.index(self.source_row(parent.row()),
+                                                0))
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        """ All rows have the columns of the source. """
+        return self.sourceModel().columnCount()
+
+    def hasChildren(self, parent=QModelIndex()):
+        """ Whether there are rows under parent, asked of every row the view
+        lays out. """
+        if not parent.isValid():
+            return bool(self.entries)
+        if parent.internalId() or parent.column():
+            return False
+        source = self.sourceModel()
+        return source.rowCount(source.index(self.source_row(parent.row()),
+                                            0)) > 0
+
+    def flags(self, index):
+        """ Cells are enabled and selectable, as in the source, without
+        mapping every cell the view lays out back to the source. """
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        """ The data of the source cell. """
+        if not index.isValid():
+            return None
+        return self.sourceModel().data(self.mapToSource(index), role)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        """ Column headers from the source, rows numbered from one. """
+        if orientation == Qt.Horizontal:
+            return self.sourceModel().headerData(section, orientation, role)
+        if role == Qt.DisplayRole:
+            return str(section + 1)
+        return None
+
+    def mapToSource(self, index):
+        """ The source index of a proxy index. """
+        if not index.isValid():
+            return QModelIndex()
+        source = self.sourceModel()
+        parent_id = index.internalId()
+        if parent_id:
+            return source.index(index.row(), index.column(),
+                                source.index(parent_id - 1, 0))
+        return source.index(self.source_row(index.row()), index.column())
+
+    def mapFromSource(self, index):
+        """ The proxy index of a source index, invalid if it is not shown. """
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.parent()
+        if parent.isValid():
+            if self.proxy_row(parent.row()) < 0:
+                return QModelIndex()
+            return self.createIndex(index.row(), index.column(),
+                                    parent.row() + 1)
+        row = self.proxy_row(index.row())
+        if row < 0:
+            return QModelIndex()
+        return self.createIndex(row, index.column(), 0)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """ Sort by column, or in source order when column is negative. """
+        self.layoutAboutToBeChanged.emit()
+        indexes, sources = self.persistent_sources()
+        self.sort_column = column
+        self.sort_order = order
+        self.entries = sorted(self.entry(entry[1]) for entry in self.entries)
+        for entry in self.entries:
+            self.entry_of[entry[1]] = entry
+        self.changePersistentIndexList(
+            indexes, [self.mapFromSource(index) for index in sources])
+        self.layoutChanged.emit()
+        self.refresh()
+
+    # Mapping
+
+    def source_row(self, row):
+        """ The source row shown at a proxy row. """
+        if self.sort_order == Qt.AscendingOrder:
+            return self.entries[row][1]
+        return self.entries[-1 - row][1]
+
+    def proxy_row(self, source_row):
+        """ The proxy row of a source row or -1 if it is not shown. """
+        entry = self.entry_of[source_row]
+        if entry is None:
+            return -1
+        position = bisect.bisect_left(self.entries, entry)
+        if self.sort_order == Qt.AscendingOrder:
+            return position
+        return len(self.entries) - 1 - position
+
+    def proxy_rows(self, positions):
+        """ The (first, last) proxy rows of a run of entry positions. """
+        first, last = positions
+        if self.sort_order == Qt.AscendingOrder:
+            return first, last
+        return len(self.entries) - 1 - last, len(self.entries) - 1 - first
+
+    def persistent_sources(self):
+        """ The persistent indexes and the source indexes they show. """
+        indexes = self.persistentIndexList()
+        return indexes, [self.mapToSource(index) for index in indexes]
+
+    # Sorting and filtering
+
+    def set_filter(self, pattern, column=-1):
+        """ Show only the top level rows whose text in column, or in any
+        column when column is negative, matches the regular expression
+        pattern, case insensitively. An empty pattern shows every row. """
+        self.pattern = re.compile(pattern, re.IGNORECASE) if pattern else None
+        self.filter_column = column
+        self.dirty.update(range(len(self.entry_of)))
+        self.refresh()
+
+    def accepts(self, row):
+        """ Whether the filter accepts a source row. """
+        if self.pattern is None:
+            return True
+        source = self.sourceModel()
+        if self.filter_column >= 0:
+            columns = [self.filter_column]
+        else:
+            columns = range(source.columnCount())
+        search = self.pattern.search
+        for column in columns:
+            text = source.data(source.index(row, column), Qt.DisplayRole)
+            if text is not None and search(str(text)):
+                return True
+        return False
+
+    def entry(self, row):
+        """ The (sort key, source row) entry of a source row. """
+        if self.sort_column < 0:
+            return ((), row)
+        source = self.sourceModel()
+        return (sort_key(source.data(source.index(row, self.sort_column),
+                                     self.sort_role)), row)
+
+    def refresh_filter(self):
+        """ Recompute whether the changed rows are accepted, returning the
+        changed rows. """
+        dirty = self.dirty
+        self.dirty = set()
+        for row in dirty:
+            self.accepted[row] = self.accepts(row)
+        return dirty
+
+    def rebuild(self):
+        """ Recompute the filter and the order of every row. """
+        source = self.sourceModel()
+        rows = source.rowCount() if source is not None else 0
+        self.accepted = bytearray(rows)
+        self.entry_of = [None] * rows
+        self.entries = []
+        self.dirty = set(range(rows))
+        self.refresh_filter()
+        self.entries = sorted(self.entry(row) for row in range(rows)
+                              if self.accepted[row])
+        for entry in self.entries:
+            self.entry_of[entry[1]] = entry
+
+    def refresh(self):
+        """ Place the rows that changed since the last refresh, removing
+        those the filter no longer accepts and inserting new and newly
+        accepted rows. """
+        if not self.dirty:
+            return
+        leaving = []
+        entering = []
+        moving = []
+        for row in self.refresh_filter():
+            old = self.entry_of[row]
+            new = self.entry(row) if self.accepted[row] else None
+            if old == new:
+                continue
+            if new is None:
+                leaving.append(old)
+            elif old is None:
+                entering.append(new)
+            else:
+                moving.append((old, new))
+        self.remove_entries(leaving)
+        self.move_entries(moving)
+        self.insert_entries(entering)
+
+    def remove_entries(self, leaving):
+        """ Remove entries, one removal for each run of adjacent rows. """
+        entries = self.entries
+        positions = sorted(bisect.bisect_left(entries, entry)
+                           for entry in leaving)
+        runs = []
+        for position in positions:
+            if runs and runs[-1][1] == position - 1:
+                runs[-1][1] = position
+            else:
+                runs.append([position, position])
+        for first, last in reversed(runs):
+            self.beginRemoveRows(QModelIndex(), *self.proxy_rows((first, last)))
+            for entry in entries[first:last + 1]:
+                self.entry_of[entry[1]] = None
+            del entries[first:last + 1]
+            self.endRemoveRows()
+
+    def move_entries(self, moving):
+        """ Give rows new keys. A row whose new key still falls between its
+        neighbours keeps its place, the others are moved in one layout
+        change. """
+        entries = self.entries
+        entry_of = self.entry_of
+        moved = []
+        for old, new in moving:
+            position = bisect.bisect_left(entries, old)
+            if ((position == 0 or entries[position - 1] < new)
+                    and (position == len(entries) - 1
+                         or new < entries[position + 1])):
+                entries[position] = new
+                entry_of[new[1]] = new
+            else:
+                moved.append((old, new))
+        if not moved:
+            return
+        self.layoutAboutToBeChanged.emit()
+        indexes, sources = self.persistent_sources()
+        if len(moved) > self.MERGE_MOVES:
+            rows = {new[1] for _, new in moved}
+            entries[:] = [entry for entry in entries if entry[1] not in rows]
+            entries += sorted(new for _, new in moved)
+            entries.sort()
+        else:
+            for old, _ in moved:
+                del entries[bisect.bisect_left(entries, old)]
+            for _, new in moved:
+                bisect.insort(entries, new)
+        for _, new in moved:
+            entry_of[new[1]] = new
+        self.changePersistentIndexList(
+            indexes, [self.mapFromSource(index) for index in sources])
+        self.layoutChanged.emit()
+
+    def insert_entries(self, entering):
+        """ Insert entries, one insertion for each run of entries that fall
+        between the same two shown rows. """
+        entries = self.entries
+        entering.sort()
+        start = 0
+        while start < len(entering):
+            position = bisect.bisect_left(entries, entering[start])
+            end = start + 1
+            while end < len(entering) and (position == len(entries) or
+                                           entering[end] < entries[position]):
+                end += 1
+            block = entering[start:end]
+            if self.sort_order == Qt.AscendingOrder:
+                first = position
+            else:
+                first = len(entries) - position
+            self.beginInsertRows(QModelIndex(), first, first + len(block) - 1)
+            entries[position:position] = block
+            for entry in block:
+                self.entry_of[entry[1]] = entry
+            self.endInsertRows()
+            start = end
+
+    # Source signals
+
+    def connections(self, source):
+        """ The source signals followed and their slots. """
+        return [(source.modelAboutToBeReset, self.beginResetModel),
+                (source.modelReset, self.source_reset),
+                (source.layoutAboutToBeChanged, self.beginResetModel),
+                (source.layoutChanged, self.source_reset),
+                (source.rowsAboutToBeInserted, self.source_rows_inserting),
+                (source.rowsInserted, self.source_rows_inserted),
+                (source.rowsAboutToBeRemoved, self.source_rows_removing),
+                (source.rowsRemoved, self.source_rows_removed),
+                (source.columnsAboutToBeInserted,
+                 self.source_columns_inserting),
+                (source.columnsInserted, self.source_columns_inserted),
+                (source.dataChanged, self.source_data_changed),
+                (source.headerDataChanged, self.headerDataChanged)]
+
+    def source_reset(self):
+        """ Rebuild after the source was reset or rearranged. """
+        self.rebuild()
+        self.endResetModel()
+
+    def source_rows_inserting(self, parent, first, last):
+        """ Forward the insertion of history rows under a shown row. """
+        shown = parent.isValid() and self.proxy_row(parent.row()) >= 0
+        if shown:
+            self.beginInsertRows(self.mapFromSource(parent), first, last)
+        self.inserting.append(shown)
+
+    def source_rows_inserted(self, parent, first, last):
+        """ Note appended top level rows for the next refresh. """
+        if self.inserting.pop():
+            self.endInsertRows()
+        if parent.isValid():
+            return
+        if first != len(self.entry_of):
+            self.beginResetModel()
+            self.rebuild()
+            self.endResetModel()
+            return
+        count = last - first + 1
+        self.entry_of += [None] * count
+        self.accepted += bytes(count)
+        self.dirty.update(range(first, last + 1))
+
+    def source_rows_removing(self, parent, first, last):
+        """ Remove shown rows before the source removes them, resetting
+        unless they are the last top level rows. """
+        if parent.isValid():
+            shown = self.proxy_row(parent.row()) >= 0
+            if shown:
+                self.beginRemoveRows(self.mapFromSource(parent), first, last)
+            self.removing.append(shown)
+            return
+        self.removing.append(False)
+        if last != len(self.entry_of) - 1:
+            self.beginResetModel()
+            self.resetting = True
+            return
+        self.remove_entries([entry for entry in self.entry_of[first:]
+                             if entry is not None])
+
+    def source_rows_removed(self, parent, first, last):
+        """ Forget the removed top level rows. """
+        if self.removing.pop():
+            self.endRemoveRows()
+        if parent.isValid():
+            return
+        if self.resetting:
+            self.resetting = False
+            self.rebuild()
+            self.endResetModel()
+            return
+        del self.entry_of[first:]
+        del self.accepted[first:]
+        self.dirty = {row for row in self.dirty if row < first}
+
+    def source_columns_inserting(self, parent, first, last):
+        """ Forward the insertion of columns. """
+        self.beginInsertColumns(QModelIndex(), first, last)
+
+    def source_columns_inserted(self, parent, first, last):
+        """ Finish inserting columns. """
+        self.endInsertColumns()
+
+    def source_data_changed(self, top_left, bottom_right, roles=()):
+        """ Forward changed cells and note the rows whose sort value or
+        filter text may have changed. """
+        parent = top_left.parent()
+        first_column, last_column = top_left.column(), bottom_right.column()
+        if parent.isValid():
+            proxy_parent = self.mapFromSource(parent)
+            if proxy_parent.isValid():
+                self.dataChanged.emit(
+                    self.index(top_left.row(), first_column, proxy_parent),
+                    self.index(bottom_right.row(), last_column, proxy_parent),
+                    roles)
+            return
+        rows = range(top_left.row(), bottom_right.row() + 1)
+        if not roles or self.sort_role in roles or Qt.DisplayRole in roles:
+            if ((first_column <= self.sort_column <= last_column)
+                    or (self.pattern is not None and (
+                        self.filter_column < 0 or first_column
+                        <= self.filter_column <= last_column))):
+                self.dirty.update(rows)
+        proxy_rows = sorted(row for row in map(self.proxy_row, rows)
+                            if row >= 0)
+        run = None
+        for row in proxy_rows:
+            if run and row == run[1] + 1:
+                run[1] = row
+                continue
+            if run:
+                self.emit_run(run, first_column, last_column, roles)
+            run = [row, row]
+        if run:
+            self.emit_run(run, first_column, last_column, roles)
+
+    def emit_run(self, run, first_column, last_column, roles):
+        """ Emit dataChanged for a [first row, last row] run of proxy rows. """
+        self.dataChanged.emit(self.index(run[0], first_column),
+                              self.index(run[1], last_column), roles)
@@ -1,124 +1,347 @@
 """ The realtime report shown to the user. """
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QColor, QStandardItem, QStandardItemModel
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt
+from PyQt5.QtGui import QColor
+from stats import STATS
+from store import ColumnStore, format_number, header_name
 
 
-class CellAnimator(object):
-    """ State machine used ot animate cell styles. Animation is performed based
-    on a frame timer. The transitions are precomputed so the main animation
-    logic is fast. """
+class TimingWheel():
+    """ Schedules items for a frame fewer than size frames ahead. Each slot
+    holds the items due in one frame so advancing a frame only touches the
+    items that are due. """
+
+    def __init__(self, size=1024):
+        super().__init__()
+        self.slots = [[] for _ in range(size)]
+
+    def schedule(self, frame, item):
+        """ Schedule item for frame. """
+        self.slots[frame % len(self.slots)].append(item)
+
+    def advance(self, frame):
+        """ Take the items scheduled for frame. """
+        slot = frame % len(self.slots)
+        items = self.slots[slot]
+        self.slots[slot] = []
+        return items
+
+    def clear(self):
+        """ Forget all the scheduled items. """
+        self.slots = [[] for _ in self.slots]
+
+
+class RowAnimator():
+    """ Animates the background of a row based on a frame timer. The row is
+    coloured as new or recent from start_frame until remove_frame and the
+    columns in the blink_mask bitmask fade in from the updated colour. The
+    colour of a cell is computed when the view asks for it. A row lives for
+    LIFETIME frames unless more data arrives in which case it is removed
+    once its blink is over. """
     NEW_COLOUR = QColor(180, 255, 180)
     UPDATED_COLOUR = [QColor(c, 255, c)
                       for c in [180 + (12 * c) for c in range(0, 5)]]
     RECENT_COLOUR = QColor(240, 255, 240)
-    NORMAL_COLOUR = QColor(255, 255, 255)
+    BLINK_FRAMES = 2 * len(UPDATED_COLOUR)
+    LIFETIME = 10 * 60
+    __slots__ = ('row', 'columns', 'start_frame', 'remove_frame', 'colour',
+                 'blink_mask')
 
-    def __init__(self, model, row, column, row_is_new, blink_cell):
+    def __init__(self, row, columns, frame, row_is_new, blink_columns=()):
         super().__init__()
-        self.column = column
         self.row = row
-        self.start_frame = model.frame
-        self.blink_end_frame = model.frame + 2 * len(self.UPDATED_COLOUR)
-        self.remove_frame = model.frame + 10 * 60
-        self.state = []
-        if row_is_new:
-            self.state.append('new')
-        else:
-            self.state.append('recent')
-        if blink_cell:
-            self.state.append('blink')
-
-    def animate(self, model, frame, last_data_frame):
-        """ Animate the cell style based on the frame time """
-        if self.start_frame != last_data_frame:
-            self.remove_frame = self.blink_end_frame
-        if self.remove_frame <= frame:
-            self.state.append('remove')
-        if self.state:
-            state = self.state.pop()
-            index = model.index(self.row, self.column)
-            if state == 'new':
-                model.setData(index, self.NEW_COLOUR, Qt.BackgroundRole)
-            elif state == 'recent':
-                model.setData(index, self.RECENT_COLOUR, Qt.BackgroundRole)
-            elif state == 'remove':
-                model.setData(index, self.NORMAL_COLOUR, Qt.BackgroundRole)
-                return True
-            else:
-                ttl = self.blink_end_frame - frame - len(self.UPDATED_COLOUR)
-                if ttl > 0:
-                    model.setData(
-                        index, self.UPDATED_COLOUR[ttl - 1], Qt.BackgroundRole)
-                    self.state.append(state)
-                else:
-                    model.setData(index, self.RECENT_COLOUR, Qt.BackgroundRole)
-        return False
-
-
-class Report(QStandardItemModel):
-    """ The Model containing the final aggregated report. """
-
-    def __init__(self, aggregator):
+        self.columns = columns
+        self.start_frame = frame
+        self.remove_frame = frame + self.LIFETIME
+        self.colour = self.NEW_COLOUR if row_is_new else self.RECENT_COLOUR
+        self.blink_mask = 0
+        for column in blink_columns:
+            self.blink_mask |= 1 << column
+
+    def background(self, column, frame):
+        """ The colour of a cell of the row in frame. """
+        if column >= self.columns:
+            return None
+        step = frame - self.start_frame
+        if self.blink_mask >> column & 1 and step < len(self.UPDATED_COLOUR):
+            return self.UPDATED_COLOUR[-1 - max(step, 0)]
+        return self.colour
+
+    def blink_span(self):
+        """ The first and last blinking column. """
+        mask = self.blink_mask
+        return (mask & -mask).bit_length() - 1, mask.bit_length() - 1
+
+    def expire(self, frame):
+        """ More data arrived in frame so remove the row after its blink,
+        returns the new remove frame. """
+        self.remove_frame = max(frame, self.start_frame + self.BLINK_FRAMES)
+        return self.remove_frame
+
+
+class Report(QAbstractItemModel):
+    """ The Model containing the final aggregated report. Cells are served
+    lazily from a ColumnStore. Top level rows have an internal id of 0 and
+    history rows the number of their parent row plus one. """
+
+    def __init__(self, aggregator, history_policy=None, eviction_policy=None):
         super().__init__()
         self.aggregator = aggregator
+        self.store = ColumnStore(self, history_policy, eviction_policy,
+                                 self.forget)
         self.clear()
 
-    def try_get_row_by_key(self, row_key):
-        """ Return row index in report of key or None if not found"""
-        if row_key and row_key in self.row_index:
-            return self.row_index[row_key]
-
-    def append_row_for_key(self, row_key, row):
-        """ Append a row to the report for a given row_key or just append
-        if there is no row key. """
-        if row_key is not None and row_key in self.row_index:
-            raise Exception(f'Row key "{row_key}" already added to index')
-        new_row = self.rowCount() or 0
-        qt_row = [QStandardItem(x) for x in row]
-        self.appendRow(qt_row)
-        self.row_index[row_key] = new_row
-        for column in range(self.columnCount()):
-            self.animate(CellAnimator(self, new_row, column, True, False))
-
-    def update_in_place(self, existing_row, row):
-        """ Use of setData ensures sorted views auto sort correctly. """
-        qt_row = [QStandardItem(x) for x in row]
-        for column in range(self.columnCount()):
-            index = self.index(existing_row, column)
-            old_data = self.data(index)
-            new_data = None
-            if column < len(row):
-                new_data = row[column]
-            if old_data != new_data:
-                self.setData(index, new_data)
-            self.animate(CellAnimator(self, existing_row,
-                                      column, False, old_data != new_data))
-            if column == 0:
-                self.itemFromIndex(index).appendRow(qt_row)
+    # QAbstractItemModel interface
+
+    def index(self, row, column, parent=QModelIndex()):
+        """ Index of a top level or history cell. The bounds are checked
+        against the store rather than with hasIndex, which would call back
+        into rowCount and columnCount. """
+        store = self.store
+        if not 0 <= column < store.width:
+            return QModelIndex()
+        if not parent.isValid():
+            if 0 <= row < store.rows:
+                return self.createIndex(row, column, 0)
+            return QModelIndex()
+        if parent.internalId() == 0 and parent.column() == 0:
+            if 0 <= row < len(store.history[parent.row()]):
+                return self.createIndex(row, column, parent.row() + 1)
+        return QModelIndex()
+
+    def parent(self, index=None):
+        """ The top level row of a history row. """
+        if index is None:
+            return super().parent()
+        if not index.isValid() or index.internalId() == 0:
+            return QModelIndex()
+        return self.createIndex(index.internalId() - 1, 0, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        """ Top level rows, or the history of a top level row. """
+        if not parent.isValid():
+            return self.store.rows
+        if parent.internalId() == 0 and parent.column() == 0:
+            return len(self.store.history[parent.row()])
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        """ All rows have the same columns. """
+        return self.store.width
+
+    def data(self, index, role=Qt.DisplayRole):
+        """ Cell text, sort value or background. """
+        if not index.isValid():
+            return None
+        row, column = index.row(), index.column()
+        parent_id = index.internalId()
+        if role in (Qt.DisplayRole, Qt.UserRole):
+            if parent_id:
+                values = self.store.history[parent_id - 1][row]
+                value = values[column] if column < len(values) else None
+                if role == Qt.DisplayRole and column in self.store.numeric:
+                    return format_number(value) if value is not None else None
+                return value
+            if role == Qt.DisplayRole:
+                return self.store.text(row, column)
+            return self.store.value(row, column)
+        if role == Qt.BackgroundRole and not parent_id:
+            animator = self.animated_rows.get(row)
+            if animator is not None:
+                return animator.background(column, self.shown_frame)
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        """ Aggregated columns are named, the others and rows are numbered
+        from one. """
+        if role == Qt.DisplayRole:
+            if orientation == Qt.Horizontal:
+                return header_name(self.headers, section)
+            return str(section + 1)
+        return None
+
+    # StoreListener interface
+
+    def begin_insert_rows(self, first, last):
+        """ Start appending top level rows. """
+        self.beginInsertRows(QModelIndex(), first, last)
+
+    def end_insert_rows(self):
+        """ Finish appending top level rows. """
+        self.endInsertRows()
+
+    def begin_remove_rows(self, first, last):
+        """ Start removing the last top level rows, forgetting their
+        animations. """
+        self.beginRemoveRows(QModelIndex(), first, last)
+        for row in range(first, last + 1):
+            self.animated_rows.pop(row, None)
+            self.changed.pop(row, None)
+
+    def end_remove_rows(self):
+        """ Finish removing top level rows. """
+        self.endRemoveRows()
+
+    def rows_moved(self, moves):
+        """ Move the animations of moved rows, forgetting those of the
+        evicted rows they replace. """
+        animated_rows = self.animated_rows
+        changed = self.changed
+        for source, destination in moves:
+            animator = animated_rows.pop(source, None)
+            animated_rows.pop(destination, None)
+            if animator is not None:
+                animator.row = destination
+                animated_rows[destination] = animator
+            span = changed.pop(source, None)
+            changed.pop(destination, None)
+            if span is not None:
+                changed[destination] = span
+
+    def begin_insert_history(self, row, first, last):
+        """ Start adding history rows under a top level row. """
+        self.beginInsertRows(self.index(row, 0), first, last)
+
+    def end_insert_history(self):
+        """ Finish adding history rows. """
+        self.endInsertRows()
+
+    def begin_remove_history(self, row, first, last):
+        """ Start removing history rows from a top level row. """
+        self.beginRemoveRows(self.index(row, 0), first, last)
+
+    def end_remove_history(self):
+        """ Finish removing history rows. """
+        self.endRemoveRows()
+
+    def begin_insert_columns(self, first, last):
+        """ Start adding columns. """
+        self.beginInsertColumns(QModelIndex(), first, last)
+
+    def end_insert_columns(self):
+        """ Finish adding columns. """
+        self.endInsertColumns()
+
+    def cells_changed(self, spans):
+        """ Announce changed cells. """
+        self.emit_changed(spans)
+
+    # Report
+
+    def apply(self, groups, numeric=(), headers=()):
+        """ Apply a batch of (row_key, rows) groups from the aggregator and
+        start the animation of the new and updated rows. When the report is
+        empty the columns listed in numeric are set to be stored as numbers
+        and the first columns to be named by headers. """
+        if not self.store.width:
+            self.store.numeric = frozenset(numeric)
+            self.headers = list(headers)
+        first_new_row, blinks = self.store.apply(groups)
+        width = self.store.width
+        for row in range(first_new_row, self.store.rows):
+            self.animate(RowAnimator(row, width, self.frame, True))
+        for row, blink_columns in blinks.items():
+            self.animate(RowAnimator(row, width, self.frame, False,
+                                     blink_columns))
+
+    def refresh(self, values):
+        """ Set the refreshed windowed values from the aggregator. """
+        self.store.refresh(values)
+
+    def emit_changed(self, spans, roles=()):
+        """ Emit one dataChanged for each run of consecutive rows sharing the
+        same (first, last) column span. """
+        run = None
+        for row in sorted(spans):
+            if run and row == run[1] + 1 and spans[row] == run[2]:
+                run[1] = row
+                continue
+            if run:
+                self.emit_run(run, roles)
+            run = [row, row, spans[row]]
+        if run:
+            self.emit_run(run, roles)
+
+    def emit_run(self, run, roles):
+        """ Emit dataChanged for a [first row, last row, span] run. """
+        first_row, last_row, (first_column, last_column) = run
+        self.dataChanged.emit(self.index(first_row, first_column),
+                              self.index(last_row, last_column), list(roles))
 
     def animate(self, animator):
-        """ Ensure there is only one animation per cell. """
-        key = f'{animator.row}x{animator.column}'
-        self.animated_cells[key] = animator
+        """ Ensure there is only one animation per row and schedule the
+        frames in which its colours change. """
+        row = animator.row
+        self.animated_rows[row] = animator
+        self.changed[row] = (0, animator.columns - 1)
+        if animator.blink_mask:
+            self.wheel.schedule(animator.start_frame + 1, animator)
+        self.wheel.schedule(animator.remove_frame, animator)
+        self.waiting.append(animator)
 
-    def clear(self):
-        """ Reset the report and empty all previous data. """
-        super().clear()
-        self.animated_cells = {}
-        self.row_index = {}
+    def expire_waiting(self):
+        """ Data arrived so bring forward the removal of the rows animated
+        by earlier data. """
+        waiting = []
+        for animator in self.waiting:
+            if animator.start_frame == self.frame:
+                waiting.append(animator)
+            elif self.animated_rows.get(animator.row) is animator:
+                self.wheel.schedule(animator.expire(self.frame), animator)
+        self.waiting = waiting
+
+    def advance_animation(self):
+        """ Note the rows whose colours change in this frame. """
+        frame = self.frame
+        for animator in self.wheel.advance(frame):
+            row = animator.row
+            if self.animated_rows.get(row) is not animator:
+                continue
+            if frame == animator.remove_frame:
+                self.changed[row] = (0, animator.columns - 1)
+                del self.animated_rows[row]
+                continue
+            step = frame - animator.start_frame
+            if step <= len(animator.UPDATED_COLOUR):
+                self.changed[row] = animator.blink_span()
+                if step < len(animator.UPDATED_COLOUR):
+                    self.wheel.schedule(frame + 1, animator)
+
+    def clear(self, aggregations=True):
+        """ Reset the report and empty all previous data, including the
+        aggregation state unless aggregations is False, as when a new
+        tabulator generation starts fresh aggregations anyway. """
+        self.beginResetModel()
+        self.store.clear()
+        self.endResetModel()
+        if aggregations and self.aggregator is not None:
+            self.aggregator.clear()
+        self.headers = []
+        self.animated_rows = {}
+        self.wheel = TimingWheel(RowAnimator.LIFETIME + 1)
+        self.waiting = []
+        self.changed = {}
         self.frame = 0
-        self.last_data_frame = 0
+        self.shown_frame = 0
+
+    def forget(self, keys):
+        """ Drop the aggregation state of the evicted keys. """
+        if self.aggregator is not None:
+            self.aggregator.forget(keys)
 
     def update(self):
         """ Update the report by updating the aggregator. """
         table = self.aggregator.update(self)
+        self.store.evict()
 
-        if table['rows']:
-            self.last_data_frame = self.frame
-        animation_complete = [k for (k, v) in self.animated_cells.items()
-                              if v.animate(self, self.frame, self.last_data_frame)]
-        for key in animation_complete:
-            del self.animated_cells[key]
+        with STATS.timer('animate'):
+            if table['rows']:
+                self.expire_waiting()
+            self.advance_animation()
+            self.shown_frame = self.frame
+            self.emit_changed(self.changed, [Qt.BackgroundRole])
+            self.changed = {}
         self.frame += 1
+        STATS.gauge('animated', len(self.animated_rows))
+        STATS.gauge('report rows', self.store.rows)
 
         return table
@@ -0,0 +1,333 @@
+""" Several input streams multiplexed into one without a thread per source.
+
+Files, FIFOs, stdin and UDP and TCP sockets are watched with a selector,
+regular files, which cannot be selected, are polled. Each source keeps its
+own partial record so only whole records leave it, framed with the name of
+the source. Framed chunks can then be interleaved, kept in the replay
+history and captured like any other input.
+"""
+import os
+import selectors
+import socket
+import stat
+import struct
+import sys
+
+FRAME_MARK = b'\x00SRC'
+FRAME = struct.Struct('<4sHI')
+
+
+def frame(name, payload):
+    """ Frame whole records read from the source called name. """
+    return FRAME.pack(FRAME_MARK, len(name), len(payload)) + name + payload
+
+
+def unframe(byte_string):
+    """ Yield (source name, records payload) of each frame in byte_string. """
+    offset = 0
+    with memoryview(byte_string) as view:
+        while offset < len(byte_string):
+            _, name_size, size = FRAME.unpack_from(byte_string, offset)
+            offset += FRAME.size
+            name = str(view[offset:offset + name_size], 'utf-8')
+            offset += name_size
+            yield name, view[offset:offset + size].tobytes()
+            offset += size
+
+
+class Source():
+    """ A named input keeping the partial record left by its last read. """
+    selectable = True
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.encoded_name = name.encode('utf-8')
+        self.partial = bytearray()
+        self.closed = False
+
+    def fileno(self):
+        """ The descriptor watched by the selector. """
+        raise NotImplementedError
+
+    def receive(self, size):
+        """ Return up to size bytes, b'' at the end of the input or None if
+        nothing is available now. """
+        raise NotImplementedError
+
+    def records(self, data, delimiter):
+        """ Return the whole records of the partial record followed by data,
+        keeping the rest as the new partial record. """
+        end = data.rfind(delimiter)
+        if end < 0:
+            self.partial += data
+            return b''
+        end += len(delimiter)
+        if self.partial:
+            complete = bytes(self.partial) + data[:end]
+            self.partial.clear()
+        else:
+            complete = data[:end]
+        self.partial += data[end:]
+        return complete
+
+    def finish(self, delimiter):
+        """ Return the partial record as a whole record at the end of the
+        input. """
+        complete = b''
+        if self.partial:
+            complete = bytes(self.partial) + delimiter
+            self.partial.clear()
+        return complete
+
+    def close(self):
+        """ Stop reading the source. """
+        self.closed = True
+
+
+class StreamSource(Source):
+    """ A source read from a file descriptor. """
+
+    def __init__(self, name, fd):
+        super().__init__(name)
+        self.fd = fd
+        os.set_blocking(fd, False)
+
+    def fileno(self):
+        return self.fd
+
+    def receive(self, size):
+        try:
+            return os.read(self.fd, size)
+        except BlockingIOError:
+            return None
+
+    def close(self):
+        super().close()
+        if self.fd > 2:
+            os.close(self.fd)
+
+
+class FileSource(StreamSource):
+    """ A regular file, polled because files are always readable. When
+    follow is set the file is tailed, reopening it if it is replaced or
+    truncated, rather than ending with its last byte. """
+    selectable = False
+
+    def __init__(self, name, path, follow=False):
+        super().__init__(name, os.open(path, os.O_RDONLY))
+        self.path = path
+        self.follow = follow
+        self.inode = os.fstat(self.fd).st_ino
+        if follow:
+            os.lseek(self.fd, 0, os.SEEK_END)
+
+    def receive(self, size):
+        data = os.read(self.fd, size)
+        if data or not self.follow:
+            return data
+        try:
+            status = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        if (status.st_ino != self.inode
+                or status.st_size < os.lseek(self.fd, 0, os.SEEK_CUR)):
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_RDONLY)
+            self.inode = os.fstat(self.fd).st_ino
+        return None
+
+
+class FifoSource(StreamSource):
+    """ A named pipe, opened for writing as well so that it stays open when
+    its writers come and go instead of repeatedly reading its end. """
+
+    def __init__(self, name, path):
+        super().__init__(name, os.open(path, os.O_RDWR | os.O_NONBLOCK))
+
+
+class UdpSource(Source):
+    """ A datagram socket, each datagram holding whole records. """
+
+    def __init__(self, name, address):
+        super().__init__(name)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.socket.setblocking(False)
+        self.delimiter = b'\n'
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def receive(self, size):
+        datagrams = []
+        received = 0
+        while received < size:
+            try:
+                datagram = self.socket.recv(65535)
+            except BlockingIOError:
+                break
+            if not datagram.endswith(self.delimiter):
+                datagram += self.delimiter
+            datagrams.append(datagram)
+            received += len(datagram)
+        return b''.join(datagrams) if datagrams else None
+
+    def records(self, data, delimiter):
+        self.delimiter = delimiter
+        return super().records(data, delimiter)
+
+    def close(self):
+        super().close()
+        self.socket.close()
+
+
+class TcpConnection(Source):
+    """ An accepted connection with its own partial record. """
+
+    def __init__(self, name, connection):
+        super().__init__(name)
+        self.socket = connection
+        self.socket.setblocking(False)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def receive(self, size):
+        try:
+            return self.socket.recv(size)
+        except BlockingIOError:
+            return None
+        except ConnectionError:
+            return b''
+
+    def close(self):
+        super().close()
+        self.socket.close()
+
+
+class TcpSource(Source):
+    """ A listening socket whose connections become sources of the same
+    name. """
+
+    def __init__(self, name, address):
+        super().__init__(name)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen()
+        self.socket.setblocking(False)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def accept(self):
+        """ Return a source for a waiting connection or None. """
+        try:
+            connection, _ = self.socket.accept()
+        except BlockingIOError:
+            return None
+        return TcpConnection(self.name, connection)
+
+    def close(self):
+        super().close()
+        self.socket.close()
+
+
+def address(spec):
+    """ The (host, port) of a HOST:PORT or :PORT spec. """
+    host, _, port = spec.rpartition(':')
+    return (host or '0.0.0.0', int(port))
+
+
+def open_source(spec):
+    """ Open the source described by spec, which is - for stdin, udp:ADDRESS
+    or tcp:ADDRESS to listen on a socket, tail:PATH to follow a file or the
+    path of a file or FIFO. """
+    kind, _, rest = spec.partition(':')
+    if spec == '-':
+        return StreamSource('stdin', sys.stdin.fileno())
+    if kind == 'udp':
+        return UdpSource(spec, address(rest))
+    if kind == 'tcp':
+        return TcpSource(spec, address(rest))
+    if kind == 'tail':
+        return FileSource(rest, rest, follow=True)
+    if stat.S_ISFIFO(os.stat(spec).st_mode):
+        return FifoSource(spec, spec)
+    return FileSource(spec, spec)
+
+
+class Inputs():
+    """ Reads the available data of many sources through one selector,
+    returning the whole records of each source framed with its name. At
+    most max_bytes are read per call, pending is set when data was left
+    unread because of that and eof once every source has ended. """
+
+    def __init__(self, specs, max_bytes=16 * 2**20, read_size=65536):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.read_size = read_size
+        self.selector = selectors.DefaultSelector()
+        self.polled = []
+        self.sources = []
+        self.pending = False
+        self.eof = False
+        for spec in specs:
+            self.add(open_source(spec))
+
+    def add(self, source):
+        """ Watch a source, polling it if it cannot be selected. """
+        self.sources.append(source)
+        if source.selectable:
+            self.selector.register(source, selectors.EVENT_READ)
+        else:
+            self.polled.append(source)
+
+    def remove(self, source):
+        """ Stop watching a source and close it. """
+        self.sources.remove(source)
+        if source.selectable:
+            self.selector.unregister(source)
+        else:
+            self.polled.remove(source)
+        source.close()
+        self.eof = not self.sources
+
+    def read(self, delimiter=b'\n'):
+        """ Read all available data up to max_bytes returning framed whole
+        records, which are empty if no record was completed. """
+        frames = []
+        size = 0
+        self.pending = False
+        ready = [key.fileobj for key, _ in self.selector.select(0)]
+        for source in ready + self.polled:
+            if isinstance(source, TcpSource):
+                connection = source.accept()
+                if connection is not None:
+                    self.add(connection)
+                continue
+            data = None
+            while size < self.max_bytes:
+                data = source.receive(min(self.read_size,
+                                          self.max_bytes - size))
+                if not data:
+                    break
+                size += len(data)
+                complete = source.records(data, delimiter)
+                if complete:
+                    frames.append(frame(source.encoded_name, complete))
+            else:
+                self.pending = True
+            if data == b'':
+                complete = source.finish(delimiter)
+                if complete:
+                    frames.append(frame(source.encoded_name, complete))
+                self.remove(source)
+        return b''.join(frames)
+
+    def close(self):
+        """ Close every source. """
+        for source in list(self.sources):
+            self.remove(source)
+        self.selector.close()
@@ -0,0 +1,115 @@
+""" Lightweight timers and counters for the stages of the pipeline. """
+import json
+import threading
+import time
+
+
+class NullTimer():
+    """ Times nothing, used while statistics are disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+
+class StageTimer():
+    """ Adds the time spent in a with block to a stage. """
+
+    def __init__(self, stats, stage):
+        super().__init__()
+        self.stats = stats
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.stats.add_time(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Stats():
+    """ Per tick stage times, counters and gauges collected from the ingest
+    and GUI threads. Each tick the totals become the last tick's values and
+    are optionally written to a JSONL file. While disabled timing costs an
+    attribute check and the stages record nothing. """
+    NULL_TIMER = NullTimer()
+
+    def __init__(self):
+        super().__init__()
+        self.enabled = False
+        self.dump = None
+        self.lock = threading.Lock()
+        self.ticks = 0
+        self.reset()
+        self.last = {'seconds': {}, 'counts': {}, 'gauges': {}}
+
+    def reset(self):
+        """ Start a new tick. """
+        self.seconds = {}
+        self.counts = {}
+        self.gauges = {}
+
+    def enable(self, enabled=True, dump=None):
+        """ Turn collection on or off, writing a JSON object per tick to the
+        dump file if one is given. """
+        with self.lock:
+            self.enabled = enabled
+            if dump is not None:
+                self.dump = dump
+            self.reset()
+
+    def timer(self, stage):
+        """ A context manager adding the time of its block to stage. """
+        if not self.enabled:
+            return self.NULL_TIMER
+        return StageTimer(self, stage)
+
+    def add_time(self, stage, seconds):
+        """ Add seconds spent in stage. """
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def count(self, name, amount):
+        """ Add amount to a counter. """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        """ Set the current value of a gauge. """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name] = value
+
+    def tick(self):
+        """ End a tick, keeping its values as the last and dumping them. """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.ticks += 1
+            self.last = {'tick': self.ticks, 'time': time.time(),
+                         'seconds': self.seconds, 'counts': self.counts,
+                         'gauges': self.gauges}
+            self.reset()
+        if self.dump is not None:
+            self.dump.write(json.dumps(self.last) + '\n')
+
+    def summary(self):
+        """ The last tick as short text for the status bar. """
+        last = self.last
+        parts = [f'{stage} {seconds * 1000:.1f}ms'
+                 for stage, seconds in last['seconds'].items()]
+        parts += [f'{name} {value}' for name, value in last['counts'].items()]
+        parts += [f'{name} {value}' for name, value in last['gauges'].items()]
+        return '  '.join(parts)
+
+
+# The statistics shared by the whole application
+STATS = Stats()
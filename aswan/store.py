@@ -0,0 +1,565 @@
+""" Qt free columnar storage of the aggregated report. """
+import collections
+import heapq
+import itertools
+import math
+import sys
+import time
+from array import array
+
+
+class StoreListener():
+    """ Told about changes to a ColumnStore so that a view of it can follow
+    them. The methods mirror the notifications of a Qt item model and do
+    nothing by default. """
+
+    def begin_insert_rows(self, first, last):
+        """ Rows first to last are about to be appended. """
+
+    def end_insert_rows(self):
+        """ The rows have been appended. """
+
+    def begin_remove_rows(self, first, last):
+        """ Rows first to last, the last rows, are about to be removed. """
+
+    def end_remove_rows(self):
+        """ The rows have been removed. """
+
+    def rows_moved(self, moves):
+        """ Each (source, destination) row was moved over an evicted row,
+        the sources are about to be removed. """
+
+    def begin_insert_history(self, row, first, last):
+        """ History rows first to last are about to be added to row. """
+
+    def end_insert_history(self):
+        """ The history rows have been added. """
+
+    def begin_remove_history(self, row, first, last):
+        """ History rows first to last of row are about to be removed. """
+
+    def end_remove_history(self):
+        """ The history rows have been removed. """
+
+    def begin_insert_columns(self, first, last):
+        """ Columns first to last are about to be added. """
+
+    def end_insert_columns(self):
+        """ The columns have been added. """
+
+    def cells_changed(self, spans):
+        """ Cells changed in the rows given as a dictionary of row to
+        (first column, last column). """
+
+
+def format_number(value):
+    """ Display text for a numeric cell. """
+    if math.isnan(value):
+        return None
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def header_name(headers, column):
+    """ Name of a column, aggregated columns are named by headers and the
+    others numbered from one. """
+    if column < len(headers):
+        return headers[column]
+    return str(column - len(headers) + 1)
+
+
+def same(old, new):
+    """ Compare cell values treating missing numbers as equal. """
+    return old == new or old != old and new != new
+
+
+def entry_size(entry):
+    """ Estimated bytes held by a history entry, strings are interned and
+    mostly shared with the columns so only the tuple and floats count. """
+    return sys.getsizeof(entry) + sum(24 for value in entry
+                                      if type(value) is float)
+
+
+class HistoryPolicy():
+    """ How much of each row's update history is kept. At most limit entries
+    are kept per row, the oldest dropped first, except the first update which
+    is never dropped when keep_first is set. Only every stride'th update is
+    recorded and with keep_last the latest update is shown as well until the
+    next one replaces it. budget caps the estimated bytes of all history by
+    clearing the history of the least recently updated rows. """
+
+    def __init__(self, limit=None, stride=1, keep_first=False, keep_last=True,
+                 budget=None):
+        super().__init__()
+        self.limit = limit
+        self.stride = max(stride, 1)
+        self.keep_first = keep_first
+        self.keep_last = keep_last
+        self.budget = budget
+
+
+class EvictionPolicy():
+    """ Which rows are evicted to bound the number of keys. Rows not updated
+    for ttl seconds are evicted and once there are more than max_rows the
+    least recently updated rows, or with order 'lfu' the least frequently
+    updated, are evicted until slack of max_rows is free again so that
+    evictions come in batches. """
+    ORDERS = ('lru', 'lfu')
+
+    def __init__(self, max_rows=None, order='lru', ttl=None, slack=0.05):
+        super().__init__()
+        if order not in self.ORDERS:
+            raise ValueError(f'Eviction order must be one of {self.ORDERS}')
+        self.max_rows = max_rows
+        self.order = order
+        self.ttl = ttl
+        self.slack = slack
+
+    @property
+    def enabled(self):
+        """ True if any rows can be evicted. """
+        return self.max_rows is not None or self.ttl is not None
+
+
+class History():
+    """ The update history of one row: the pinned first update, if any,
+    followed by a ring buffer of the latest entries. When provisional is set
+    the newest entry was kept only because it is the latest. """
+    __slots__ = ('pinned', 'ring', 'updates', 'provisional', 'nbytes')
+
+    def __init__(self, limit=None):
+        self.pinned = None
+        self.ring = collections.deque(maxlen=limit)
+        self.updates = 0
+        self.provisional = False
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.ring) + (self.pinned is not None)
+
+    def __getitem__(self, index):
+        if self.pinned is not None:
+            if index == 0:
+                return self.pinned
+            index -= 1
+        return self.ring[index]
+
+    def clear(self):
+        """ Forget the entries but not the count of updates. """
+        self.pinned = None
+        self.ring.clear()
+        self.provisional = False
+        self.nbytes = 0
+
+
+class ColumnStore():
+    """ The report rows stored by column. Text columns are lists of interned
+    strings, numeric columns are arrays of doubles with NaN for a missing
+    value. Each row keeps its updates as a History of tuples bounded by the
+    HistoryPolicy. Rows are evicted following the EvictionPolicy by moving
+    the last rows into the evicted rows and removing the end of the store,
+    so only the moved rows change position. forget, if given, is called with
+    the keys of the evicted rows. """
+
+    def __init__(self, listener=None, policy=None, eviction=None,
+                 forget=None):
+        super().__init__()
+        self.listener = listener or StoreListener()
+        self.policy = policy or HistoryPolicy()
+        self.eviction = eviction if eviction and eviction.enabled else None
+        self.forget = forget
+        self.numeric = frozenset()
+        self.clear()
+
+    def clear(self):
+        """ Remove all rows and columns. """
+        self.columns = []
+        self.row_index = {}
+        self.keys = []
+        self.touched = collections.OrderedDict()
+        self.hits = {}
+        self.history = []
+        self.history_bytes = 0
+        self.recently_updated = collections.OrderedDict()
+        self.rows = 0
+
+    @property
+    def width(self):
+        """ Number of columns. """
+        return len(self.columns)
+
+    def cell(self, column, value):
+        """ Convert a parsed field to its stored form. """
+        if column in self.numeric:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return math.nan
+        if type(value) is str:
+            return sys.intern(value)
+        return value
+
+    def value(self, row, column):
+        """ The stored value of a cell. """
+        return self.columns[column][row]
+
+    def text(self, row, column):
+        """ The display text of a cell. """
+        value = self.columns[column][row]
+        if column in self.numeric:
+            return format_number(value)
+        return value
+
+    def add_columns(self, width):
+        """ Grow the store to at least width columns. """
+        if width <= len(self.columns):
+            return
+        self.listener.begin_insert_columns(len(self.columns), width - 1)
+        for column in range(len(self.columns), width):
+            if column in self.numeric:
+                self.columns.append(array('d', [math.nan]) * self.rows)
+            else:
+                self.columns.append([None] * self.rows)
+        self.listener.end_insert_columns()
+
+    def apply(self, groups):
+        """ Apply a batch of (row_key, rows) groups. Rows with a new key are
+        appended in one block, the rest become updates whose history is
+        appended in one block per row. A row_key of None is a row without a
+        key that is always appended. Returns the first appended row and a
+        dictionary of updated row to the columns changed by its last
+        update. """
+        touched = None
+        if self.eviction is not None:
+            now = time.monotonic()
+            self.make_room(groups, now)
+            touched = self.touched
+            hits = self.hits
+        first_new_row = self.rows
+        new_rows = []
+        updates = {}
+        for row_key, rows in groups:
+            existing_row = (None if row_key is None
+                            else self.row_index.get(row_key))
+            created = existing_row is None
+            if created:
+                if row_key is None:
+                    # A row without a key is never updated
+                    row_key = object()
+                existing_row = first_new_row + len(new_rows)
+                self.row_index[row_key] = existing_row
+                self.keys.append(row_key)
+                new_rows.append(rows[0])
+            if touched is not None:
+                touched[row_key] = now
+                touched.move_to_end(row_key)
+                hits[row_key] = hits.get(row_key, 0) + len(rows)
+            if created:
+                rows = rows[1:]
+            if rows:
+                updates.setdefault(existing_row, []).extend(rows)
+
+        self.add_columns(max((len(row) for _, rows in groups for row in rows),
+                             default=0))
+        if new_rows:
+            self.append_rows(new_rows)
+        return first_new_row, self.update_rows(updates)
+
+    def refresh(self, values):
+        """ Set cells of existing rows without recording an update or
+        touching the rows for eviction. values maps a row key to (column,
+        value) pairs, keys no longer in the store are ignored. """
+        columns = self.columns
+        spans = {}
+        for row_key, cells in values.items():
+            row = self.row_index.get(row_key)
+            if row is None:
+                continue
+            span = None
+            for column, value in cells:
+                if column < len(columns):
+                    columns[column][row] = self.cell(column, value)
+                    span = ((column, column) if span is None else
+                            (min(span[0], column), max(span[1], column)))
+            if span is not None:
+                spans[row] = span
+        if spans:
+            self.listener.cells_changed(spans)
+
+    def make_room(self, groups, now):
+        """ Evict rows to make room for the new keys of groups, which are
+        not evicted themselves. """
+        keep = {row_key for row_key, _ in groups if row_key is not None}
+        new = (sum(1 for key in keep if key not in self.row_index)
+               + sum(1 for row_key, _ in groups if row_key is None))
+        self.evict(new, now, keep)
+
+    def evict(self, new=0, now=None, keep=frozenset()):
+        """ Evict the rows idle for longer than the ttl and, if the store
+        with new more rows would hold more than max_rows, enough rows to
+        leave slack free, never evicting the keys in the set keep. Returns
+        the number of rows evicted. """
+        policy = self.eviction
+        if policy is None:
+            return 0
+        touched = self.touched
+        victims = []
+        if policy.ttl is not None:
+            idle = (time.monotonic() if now is None else now) - policy.ttl
+            for key, last in touched.items():
+                if last > idle:
+                    break
+                if key not in keep:
+                    victims.append(key)
+        count = 0
+        if policy.max_rows is not None:
+            count = self.rows - len(victims) + new - policy.max_rows
+            if count > 0:
+                count += int(policy.max_rows * policy.slack)
+        if count > 0:
+            skip = keep.union(victims) if victims else keep
+            candidates = (key for key in touched if key not in skip)
+            if policy.order == 'lfu':
+                victims += heapq.nsmallest(count, candidates,
+                                           key=self.hits.__getitem__)
+            else:
+                victims += itertools.islice(candidates, count)
+        if victims:
+            self.remove_rows(sorted(self.row_index[key] for key in victims))
+            if self.forget is not None:
+                self.forget(victims)
+        return len(victims)
+
+    def remove_rows(self, rows):
+        """ Remove the sorted rows by moving the last surviving rows over
+        the evicted rows before them and removing the end of the store in
+        one block, in time proportional to the number of rows removed. """
+        listener = self.listener
+        end = self.rows - len(rows)
+        evicted = set(rows)
+        for row in rows:
+            key = self.keys[row]
+            del self.row_index[key]
+            del self.touched[key]
+            self.hits.pop(key, None)
+            self.recently_updated.pop(key, None)
+            self.history_bytes -= self.history[row].nbytes
+        holes = [row for row in rows if row < end]
+        sources = [row for row in range(end, self.rows) if row not in evicted]
+        moves = list(zip(sources, holes))
+        for source, hole in moves:
+            history = self.history[hole]
+            if len(history):
+                listener.begin_remove_history(hole, 0, len(history) - 1)
+                history.clear()
+                listener.end_remove_history()
+            history = self.history[source]
+            if len(history):
+                listener.begin_remove_history(source, 0, len(history) - 1)
+                self.history[source] = History(self.policy.limit)
+                listener.end_remove_history()
+            for values in self.columns:
+                values[hole] = values[source]
+            key = self.keys[source]
+            self.keys[hole] = key
+            self.row_index[key] = hole
+            if len(history):
+                listener.begin_insert_history(hole, 0, len(history) - 1)
+            self.history[hole] = history
+            if len(history):
+                listener.end_insert_history()
+        if moves:
+            width = len(self.columns)
+            listener.cells_changed({hole: (0, width - 1)
+                                    for _, hole in moves})
+            listener.rows_moved(moves)
+        listener.begin_remove_rows(end, self.rows - 1)
+        for values in self.columns:
+            del values[end:]
+        del self.history[end:]
+        del self.keys[end:]
+        self.rows = end
+        listener.end_remove_rows()
+
+    def append_rows(self, rows):
+        """ Append rows to the store. """
+        first = self.rows
+        self.listener.begin_insert_rows(first, first + len(rows) - 1)
+        for column, values in enumerate(self.columns):
+            values.extend(self.cell(column, row[column])
+                          if column < len(row) else self.cell(column, None)
+                          for row in rows)
+        self.history.extend(History(self.policy.limit) for _ in rows)
+        self.rows += len(rows)
+        self.listener.end_insert_rows()
+
+    def update_rows(self, updates):
+        """ Record the updates of existing rows in their history and set each
+        cell to its final value. """
+        changed_spans = {}
+        blinks = {}
+        for existing_row, rows in updates.items():
+            self.record_history(existing_row, rows)
+
+            old_data = [values[existing_row] for values in self.columns]
+            previous = current = old_data
+            for row in rows:
+                previous = current
+                current = [self.cell(column, row[column]) if column < len(row)
+                           else self.cell(column, None)
+                           for column in range(len(self.columns))]
+            changed = [column for column in range(len(self.columns))
+                       if not same(old_data[column], current[column])]
+            for column in changed:
+                self.columns[column][existing_row] = current[column]
+            if changed:
+                changed_spans[existing_row] = (changed[0], changed[-1])
+            blinks[existing_row] = [
+                column for column in range(len(self.columns))
+                if not same(previous[column], current[column])]
+        if changed_spans:
+            self.listener.cells_changed(changed_spans)
+        self.enforce_budget()
+        return blinks
+
+    def record_history(self, row, rows):
+        """ Add the updates of a row to its history following the policy,
+        announcing the history rows removed and added. """
+        policy = self.policy
+        history = self.history[row]
+        pinned = None
+        entries = []
+        drop_tail = False
+        provisional = history.provisional
+        for update in rows:
+            count = history.updates
+            history.updates += 1
+            entry = tuple(self.cell(column, value)
+                          for column, value in enumerate(update))
+            if policy.keep_first and history.pinned is None and count == 0:
+                pinned = entry
+                continue
+            on_stride = count % policy.stride == 0
+            if not on_stride and not policy.keep_last:
+                continue
+            if provisional:
+                if entries:
+                    entries.pop()
+                else:
+                    drop_tail = True
+            entries.append(entry)
+            provisional = not on_stride
+        history.provisional = provisional
+
+        kept = len(history.ring) - drop_tail
+        if policy.limit is not None:
+            entries = entries[max(len(entries) - policy.limit, 0):]
+            drop_head = max(kept + len(entries) - policy.limit, 0)
+        else:
+            drop_head = 0
+        offset = history.pinned is not None
+        if drop_tail and drop_head < kept:
+            self.remove_history(row, len(history) - 1, 1)
+            drop_tail = False
+        if drop_head or drop_tail:
+            self.remove_history(row, offset, drop_head + drop_tail)
+
+        added = entries if pinned is None else [pinned] + entries
+        if not added:
+            return
+        first = len(history)
+        self.listener.begin_insert_history(row, first, first + len(added) - 1)
+        if pinned is not None:
+            history.pinned = pinned
+        history.ring.extend(entries)
+        self.listener.end_insert_history()
+        nbytes = sum(entry_size(entry) for entry in added)
+        history.nbytes += nbytes
+        self.history_bytes += nbytes
+        key = self.keys[row]
+        self.recently_updated[key] = None
+        self.recently_updated.move_to_end(key)
+
+    def remove_history(self, row, first, count):
+        """ Remove count history rows of row starting at first, where first
+        is the last row or the first row of the ring. """
+        history = self.history[row]
+        self.listener.begin_remove_history(row, first, first + count - 1)
+        ring = history.ring
+        if first == len(history) - 1 and count == 1:
+            removed = [ring.pop()]
+        else:
+            removed = [ring.popleft() for _ in range(count)]
+        self.listener.end_remove_history()
+        nbytes = sum(entry_size(entry) for entry in removed)
+        history.nbytes -= nbytes
+        self.history_bytes -= nbytes
+
+    def enforce_budget(self):
+        """ Clear the history of the least recently updated rows until the
+        history fits the budget, always keeping the latest row's. """
+        budget = self.policy.budget
+        if budget is None:
+            return
+        while self.history_bytes > budget and len(self.recently_updated) > 1:
+            key, _ = self.recently_updated.popitem(last=False)
+            row = self.row_index[key]
+            history = self.history[row]
+            if not len(history):
+                continue
+            self.listener.begin_remove_history(row, 0, len(history) - 1)
+            self.history_bytes -= history.nbytes
+            history.clear()
+            self.listener.end_remove_history()
+
+
+class StoreModel():
+    """ The model interface the aggregator updates, backed by a ColumnStore
+    without Qt. Report implements the same interface as a Qt item model, this
+    one serves headless runs and benchmarks. """
+
+    def __init__(self, aggregator, history_policy=None, eviction_policy=None):
+        super().__init__()
+        self.aggregator = aggregator
+        self.store = ColumnStore(policy=history_policy,
+                                 eviction=eviction_policy,
+                                 forget=self.forget)
+        self.headers = []
+
+    def apply(self, groups, numeric=(), headers=()):
+        """ Apply a batch of (row_key, rows) groups from the aggregator. When
+        the model is empty the columns listed in numeric are set to be stored
+        as numbers and the first columns to be named by headers. """
+        if not self.store.width:
+            self.store.numeric = frozenset(numeric)
+            self.headers = list(headers)
+        self.store.apply(groups)
+
+    def refresh(self, values):
+        """ Set the refreshed windowed values from the aggregator. """
+        self.store.refresh(values)
+
+    def clear(self, aggregations=True):
+        """ Empty all previous data, including the aggregation state unless
+        aggregations is False. """
+        self.store.clear()
+        self.headers = []
+        if aggregations and self.aggregator is not None:
+            self.aggregator.clear()
+
+    def forget(self, keys):
+        """ Drop the aggregation state of the evicted keys. """
+        if self.aggregator is not None:
+            self.aggregator.forget(keys)
+
+    def update(self):
+        """ Update the model by updating the aggregator and evicting the rows
+        that have been idle too long. """
+        table = self.aggregator.update(self)
+        self.store.evict()
+        return table
+
+    def header(self, column):
+        """ Name of a column. """
+        return header_name(self.headers, column)
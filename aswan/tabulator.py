@@ -1,17 +1,36 @@
 """ Code to convert incoming buffer to table """
+import functools
+import json
+import os
+import re
+import threading
+import time
+from aggregator import key_function
+from capture import CaptureWriter
+from history import ChunkHistory, HistoryCursor, RecordCache
+from parallel import ParallelParser
+from sources import Inputs, unframe
+from stats import STATS
 import utils
 
 
 class FixedKeyColumn():
-    """ Metadata for a single key at static position. """
+    """ Metadata for the key, the columns that hold numbers and the
+    aggregations computed per key. The key is a column, a dict computing a
+    key from a column, a list of these for a composite key or None when rows
+    are not grouped. """
 
     def __init__(self):
         super().__init__()
 
         # Defaults
-        self.key = 0
+        self.key = None
+        self.numeric = []
+        self.aggregate = []
 
-        self.get_metadata = lambda rows: {'key': self.key}
+        self.get_metadata = lambda rows: {'key': self.key,
+                                          'numeric': self.numeric,
+                                          'aggregate': self.aggregate}
 
 
 class DelimitedTextRecordParser():
@@ -23,10 +42,12 @@ class DelimitedTextRecordParser():
         # Defaults
         self.encoding = 'utf-8'
         self.record_delimiter = '\n'
+        self.record_filter = None
 
-        self.read_available_bytes = utils.read_available_bytes
-        self.parse_records = lambda buffer: utils.bytes_to_unicode_records(
-            buffer, self.record_delimiter, self.encoding)
+        self.reader = utils.ByteReader()
+        self.read_available_bytes = self.reader.read
+        self.parse_records = lambda buffer, byte_string: utils.split_records(
+            buffer, byte_string, self.record_delimiter, self.encoding)
 
 
 class DelimitedTextFieldParser(DelimitedTextRecordParser, FixedKeyColumn):
@@ -37,7 +58,7 @@ class DelimitedTextFieldParser(DelimitedTextRecordParser, FixedKeyColumn):
 
         # Defaults
         self.field_delimiter = '\t'
-        self.key = 0
+        self.key = None
 
         self.parse_fields = lambda record: record.split(self.field_delimiter)
 
@@ -107,50 +128,605 @@ class WeblogConfig(DelimitedTextRecordParser, FixedKeyColumn):
         self.parse_fields = field_parser
 
 
+def join_source(separator, parts, field, size=0):
+    """ Source for a single part or a join of a slice of parts. A slice that
+    ends within the first size parts, which are known to exist, is joined
+    by concatenation. """
+    if isinstance(field, int):
+        return f'{parts}[{field}]'
+    start, end = field
+    if start is not None and end is not None and start < end <= size:
+        return f' + {separator!r} + '.join(f'{parts}[{index}]'
+                                            for index in range(start, end))
+    start, end = ('' if i is None else i for i in field)
+    return f'{separator!r}.join({parts}[{start}:{end}])'
+
+
+def parts_needed(fields):
+    """ The number of parts a record must split into for the single parts
+    of fields to exist, slices being empty when they are past the end. """
+    return max((field + 1 for field in fields if isinstance(field, int)),
+               default=0)
+
+
+def split_limit(separator, fields):
+    """ The maxsplit for fields whose last joins the parts from some start
+    to the end, which leaves that tail whole rather than split and joined
+    again, or -1 when other fields reach into the tail or the separator is
+    whitespace. """
+    if not isinstance(separator, str) or not fields:
+        return -1
+    tail = fields[-1]
+    if (not isinstance(tail, list) or tail[1] is not None
+            or not isinstance(tail[0], int) or tail[0] <= 0):
+        return -1
+    for field in fields[:-1]:
+        if isinstance(field, dict):
+            field = field['part']
+        if isinstance(field, int):
+            if not 0 <= field < tail[0]:
+                return -1
+        elif not all(index is not None and 0 <= index <= tail[0]
+                     for index in field):
+            return -1
+    return tail[0]
+
+
+def split_source(text, separator, limit):
+    """ Source splitting text on separator at most limit times, or on every
+    separator when limit is -1. """
+    if limit < 0:
+        return f'{text}.split({separator!r})'
+    return f'{text}.split({separator!r}, {limit})'
+
+
+def field_source(separator, parts, field, size, limit):
+    """ Source for a field of parts split at most limit times, the tail of
+    a limited split being its last part or empty when it is missing. """
+    if limit >= 0 and field == [limit, None]:
+        return f'({parts}[{limit}] if len({parts}) > {limit} else "")'
+    return join_source(separator, parts, field, size)
+
+
+def split_parser(alternatives):
+    """ Compile split alternatives into a parser function. Each alternative
+    splits the record on a separator and, when the number of parts matches,
+    builds fields from parts, joined slices of parts or the same taken from
+    a part split again. The generated code checks the lengths of the splits
+    instead of catching IndexError so that a record too short for one
+    alternative is tried with the next. A trailing slice to the end is
+    left unsplit when split_limit allows. Records that do not fit any
+    alternative give None. """
+    lines = ['def parse_fields(record):']
+    for alternative in alternatives:
+        separator = alternative['separator']
+        subsplits = {}
+        for field in alternative['fields']:
+            if isinstance(field, dict):
+                subsplits.setdefault((field['part'], field['separator']),
+                                     []).append(field['field'])
+        names = {split: f'part{number}'
+                 for number, split in enumerate(subsplits)}
+        needed = {split: parts_needed(fields)
+                  for split, fields in subsplits.items()}
+        limits = {split: split_limit(split[1], fields)
+                  for split, fields in subsplits.items()}
+        size = max([parts_needed(alternative['fields'])]
+                   + [part + 1 for part, _ in subsplits])
+        limit = -1
+        if 'parts' not in alternative:
+            limit = split_limit(separator, alternative['fields'])
+        fields = []
+        for field in alternative['fields']:
+            if isinstance(field, dict):
+                split = (field['part'], field['separator'])
+                fields.append(field_source(field['separator'], names[split],
+                                           field['field'], needed[split],
+                                           limits[split]))
+            else:
+                fields.append(field_source(separator, 'parts', field, size,
+                                           limit))
+        lines.append(f'    parts = {split_source("record", separator, limit)}')
+        indent = '    '
+        if 'parts' in alternative:
+            if alternative['parts'] < size:
+                continue
+            lines.append(f'{indent}if len(parts) == {alternative["parts"]}:')
+            indent += '    '
+        elif size > 1:
+            lines.append(f'{indent}if len(parts) >= {size}:')
+            indent += '    '
+        lines += [f'{indent}{name} = '
+                  f'{split_source(f"parts[{part}]", sep, limits[part, sep])}'
+                  for (part, sep), name in names.items()]
+        checks = [f'len({names[split]}) >= {needed[split]}'
+                  for split in subsplits if needed[split] > 1]
+        if checks:
+            lines.append(f'{indent}if {" and ".join(checks)}:')
+            indent += '    '
+        lines.append(f'{indent}return [{", ".join(fields)}]')
+    lines.append('    return None')
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['parse_fields']
+
+
+def fixed_parser(columns):
+    """ Compile [start, end] character columns into a parser function. """
+    fields = ', '.join(join_source('', 'record', column) for column in columns)
+    namespace = {}
+    exec(f'def parse_fields(record):\n    return [{fields}]', namespace)
+    return namespace['parse_fields']
+
+
+def regex_parser(patterns):
+    """ Compile patterns that must match a whole record into a parser
+    function returning the groups of the first that matches. """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    matchers = [re.compile(pattern).fullmatch for pattern in patterns]
+
+    def parse_fields(record):
+        for fullmatch in matchers:
+            match = fullmatch(record)
+            if match:
+                return list(match.groups(''))
+        return None
+    return parse_fields
+
+
+def record_filter(spec, encoding):
+    """ Compile the byte level part of a filter spec into a function
+    selecting the raw records that contain any of the "contains" strings and
+    match the "regex", or None when the spec has neither. """
+    conditions = []
+    namespace = {}
+    contains = spec.get('contains', [])
+    if isinstance(contains, str):
+        contains = [contains]
+    if contains:
+        conditions.append('(' + ' or '.join(
+            f'{text.encode(encoding)!r} in record' for text in contains) + ')')
+    if 'regex' in spec:
+        namespace['search'] = re.compile(spec['regex'].encode(encoding)).search
+        conditions.append('search(record)')
+    if not conditions:
+        return None
+    exec('def select(records):\n'
+         f'    return [record for record in records if {" and ".join(conditions)}]',
+         namespace)
+    return namespace['select']
+
+
+FIELD_TESTS = {'equals': '{field} == {value}',
+               'in': '{field} in {value}',
+               'startswith': '{field}.startswith({value})',
+               'endswith': '{field}.endswith({value})',
+               'contains': '{value} in {field}',
+               'regex': '{value}({field})',
+               'min': 'float({field}) >= {value}',
+               'max': 'float({field}) <= {value}'}
+
+
+def field_test(condition, number, namespace):
+    """ Source for one field condition such as {"column": 7, "startswith":
+    "5"}, all of whose tests must pass unless "not" is set. """
+    field = f'fields[{condition["column"]}]'
+    tests = []
+    for name, value in condition.items():
+        if name in ('column', 'not'):
+            continue
+        if name not in FIELD_TESTS:
+            raise Exception(f'Unknown filter test "{name}", use one of {list(FIELD_TESTS)}')
+        if name in ('in', 'regex'):
+            constant = f'value{number}_{len(tests)}'
+            namespace[constant] = (frozenset(value) if name == 'in'
+                                   else re.compile(value).search)
+            value = constant
+        elif name in ('min', 'max'):
+            value = repr(float(value))
+        else:
+            value = repr(tuple(value) if isinstance(value, list) else value)
+        tests.append(FIELD_TESTS[name].format(field=field, value=value))
+    source = ' and '.join(tests) or 'True'
+    return f'not ({source})' if condition.get('not') else f'({source})'
+
+
+def filtered_parser(parse_fields, conditions):
+    """ Compile field conditions into a parser that returns the fields of
+    parse_fields only when every condition holds, so that filtered rows are
+    dropped while parsing, before they reach the aggregations. Rows missing
+    a tested field or holding text where a number is tested are dropped. """
+    namespace = {'parse': parse_fields}
+    tests = ' and '.join(field_test(condition, number, namespace)
+                         for number, condition in enumerate(conditions))
+    exec('def parse_fields(record):\n'
+         '    fields = parse(record)\n'
+         '    try:\n'
+         f'        if fields and {tests}:\n'
+         '            return fields\n'
+         '    except (IndexError, ValueError):\n'
+         '        pass\n'
+         '    return None', namespace)
+    return namespace['parse_fields']
+
+
+class DeclarativeConfig(DelimitedTextRecordParser, FixedKeyColumn):
+    """ A config described by a spec, usually loaded from a JSON file, whose
+    field parser is compiled once from a regex, split or fixed layout. An
+    optional filter drops raw records by substring or regex before they are
+    decoded and rows by field conditions before they are aggregated. """
+    PARSERS = {'regex': regex_parser,
+               'split': split_parser,
+               'fixed': fixed_parser}
+
+    def __init__(self, spec):
+        super().__init__()
+
+        self.spec = spec
+        self.name = spec['name']
+        self.encoding = spec.get('encoding', 'utf-8')
+        self.record_delimiter = spec.get('record_delimiter', '\n')
+        self.key = spec.get('key')
+        try:
+            key_function(self.key)
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError(f'Config "{self.name}" key: {error}') from error
+        self.numeric = spec.get('numeric', [])
+        self.aggregate = spec.get('aggregate', [])
+        layouts = [name for name in self.PARSERS if name in spec]
+        if len(layouts) != 1:
+            raise Exception(f'Config "{self.name}" needs one of {list(self.PARSERS)}')
+        self.parse_fields = self.PARSERS[layouts[0]](spec[layouts[0]])
+        filter_spec = spec.get('filter', {})
+        select = record_filter(filter_spec, self.encoding)
+        if select is not None:
+            self.record_filter = json.dumps(
+                {name: filter_spec[name] for name in ('contains', 'regex')
+                 if name in filter_spec}, sort_keys=True)
+            self.parse_records = lambda buffer, byte_string: utils.filter_records(
+                buffer, byte_string, self.record_delimiter, self.encoding, select)
+        if filter_spec.get('where'):
+            self.parse_fields = filtered_parser(self.parse_fields,
+                                                filter_spec['where'])
+        self.factory = functools.partial(DeclarativeConfig, spec)
+
+    @classmethod
+    def load(cls, path):
+        """ Load a config from a JSON file. """
+        with open(path, encoding='utf-8') as file:
+            return cls(json.load(file))
+
+
+def source_key(spec):
+    """ A key spec for rows starting with their source, the "source" part
+    being the first column and every other column one to the right. """
+    if spec == 'source':
+        return 0
+    if isinstance(spec, int):
+        return spec + 1
+    if isinstance(spec, dict):
+        return {**spec, 'column': int(spec['column']) + 1}
+    if isinstance(spec, list):
+        return [source_key(part) for part in spec]
+    return spec
+
+
+def source_metadata(metadata):
+    """ Metadata for rows starting with the name of their source, with the
+    columns of the key, the numbers and the aggregations moved one to the
+    right. """
+    aggregate = [{**spec, **{name: spec[name] + 1 for name
+                             in ('column', 'weight')
+                             if spec.get(name) is not None}}
+                 for spec in metadata.get('aggregate') or ()]
+    return {**metadata, 'key': source_key(metadata.get('key')),
+            'numeric': [column + 1 for column
+                        in metadata.get('numeric', ())],
+            'aggregate': aggregate}
+
+
+CONFIG_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'configs')
+
+
+def load_configs(directory=CONFIG_DIRECTORY, errors=None):
+    """ Return a dictionary of config name to factory for the JSON configs in
+    directory. A file that fails to load raises, unless errors is a list in
+    which case the file is skipped and a description of its error added. """
+    configs = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.json'):
+            try:
+                config = DeclarativeConfig.load(
+                    os.path.join(directory, filename))
+            except Exception as error:
+                if errors is None:
+                    raise
+                errors.append(f'{filename}: {error}')
+                continue
+            configs[config.name] = config.factory
+    return configs
+
+
 class Tabulator():
     """ The tabulator has a dynamic config that supplies records split into
-    fields that are then converted to tables. """
-
-    def __init__(self):
+    fields that are then converted to tables. Without keep_history the input
+    is not kept for replay. A replay returns the history in batches of about
+    replay_batch bytes, reusing the records of recent chunks when the config
+    splits records the same way. An opened capture is read before the input
+    and the input can be written to a capture as it is read. The input is
+    the config's reader, stdin, unless several inputs are set in which case
+    each row starts with the name of its source and the config's columns
+    move one to the right. The history kept for replay
+    can be given, such as a compressed ChunkHistory. Each table has the
+    time its records were read, kept in the history and captures so that a
+    replay is timed as the input was. A replay batch holds the chunks read
+    within replay_seconds of its first that are framed the same way. """
+    REPLAY_BATCH = 2**20
+    REPLAY_SECONDS = 1.0
+
+    def __init__(self, keep_history=True, history=None):
         super().__init__()
 
         # Defaults
-        self.replay_bytes = []
-        self.bytes_history = []
-        self.partial_record = b''
+        self.replay_cursor = None
+        self.keep_history = keep_history
+        self.bytes_history = ChunkHistory() if history is None else history
+        self.record_cache = RecordCache()
+        self.chunks_read = 0
+        self.replay_batch = self.REPLAY_BATCH
+        self.replay_seconds = self.REPLAY_SECONDS
+        self.read_time = None
+        self.partial_record = bytearray()
         self.config = DelimitedTextFieldParser()
+        self.generation = 0
+        self.lock = threading.RLock()
+        self.parser = None
+        self.source = None
+        self.capture = None
+        self.inputs = None
+        self.record_sources = None
 
     def replay(self):
-        """ Replay buffer history - useful when changing config. """
-        self.replay_bytes = self.bytes_history
-        self.bytes_history = []
-        self.partial_record = b''
+        """ Replay buffer history - useful when changing config. Tables from
+        before the replay carry an older generation. """
+        with self.lock:
+            self.replay_cursor = HistoryCursor(self.bytes_history)
+            self.partial_record.clear()
+            self.generation += 1
+
+    def set_config(self, config):
+        """ Switch to a new config and replay the history through it. """
+        with self.lock:
+            self.config = config
+            if self.parser is not None:
+                self.set_workers(self.parser.workers)
+            self.replay()
+
+    def set_workers(self, workers):
+        """ Parse fields with a pool of worker processes, or in process when
+        workers is 0. """
+        with self.lock:
+            if self.parser is not None:
+                self.parser.close()
+                self.parser = None
+            if workers > 0:
+                self.parser = ParallelParser(self.config, workers)
+
+    def open_capture(self, reader):
+        """ Start a new session from a capture reader, discarding the history
+        read so far. The input is read once the capture has been read. """
+        with self.lock:
+            if self.source is not None:
+                self.source.close()
+            self.source = reader
+            self.replay_cursor = None
+            self.bytes_history.clear()
+            self.record_cache.clear()
+            self.partial_record.clear()
+            self.generation += 1
+
+    def set_inputs(self, specs):
+        """ Read the sources described by specs instead of the config's
+        reader, or go back to it when specs is empty. """
+        with self.lock:
+            if self.inputs is not None:
+                self.inputs.close()
+                self.inputs = None
+            if specs:
+                self.inputs = Inputs(specs)
+
+    @property
+    def input_reader(self):
+        """ The reader of the input. """
+        return self.config.reader if self.inputs is None else self.inputs
+
+    def read_input(self):
+        """ Read available bytes from the inputs or the config's reader. """
+        if self.inputs is None:
+            return self.config.read_available_bytes()
+        return self.inputs.read(
+            self.config.record_delimiter.encode(self.config.encoding))
+
+    def set_capture(self, path):
+        """ Write the input read from now on to the capture at path, or stop
+        capturing when path is None. """
+        with self.lock:
+            if self.capture is not None:
+                self.capture.close()
+                self.capture = None
+            if path is not None:
+                self.capture = CaptureWriter(path)
+
+    @property
+    def pending(self):
+        """ True when more data can be processed without waiting for input. """
+        return (self.replay_cursor is not None or self.source is not None
+                or self.input_reader.pending)
+
+    @property
+    def replay_progress(self):
+        """ The fraction of the history replayed or of the capture read, or
+        None when neither is in progress. """
+        cursor = self.replay_cursor
+        if cursor is not None:
+            return cursor.position / cursor.end if cursor.end else 1.0
+        source = self.source
+        if source is not None:
+            return source.progress
+        return None
+
+    @property
+    def finished(self):
+        """ True once the input has ended and every record was returned. """
+        return (self.replay_cursor is None and self.source is None
+                and self.input_reader.eof and not self.partial_record)
+
+    def framing(self):
+        """ What the records split from a chunk depend on. """
+        return (self.config.record_delimiter, self.config.encoding,
+                self.config.record_filter)
+
+    def split_chunk(self, byte_string, framed):
+        """ Split a chunk into records, returning them with the (end, name)
+        runs of records from each source when the chunk is framed, holding
+        the records of several inputs, or None otherwise. """
+        if not framed:
+            return (self.config.parse_records(self.partial_record, byte_string),
+                    None)
+        records = []
+        sources = []
+        for name, payload in unframe(byte_string):
+            records += self.config.parse_records(bytearray(), payload)
+            sources.append((len(records), name))
+        return records, sources
+
+    def replay_records(self):
+        """ Replay history chunks until a batch of replay_batch bytes is
+        ready, taking the records of chunks already split the same way from
+        the record cache. """
+        cursor = self.replay_cursor
+        cache = self.record_cache
+        first = self.chunks_read - cursor.end
+        records = []
+        self.record_sources = None
+        size = 0
+        first_time = None
+        while not records or size < self.replay_batch:
+            following = cursor.peek()
+            if records and following is not None and (
+                    following[0] - first_time >= self.replay_seconds
+                    or following[1] != cursor.framed):
+                break
+            number = first + cursor.position
+            byte_string = cursor.next()
+            if byte_string is None:
+                self.replay_cursor = None
+                break
+            if first_time is None:
+                first_time = cursor.time
+            self.read_time = cursor.time
+            size += len(byte_string)
+            cached = cache.get(number)
+            if cached is None:
+                chunk_records, sources = self.split_chunk(byte_string,
+                                                          cursor.framed)
+                cache.put(number, chunk_records, self.partial_record,
+                          len(byte_string), sources)
+            else:
+                chunk_records, partial, _, sources = cached
+                self.partial_record[:] = partial
+            if sources is not None:
+                if self.record_sources is None:
+                    self.record_sources = []
+                self.record_sources += [(len(records) + end, name)
+                                        for end, name in sources]
+            records += chunk_records
+        STATS.count('bytes', size)
+        return records
 
     def read_or_replay_records(self):
         """ Read or replay records - handles partial records """
-        if self.replay_bytes:
-            byte_string = self.replay_bytes.pop(0)
-        else:
-            byte_string = self.config.read_available_bytes()
-
+        if self.keep_history:
+            self.record_cache.set_framing(self.framing())
+        if self.replay_cursor is not None:
+            records = self.replay_records()
+            if records or self.replay_cursor is not None:
+                return records
+
+        byte_string = None
+        self.record_sources = None
+        if self.source is not None:
+            byte_string = self.source.read()
+            if byte_string:
+                self.read_time = self.source.time
+                framed = self.source.framed
+            else:
+                self.source.close()
+                self.source = None
+        if not byte_string:
+            byte_string = self.read_input()
+            framed = self.inputs is not None
+            if (not byte_string and self.input_reader.eof
+                    and self.partial_record):
+                # The input ended without a final delimiter so end the last
+                # record with one, kept like any other chunk
+                byte_string = self.config.record_delimiter.encode(
+                    self.config.encoding)
+                framed = False
+            if byte_string:
+                self.read_time = time.time()
+                if self.capture is not None:
+                    self.capture.write(byte_string, self.read_time, framed)
         if byte_string:
-            self.bytes_history.append(byte_string)
-            records, self.partial_record = self.config.parse_records(
-                self.partial_record + byte_string)
+            STATS.count('bytes', len(byte_string))
+            records, self.record_sources = self.split_chunk(byte_string,
+                                                            framed)
+            if self.keep_history:
+                self.bytes_history.append(byte_string, self.read_time,
+                                          framed)
+                self.record_cache.put(self.chunks_read, records,
+                                      self.partial_record, len(byte_string),
+                                      self.record_sources)
+                self.chunks_read += 1
             return records
-        else:
-            return None
+        return None
+
+    def parse_rows(self, records):
+        """ Parse records into rows of fields, dropping records that do not
+        parse. """
+        if self.parser is not None and len(records) >= self.parser.min_records:
+            return self.parser.parse(records)
+        rows = []
+        for record in records:
+            fields = self.config.parse_fields(record)
+            if fields:
+                rows.append(fields)
+        return rows
 
     def update(self):
         """ Read available data and convert to a table """
-        rows = []
-        records = self.read_or_replay_records()
-        if records:
-            metadata = self.config.get_metadata(records)
-            for record in records:
-                fields = self.config.parse_fields(record)
-                if fields:
-                    rows.append(fields)
-        else:
-            metadata = {}
-        return {'metadata': metadata, 'rows': rows}
+        with self.lock:
+            rows = []
+            with STATS.timer('read'):
+                records = self.read_or_replay_records()
+            if records:
+                metadata = self.config.get_metadata(records)
+                with STATS.timer('parse'):
+                    if self.record_sources is None:
+                        rows = self.parse_rows(records)
+                    else:
+                        metadata = source_metadata(metadata)
+                        start = 0
+                        for end, name in self.record_sources:
+                            rows += [[name, *fields] for fields in
+                                     self.parse_rows(records[start:end])]
+                            start = end
+                STATS.count('records', len(records))
+                STATS.count('rows', len(rows))
+            else:
+                metadata = {}
+            return {'metadata': metadata, 'rows': rows,
+                    'pending': self.pending, 'generation': self.generation,
+                    'time': self.read_time if records else None}
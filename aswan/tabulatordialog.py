@@ -1,16 +1,14 @@
 """ Tabulator Dialog is used to configure the available table columns for a
 report."""
-from PyQt5.QtWidgets import QDialog
+from PyQt5.QtWidgets import QDialog, QMessageBox
 from ui_tabulatordialog import Ui_TabulatorDialog
-from tabulator import SyslogConfig, TcpDumpConfig, WeblogConfig, DelimitedTextFieldParser
+from tabulator import DelimitedTextFieldParser, load_configs
 
 
 class TabulatorDialog(QDialog):
-    """ Setup the tabulator. """
-    OPTIONS = {'Default':DelimitedTextFieldParser,
-               'TcpDump': TcpDumpConfig,
-               'WebLog': WeblogConfig,
-               'SysLog': SyslogConfig}
+    """ Setup the tabulator. The templates are the JSON configs found in the
+    configs directory when the dialog is opened, a file that fails to load
+    is reported and left out. """
 
     def __init__(self, application):
         super().__init__()
@@ -18,9 +16,14 @@ class TabulatorDialog(QDialog):
         self.dialog = Ui_TabulatorDialog()
         self.dialog.setupUi(self)
         self.application = application
+        errors = []
+        self.options = {'Default': DelimitedTextFieldParser,
+                        **load_configs(errors=errors)}
+        for error in errors:
+            QMessageBox.warning(self, 'Tabulator Config', error)
 
         # Data binding
-        self.dialog.comboBox.insertItems(0, list(self.OPTIONS.keys()))
+        self.dialog.comboBox.insertItems(0, list(self.options.keys()))
 
         # Command binding
         self.dialog.buttonBox.accepted.connect(self.cmd_apply)
@@ -29,7 +32,6 @@ class TabulatorDialog(QDialog):
     def cmd_apply(self):
         """ Handle Ok/Cancel. """
         option = self.dialog.comboBox.currentText()
-        self.application.TABULATOR.config = self.OPTIONS[option]()
-        self.application.TABULATOR.replay()
-        self.application.REPORT.clear()
+        self.application.TABULATOR.set_config(self.options[option]())
+        self.application.REPORT.clear(aggregations=False)
         self.close()
@@ -0,0 +1,162 @@
+""" Tests of capture files: reading them back, repairing a capture cut
+short and the limits of a capture reader. Run with:
+python3 -m unittest test_capture """
+import os
+import tempfile
+import unittest
+from capture import (CHUNK_HEADER, INDEX_ENTRY, CaptureFile, CaptureWriter,
+                     index_path)
+
+
+class CaptureTest(unittest.TestCase):
+    """ Writes captures of numbered chunks read a tenth of a second apart
+    into a temporary directory. """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'test.cap')
+
+    def write(self, chunks, start=1000.0, framed=False):
+        writer = CaptureWriter(self.path)
+        for number, chunk in enumerate(chunks):
+            writer.write(chunk, start + number / 10, framed)
+        writer.close()
+
+    def open(self):
+        capture = CaptureFile(self.path)
+        self.addCleanup(capture.close)
+        return capture
+
+    def chunks(self, capture):
+        return [capture.chunk(index) for index in range(len(capture))]
+
+
+class CaptureFileTest(CaptureTest):
+    """ Chunks read back as written, and a capture cut short by a crash
+    opens with the chunks that were complete and can be appended to. """
+
+    def test_read_back(self):
+        chunks = [b'%d\n' % number * number for number in range(1, 20)]
+        self.write(chunks)
+        capture = self.open()
+        self.assertFalse(capture.repaired)
+        self.assertEqual(self.chunks(capture), chunks)
+        self.assertEqual(list(capture.times),
+                         [1000.0 + number / 10 for number in range(19)])
+        self.assertAlmostEqual(capture.duration, 1.8)
+        self.assertEqual(capture.seek(0.5), 5)
+        self.assertEqual(capture.seek(-0.3), 15)
+
+    def test_not_a_capture(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'not a capture\n')
+        with self.assertRaises(ValueError):
+            CaptureFile(self.path)
+
+    def test_chunk_cut_short(self):
+        chunks = [b'first\n', b'second\n', b'third\n']
+        self.write(chunks)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as file:
+            file.truncate(size - 3)
+        capture = self.open()
+        self.assertEqual(self.chunks(capture), chunks[:2])
+        capture.close()
+        self.write([b'fourth\n'], start=2000.0)
+        capture = self.open()
+        self.assertFalse(capture.repaired)
+        self.assertEqual(self.chunks(capture), chunks[:2] + [b'fourth\n'])
+        self.assertEqual(capture.times[-1], 2000.0)
+
+    def test_missing_index(self):
+        chunks = [b'a\n', b'bb\n', b'ccc\n']
+        self.write(chunks)
+        os.remove(index_path(self.path))
+        capture = self.open()
+        self.assertTrue(capture.repaired)
+        self.assertEqual(self.chunks(capture), chunks)
+        self.assertEqual(list(capture.times), [1000.0, 1000.1, 1000.2])
+
+    def test_index_cut_short(self):
+        chunks = [b'a\n', b'bb\n', b'ccc\n']
+        self.write(chunks)
+        with open(index_path(self.path), 'r+b') as file:
+            file.truncate(INDEX_ENTRY.size + 5)
+        capture = self.open()
+        self.assertTrue(capture.repaired)
+        self.assertEqual(self.chunks(capture), chunks)
+        capture.close()
+        self.write([b'dddd\n'])
+        capture = self.open()
+        self.assertFalse(capture.repaired)
+        self.assertEqual(self.chunks(capture), chunks + [b'dddd\n'])
+
+    def test_index_past_data(self):
+        chunks = [b'a\n', b'bb\n', b'ccc\n']
+        self.write(chunks)
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path)
+                          - CHUNK_HEADER.size - len(chunks[-1]))
+        capture = self.open()
+        self.assertTrue(capture.repaired)
+        self.assertEqual(self.chunks(capture), chunks[:2])
+
+    def test_framed_chunks(self):
+        writer = CaptureWriter(self.path)
+        writer.write(b'one\n', 1.0, True)
+        writer.write(b'two\n', 1.1, True)
+        writer.write(b'three\n', 1.2)
+        writer.write(b'four\n', 1.3, True)
+        writer.close()
+        capture = self.open()
+        self.assertEqual(list(capture.framed), [1, 1, 0, 1])
+        self.assertEqual(self.chunks(capture),
+                         [b'one\n', b'two\n', b'three\n', b'four\n'])
+        reader = capture.reader()
+        reads = []
+        while reader.pending:
+            reads.append((reader.read(), reader.framed))
+        self.assertEqual(reads, [(b'one\ntwo\n', True), (b'three\n', False),
+                                 (b'four\n', True)])
+
+
+class CaptureReaderTest(CaptureTest):
+    """ A read joins whole chunks within max_bytes and max_seconds of its
+    first, or is one larger chunk. """
+
+    def read_all(self, reader):
+        reads = []
+        while reader.pending:
+            reads.append((reader.read(), reader.time))
+        self.assertEqual(reader.read(), b'')
+        return reads
+
+    def test_max_bytes(self):
+        chunks = [b'x' * size + b'\n' for size in
+                  (10, 30, 5, 60, 200, 1, 1, 1, 80, 40, 39, 3)]
+        self.write(chunks)
+        capture = self.open()
+        for max_bytes in (1, 41, 50, 81, 100, 1000):
+            reads = self.read_all(capture.reader(0, max_bytes, 60))
+            self.assertEqual(b''.join(data for data, _ in reads),
+                             b''.join(chunks))
+            for data, _ in reads:
+                if len(data) > max_bytes:
+                    self.assertIn(data, chunks)
+
+    def test_max_seconds(self):
+        chunks = [b'%d\n' % number for number in range(30)]
+        self.write(chunks)
+        capture = self.open()
+        reads = self.read_all(capture.reader(5, 2**20, 1.0))
+        self.assertEqual([data for data, _ in reads],
+                         [b''.join(chunks[5:15]), b''.join(chunks[15:25]),
+                          b''.join(chunks[25:])])
+        self.assertEqual([time for _, time in reads],
+                         [capture.times[14], capture.times[24],
+                          capture.times[29]])
+
+
+if __name__ == '__main__':
+    unittest.main()
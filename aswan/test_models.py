@@ -0,0 +1,202 @@
+""" Consistency tests of the report under row eviction and of the
+incremental sort and filter proxy, checked by QAbstractItemModelTester.
+Run with: python3 -m unittest test_models """
+import os
+import random
+import unittest
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PyQt5.QtCore import QtMsgType, Qt, qInstallMessageHandler
+from PyQt5.QtTest import QAbstractItemModelTester
+from PyQt5.QtWidgets import QApplication
+from proxy import SortFilterProxy, sort_key
+from report import Report
+from store import EvictionPolicy, HistoryPolicy
+
+APPLICATION = QApplication.instance() or QApplication([])
+
+
+class Feed():
+    """ An aggregator applying one batch of groups per update and noting
+    the keys the report forgets. """
+
+    def __init__(self, batches):
+        super().__init__()
+        self.batches = iter(batches)
+        self.forgotten = []
+
+    def update(self, report):
+        """ Apply the next batch. """
+        groups = next(self.batches, [])
+        report.apply(groups, numeric=[2])
+        return {'rows': [row for _, rows in groups for row in rows]}
+
+    def forget(self, keys):
+        """ Note the evicted keys. """
+        self.forgotten += keys
+
+    def clear(self):
+        """ There is no aggregation state. """
+
+
+def skewed_batches(seed, count=40):
+    """ Batches of groups of [key, text, number] rows with a few busy keys
+    and many that are seen rarely. """
+    generator = random.Random(seed)
+    batches = []
+    for _ in range(count):
+        groups = {}
+        for _ in range(generator.randint(0, 12)):
+            key = f'k{int(generator.paretovariate(0.7))}'
+            groups[key] = [[key, generator.choice('abcxyz'),
+                            generator.randint(0, 99)]
+                           for _ in range(generator.randint(1, 3))]
+        batches.append(list(groups.items()))
+    return batches
+
+
+class ModelTest(unittest.TestCase):
+    """ Collects the failures QAbstractItemModelTester reports as Qt
+    warnings. """
+
+    def setUp(self):
+        self.failures = []
+
+        def handler(message_type, context, message):
+            if message_type != QtMsgType.QtDebugMsg and 'FAIL' in message:
+                self.failures.append(message)
+        qInstallMessageHandler(handler)
+        self.addCleanup(qInstallMessageHandler, None)
+
+    def check_model(self, model):
+        """ Check model on every change for as long as the test runs. """
+        tester = QAbstractItemModelTester(
+            model, QAbstractItemModelTester.FailureReportingMode.Warning)
+        self.addCleanup(tester.deleteLater)
+        return tester
+
+
+class ReportEvictionTest(ModelTest):
+    """ Evicting rows moves the last rows into their place. Each key keeps
+    its row, cells and history and the evicted keys are forgotten. """
+
+    def check(self, report, latest):
+        store = report.store
+        self.assertEqual(report.rowCount(), len(store.row_index))
+        self.assertEqual(sorted(store.row_index.values()),
+                         list(range(report.rowCount())))
+        for key, row in store.row_index.items():
+            self.assertEqual(store.keys[row], key)
+            self.assertEqual(report.data(report.index(row, 0)), key)
+            self.assertEqual(report.data(report.index(row, 1)),
+                             latest[key][1])
+            self.assertEqual(report.data(report.index(row, 2), Qt.UserRole),
+                             latest[key][2])
+            history = store.history[row]
+            self.assertEqual(report.rowCount(report.index(row, 0)),
+                             len(history))
+            for entry in range(len(history)):
+                self.assertEqual(report.data(report.index(
+                    entry, 0, report.index(row, 0))), key)
+
+    def evict(self, order):
+        batches = skewed_batches(7)
+        feed = Feed(batches)
+        report = Report(feed, HistoryPolicy(limit=3, budget=3000),
+                        EvictionPolicy(20, order))
+        self.check_model(report)
+        latest = {}
+        for groups in batches:
+            report.update()
+            for key, rows in groups:
+                latest[key] = rows[-1]
+            self.assertLessEqual(report.rowCount(), 20)
+            for key in feed.forgotten:
+                self.assertNotIn(key, report.store.row_index)
+                latest.pop(key, None)
+            feed.forgotten = []
+            self.check(report, latest)
+        self.assertEqual(self.failures, [])
+
+    def test_lru(self):
+        self.evict('lru')
+
+    def test_lfu(self):
+        self.evict('lfu')
+
+
+class SortFilterProxyTest(ModelTest):
+    """ The proxy shows the rows a full sort and filter of the report would,
+    while rows are added, updated and evicted and the sort and filter
+    change. """
+
+    def check(self, report, proxy):
+        expected = []
+        for row in range(report.rowCount()):
+            if proxy.pattern is not None:
+                columns = ([proxy.filter_column] if proxy.filter_column >= 0
+                           else range(report.columnCount()))
+                texts = [report.data(report.index(row, column))
+                         for column in columns]
+                if not any(text is not None and proxy.pattern.search(str(text))
+                           for text in texts):
+                    continue
+            key = ()
+            if proxy.sort_column >= 0:
+                key = sort_key(report.data(
+                    report.index(row, proxy.sort_column), Qt.UserRole))
+            expected.append((key, row))
+        expected.sort(reverse=proxy.sort_order == Qt.DescendingOrder)
+        self.assertEqual(proxy.rowCount(), len(expected))
+        shown = []
+        for row in range(proxy.rowCount()):
+            source = proxy.mapToSource(proxy.index(row, 0))
+            self.assertEqual(proxy.mapFromSource(source).row(), row)
+            self.assertEqual(proxy.rowCount(proxy.index(row, 0)),
+                             report.rowCount(source))
+            for column in range(proxy.columnCount()):
+                self.assertEqual(
+                    proxy.data(proxy.index(row, column)),
+                    report.data(report.index(source.row(), column)))
+            shown.append(source.row())
+        self.assertEqual(sorted(shown), sorted(row for _, row in expected))
+        self.assertEqual([key for key, _ in expected],
+                         [() if proxy.sort_column < 0 else sort_key(
+                             report.data(report.index(row, proxy.sort_column),
+                                         Qt.UserRole)) for row in shown])
+
+    def follow(self, eviction):
+        batches = skewed_batches(11)
+        report = Report(Feed(batches), HistoryPolicy(limit=3, budget=3000),
+                        eviction)
+        proxy = SortFilterProxy()
+        proxy.setSourceModel(report)
+        self.check_model(proxy)
+        proxy.sort(2, Qt.DescendingOrder)
+        changes = {10: lambda: proxy.sort(1, Qt.AscendingOrder),
+                   15: lambda: proxy.set_filter('[ax]', 1),
+                   20: lambda: proxy.set_filter('k1', -1),
+                   23: lambda: proxy.sort(-1),
+                   26: lambda: proxy.set_filter(''),
+                   28: lambda: proxy.sort(0, Qt.DescendingOrder),
+                   33: report.clear,
+                   35: lambda: proxy.sort(2, Qt.AscendingOrder)}
+        for number in range(len(batches)):
+            if number in changes:
+                changes[number]()
+            report.update()
+            proxy.refresh()
+            self.check(report, proxy)
+        self.assertEqual(self.failures, [])
+
+    def test_without_eviction(self):
+        self.follow(None)
+
+    def test_lru(self):
+        self.follow(EvictionPolicy(20, 'lru'))
+
+    def test_lfu(self):
+        self.follow(EvictionPolicy(20, 'lfu'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+""" Accuracy and merge tests of the HyperLogLog and KLL sketches. Run with:
+python3 -m unittest test_sketches """
+import bisect
+import math
+import random
+import unittest
+from aggregator import KLL, HyperLogLog
+
+
+def rank_error(sketch, values, fractions):
+    """ The largest difference between a fraction and the rank of the
+    sketch's quantile for it among the sorted values. """
+    ranked = sorted(values)
+    return max(abs(bisect.bisect_left(ranked, quantile) / len(ranked)
+                   - fraction)
+               for quantile, fraction
+               in zip(sketch.quantiles(fractions), fractions))
+
+
+def registers(sketch):
+    """ The registers of a HyperLogLog sketch, sparse or not, as a list. """
+    if type(sketch.registers) is dict:
+        ranks = [0] * (1 << sketch.precision)
+        for index, rank in sketch.registers.items():
+            ranks[index] = rank
+        return ranks
+    return list(sketch.registers)
+
+
+def total_weight(sketch):
+    """ The number of values a KLL sketch stands for. """
+    return sum(len(compactor) << level
+               for level, compactor in enumerate(sketch.compactors))
+
+
+class HyperLogLogTest(unittest.TestCase):
+    """ Counts stay within three standard errors, 1.04 / sqrt(2 ** precision)
+    each, and merges equal the sketch of the combined values. """
+
+    def assert_within_bound(self, sketch, count):
+        bound = 3 * 1.04 / math.sqrt(1 << sketch.precision)
+        self.assertLessEqual(abs(sketch.count() - count) / count, bound)
+
+    def test_error_within_bound(self):
+        for precision in (8, 10, 12):
+            for count in (10, 1000, 20000):
+                sketch = HyperLogLog(precision)
+                for value in range(count):
+                    sketch.add(f'value {value}')
+                    sketch.add(f'value {value // 2}')
+                self.assert_within_bound(sketch, count)
+
+    def test_merge_matches_combined(self):
+        for sizes in ((10, 20), (3000, 50), (20000, 30000)):
+            first, second, combined = (HyperLogLog(10) for _ in range(3))
+            for value in range(sizes[0]):
+                first.add(value)
+                combined.add(value)
+            for value in range(sizes[0] // 2, sizes[0] // 2 + sizes[1]):
+                second.add(value)
+                combined.add(value)
+            first.merge(second)
+            self.assertEqual(registers(first), registers(combined))
+            self.assertAlmostEqual(first.count(), combined.count())
+            self.assert_within_bound(first,
+                                     max(sizes[0], sizes[0] // 2 + sizes[1]))
+
+    def test_merge_needs_same_precision(self):
+        with self.assertRaises(ValueError):
+            HyperLogLog(10).merge(HyperLogLog(12))
+
+
+class KLLTest(unittest.TestCase):
+    """ Quantiles stay within a rank error of 2 / k in about 3 * k values,
+    plus one per level from rounding, and merges stand for the combined
+    values within the same bound. Compaction is random so the generator is
+    seeded. """
+    FRACTIONS = [index / 100 for index in range(1, 100)]
+
+    def setUp(self):
+        random.seed(1)
+        self.values = random.Random(2)
+
+    def test_error_within_bound(self):
+        for k in (100, 200):
+            for values in ([self.values.random() for _ in range(50000)],
+                           [self.values.expovariate(1) for _ in range(50000)],
+                           list(range(20000, 0, -1))):
+                sketch = KLL(k)
+                for value in values:
+                    sketch.add(value)
+                self.assertEqual(total_weight(sketch), len(values))
+                self.assertLessEqual(sketch.nbytes(),
+                                     8 * (3 * k + len(sketch.compactors)))
+                self.assertLessEqual(
+                    rank_error(sketch, values, self.FRACTIONS), 2 / k)
+
+    def test_exact_while_small(self):
+        values = [self.values.random() for _ in range(150)]
+        sketch = KLL(200)
+        for value in values:
+            sketch.add(value)
+        ranked = sorted(values)
+        self.assertEqual(sketch.quantiles(self.FRACTIONS),
+                         [ranked[math.ceil(fraction * len(ranked)) - 1]
+                          for fraction in self.FRACTIONS])
+
+    def test_merge_matches_combined(self):
+        for sizes in ((50, 60), (30000, 500), (40000, 40000)):
+            first_values = [self.values.random() for _ in range(sizes[0])]
+            second_values = [self.values.random() * 2
+                             for _ in range(sizes[1])]
+            first, second, combined = (KLL(200) for _ in range(3))
+            for value in first_values:
+                first.add(value)
+                combined.add(value)
+            for value in second_values:
+                second.add(value)
+                combined.add(value)
+            first.merge(second)
+            values = first_values + second_values
+            self.assertEqual(total_weight(first), len(values))
+            self.assertEqual(total_weight(first), total_weight(combined))
+            if len(values) < first.capacity(0):
+                self.assertEqual(first.quantiles(self.FRACTIONS),
+                                 combined.quantiles(self.FRACTIONS))
+            for sketch in (first, combined):
+                self.assertLessEqual(
+                    rank_error(sketch, values, self.FRACTIONS), 2 / 200)
+
+    def test_merge_needs_same_k(self):
+        with self.assertRaises(ValueError):
+            KLL(200).merge(KLL(100))
+
+
+if __name__ == '__main__':
+    unittest.main()
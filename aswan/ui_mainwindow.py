@@ -53,6 +53,10 @@ class Ui_MainWindow(object):
         self.actionAudible_Blink.setCheckable(True)
         self.actionAudible_Blink.setChecked(False)
         self.actionAudible_Blink.setObjectName("actionAudible_Blink")
+        self.actionStatistics = QtWidgets.QAction(MainWindow)
+        self.actionStatistics.setCheckable(True)
+        self.actionStatistics.setChecked(False)
+        self.actionStatistics.setObjectName("actionStatistics")
         self.actionSave = QtWidgets.QAction(MainWindow)
         self.actionSave.setObjectName("actionSave")
         self.actionSave_As = QtWidgets.QAction(MainWindow)
@@ -89,6 +93,7 @@ class Ui_MainWindow(object):
         self.menuView.addSeparator()
         self.menuView.addAction(self.actionRealtime)
         self.menuView.addAction(self.actionAudible_Blink)
+        self.menuView.addAction(self.actionStatistics)
         self.menubar.addAction(self.menuFile.menuAction())
         self.menubar.addAction(self.menuView.menuAction())
         self.menubar.addAction(self.menuHelp.menuAction())
@@ -107,6 +112,7 @@ class Ui_MainWindow(object):
         self.actionVersion.setText(_translate("MainWindow", "Version 0.0.3"))
         self.actionRealtime.setText(_translate("MainWindow", "Realltime"))
         self.actionAudible_Blink.setText(_translate("MainWindow", "Audible Blink"))
+        self.actionStatistics.setText(_translate("MainWindow", "Statistics"))
         self.actionSave.setText(_translate("MainWindow", "Save"))
         self.actionSave_As.setText(_translate("MainWindow", "Save As..."))
         self.actionNew.setText(_translate("MainWindow", "New"))
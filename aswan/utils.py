@@ -12,20 +12,115 @@ def bytes_to_unicode_records(byte_string, delimiter, encoding):
     return (records[:-1], records[-1].encode(encoding))
 
 
-def read_available_bytes(file=sys.stdin, chunk_size=4096):
-    """ Read all available data from f in chucks of chunk_size returning a byte
-    array or None if nothing read. """
-    buffer = b''
-    while True:
-        read_list, _, exception_list = select.select([file], [], [file], 0)
-        if file in exception_list:
-            print('stdin error')
-            break
-        if file in read_list:
-            chunk = os.read(file.fileno(), chunk_size)
-            if chunk == b'':
-                break
-            buffer += chunk
-        else:
-            break
-    return buffer
+def split_records(buffer, byte_string, delimiter, encoding):
+    """ Append byte_string to the partial record held in the bytearray buffer
+    and return the complete records as unicode. Only the new bytes are
+    searched for delimiters, complete records are decoded once and the
+    trailing partial record stays in buffer as undecoded bytes. """
+    raw_delimiter = delimiter.encode(encoding)
+    if buffer and len(raw_delimiter) > 1:
+        # The delimiter may straddle the partial record and the new bytes
+        start = max(0, len(buffer) - len(raw_delimiter) + 1)
+        buffer += byte_string
+        end = buffer.rfind(raw_delimiter, start)
+        if end < 0:
+            return []
+        with memoryview(buffer) as view:
+            records = str(view[:end], encoding).split(delimiter)
+        del buffer[:end + len(raw_delimiter)]
+        return records
+
+    end = byte_string.rfind(raw_delimiter)
+    if end < 0:
+        buffer += byte_string
+        return []
+    if buffer:
+        # Only the first record needs joining to the partial record
+        first = byte_string.find(raw_delimiter)
+        buffer += byte_string[:first]
+        records = [buffer.decode(encoding)]
+        buffer.clear()
+        if end > first:
+            records.extend(byte_string[first + len(raw_delimiter):end].decode(
+                encoding).split(delimiter))
+    else:
+        records = byte_string[:end].decode(encoding).split(delimiter)
+    buffer += byte_string[end + len(raw_delimiter):]
+    return records
+
+
+def filter_records(buffer, byte_string, delimiter, encoding, select):
+    """ Like split_records but the complete records are split as bytes and
+    only those kept by select, which takes and returns a list of raw
+    records, are decoded. """
+    raw_delimiter = delimiter.encode(encoding)
+    start = max(0, len(buffer) - len(raw_delimiter) + 1)
+    buffer += byte_string
+    end = buffer.rfind(raw_delimiter, start)
+    if end < 0:
+        return []
+    with memoryview(buffer) as view:
+        complete = view[:end].tobytes()
+    del buffer[:end + len(raw_delimiter)]
+    return [record.decode(encoding)
+            for record in select(complete.split(raw_delimiter))]
+
+
+if hasattr(os, 'readv'):
+    def readinto(fileno, view):
+        """ Read from fileno directly into view returning the byte count. """
+        return os.readv(fileno, [view])
+else:
+    def readinto(fileno, view):
+        """ Read from fileno into view returning the byte count. """
+        chunk = os.read(fileno, len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class ByteReader():
+    """ Drain available data from a file into a reusable preallocated buffer.
+    The read size adapts to the data rate and at most max_bytes are read per
+    call, pending is set when data was left unread because of that budget
+    and eof once the end of the file has been read. """
+    MIN_CHUNK = 4096
+
+    def __init__(self, file=sys.stdin, max_bytes=16 * 2**20):
+        super().__init__()
+        self.file = file
+        self.max_bytes = max_bytes
+        self.buffer = None
+        self.chunk_size = 65536
+        self.pending = False
+        self.eof = False
+
+    def read(self):
+        """ Read all available data up to max_bytes returning bytes, which are
+        empty if nothing was read. """
+        if self.buffer is None or len(self.buffer) != self.max_bytes:
+            self.buffer = bytearray(self.max_bytes)
+        fileno = self.file.fileno()
+        size = 0
+        self.pending = False
+        with memoryview(self.buffer) as view:
+            while size < self.max_bytes:
+                read_list, _, exception_list = select.select(
+                    [fileno], [], [fileno], 0)
+                if exception_list:
+                    print('stdin error')
+                    break
+                if not read_list:
+                    break
+                chunk_size = min(self.chunk_size, self.max_bytes - size)
+                count = readinto(fileno, view[size:size + chunk_size])
+                if count == 0:
+                    self.eof = True
+                    break
+                size += count
+                if count == chunk_size:
+                    self.chunk_size = min(2 * self.chunk_size, self.max_bytes)
+                elif count < chunk_size // 4:
+                    self.chunk_size = max(self.chunk_size // 2, self.MIN_CHUNK)
+            else:
+                self.pending = True
+            return view[:size].tobytes()